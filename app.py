@@ -1,8 +1,6 @@
 
 from flask import Flask
 from flask_cors import CORS
-from main import main
-from documents import documents
 import os
 from dotenv import load_dotenv
 
@@ -13,6 +11,13 @@ load_dotenv()
 
 def create_app():
     """Créer et configurer l'application Flask."""
+    # Importés ici : les processus d'extraction PDF (spawn) réimportent ce module
+    # quand il est lancé directement, sans avoir besoin de Chroma ni d'OpenAI
+    from main import main
+    from documents import documents
+    from jobs import get_job_queue
+    from discussion_store import get_discussion_store
+
     app = Flask(__name__)
     
     # Configuration CORS pour permettre les requêtes depuis le frontend React
@@ -22,6 +27,12 @@ def create_app():
     app.register_blueprint(main, url_prefix='/api')
     app.register_blueprint(documents, url_prefix='/api')
     
+    # Ouverture du stockage des discussions : les anciennes discussions JSON y sont importées avant de servir
+    get_discussion_store()
+
+    # Reprise des tâches d'ingestion en attente ou interrompues par un redémarrage
+    get_job_queue().resume()
+    
     return app
 
 if __name__ == '__main__':
@@ -0,0 +1,225 @@
+import asyncio
+import contextvars
+import logging
+
+from asgiref.wsgi import WsgiToAsgi
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+from app import create_app
+from cache import query_embedding_cache, answer_cache, make_cache_key
+from main import (
+    CHAT_MODEL, CORS_HEADERS, ERROR_MESSAGE, validate_question, load_history, is_history_less, prepare_prompt,
+    replay_answer, stream_headers, save_answer, finish_ask_trace,
+)
+from metrics import Trace, ASK_REQUESTS
+from registry import get_async_openai_client, get_collection, get_embedding_function, EMBEDDING_PROVIDER
+from retrieval import retrieve
+from singleflight import SINGLE_FLIGHT, SINGLE_FLIGHT_WAIT, ask_flights
+from storage import append_message_to_discussion
+
+logger = logging.getLogger(__name__)
+
+
+async def get_query_embedding_async(question):
+    """Version asynchrone de `main.get_query_embedding`, via le client OpenAI asynchrone.
+
+    Avec un fournisseur local, le calcul se fait dans un thread, hors de la boucle d'événements.
+    """
+    provider = get_embedding_function()
+    embedding = query_embedding_cache.get(question, provider.model_name)
+    if embedding is not None:
+        logger.info("Embedding de la question trouvé en cache.")
+        return embedding
+
+    if EMBEDDING_PROVIDER == 'openai':
+        response = await get_async_openai_client().embeddings.create(
+            model=provider.model_name,
+            input=[question]
+        )
+        embedding = response.data[0].embedding
+    else:
+        embedding = (await asyncio.to_thread(provider.embed, [question]))[0]
+    query_embedding_cache.set(question, provider.model_name, embedding)
+    return embedding
+
+
+async def follow_flight(trace, question, discussion_path, flight):
+    """Version asynchrone de `main.follow_flight`."""
+    with trace.span('save_question'):
+        await asyncio.to_thread(
+            append_message_to_discussion, discussion_path, {"type": "user", "content": question}
+        )
+
+    async def stream_with_save():
+        full_response = ""
+        async for chunk in flight.replay_async():
+            if not full_response:
+                trace.record('ttft', trace.since_start())
+            full_response += chunk
+            yield chunk
+        failed = flight.failed
+        with trace.span('save_answer'):
+            await asyncio.to_thread(
+                save_answer, question, discussion_path, {"context": flight.context, "has_history": False},
+                None, full_response, True, failed
+            )
+        finish_ask_trace(trace, full_response, True, failed, coalesced=True)
+
+    return StreamingResponse(
+        stream_with_save(),
+        media_type="text/plain",
+        headers=stream_headers(flight.filenames)
+    )
+
+
+async def ask(request):
+    """Version asynchrone de `/api/ask`, même contrat que `main.ask`.
+
+    Le streaming OpenAI et les appels bloquants (Chroma, disque) ne monopolisent
+    pas le worker : une boucle asyncio garde des centaines de flux ouverts.
+    """
+    trace = Trace('ask')
+    try:
+        data = await request.json()
+    except Exception:
+        data = None
+
+    question, error = validate_question(data)
+    if error:
+        return JSONResponse({"error": error}, status_code=400, headers=CORS_HEADERS)
+
+    flight, flight_key, leader = None, None, False
+    try:
+        discussion_path = data.get('filename')
+        logger.info(f"Question reçue: {question}")
+
+        # L'historique de la session peut être relu depuis le stockage des discussions
+        history = await asyncio.to_thread(load_history, data)
+
+        # 🔹 Une question identique sans historique est déjà en cours : on suit sa réponse
+        if SINGLE_FLIGHT and is_history_less(history):
+            flight_key = make_cache_key(question, CHAT_MODEL)
+            flight, leader = ask_flights.join(flight_key)
+            if not leader:
+                if await flight.wait_start_async(SINGLE_FLIGHT_WAIT):
+                    return await follow_flight(trace, question, discussion_path, flight)
+                flight = None
+
+        # Recherche dans ChromaDB, hors de la boucle d'événements
+        with trace.span('embedding'):
+            query_embedding = await get_query_embedding_async(question)
+        collection = await asyncio.to_thread(get_collection)
+        with trace.span('retrieval'):
+            results = await asyncio.to_thread(retrieve, collection, question, query_embedding, n_results=5)
+
+        with trace.span('prompt'):
+            prompt = await asyncio.to_thread(prepare_prompt, question, data, results, history)
+
+        # 🔹 Sauvegarder la question
+        with trace.span('save_question'):
+            await asyncio.to_thread(
+                append_message_to_discussion, discussion_path, {"type": "user", "content": question}
+            )
+
+        # 🔹 Cache sémantique des réponses, uniquement sans historique
+        cached_answer = None
+        if not prompt["has_history"]:
+            cached_answer = await asyncio.to_thread(answer_cache.lookup, query_embedding, prompt["source_ids"])
+            if cached_answer is not None:
+                prompt["filenames"] = cached_answer[1]
+
+    except Exception as e:
+        logger.error("Erreur lors de la recherche de similarité : %s", str(e))
+        if leader and not flight.started:
+            ask_flights.abandon(flight_key, flight)
+        ASK_REQUESTS.labels("error").inc()
+        return JSONResponse({"error": "Erreur lors de la recherche de similarité."}, status_code=500,
+                            headers=CORS_HEADERS)
+
+    full_response = ""
+    failed = False
+
+    async def generate():
+        nonlocal full_response, failed
+        if cached_answer is not None:
+            full_response = cached_answer[0]
+            for chunk in replay_answer(full_response):
+                yield chunk
+        else:
+            try:
+                with trace.span('generation'):
+                    stream = await get_async_openai_client().chat.completions.create(
+                        model=CHAT_MODEL,
+                        messages=prompt["messages"],
+                        stream=True,
+                    )
+
+                    async for chunk in stream:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            content = chunk.choices[0].delta.content
+                            if not full_response:
+                                trace.record('ttft', trace.since_start())
+                            full_response += content
+                            yield content
+
+            except Exception as e:
+                logger.error("Erreur modèle : %s", str(e))
+                full_response = ERROR_MESSAGE
+                failed = True
+                if leader:
+                    flight.fail()
+                yield ERROR_MESSAGE
+
+    # 🔹 Meneur : la génération est partagée avec les questions identiques qui arrivent
+    chunks = generate()
+    if leader:
+        flight.start(prompt["filenames"], prompt["context"])
+        ask_flights.launch_async(flight_key, flight, chunks)
+        chunks = flight.replay_async()
+
+    async def stream_with_save():
+        async for chunk in chunks:
+            yield chunk
+
+        # 🔹 On sauvegarde la réponse une fois générée
+        with trace.span('save_answer'):
+            await asyncio.to_thread(
+                save_answer, question, discussion_path, prompt, query_embedding,
+                full_response, cached_answer is not None, failed
+            )
+        finish_ask_trace(trace, full_response, cached_answer is not None, failed)
+
+    return StreamingResponse(
+        stream_with_save(),
+        media_type="text/plain",
+        headers=stream_headers(prompt["filenames"])
+    )
+
+
+class IsolatedContext:
+    """Exécute chaque requête d'une application ASGI dans un contexte neuf.
+
+    Les requêtes successives d'une même connexion keep-alive partagent sinon
+    le contexte de la première : asgiref y retrouve l'exécuteur, déjà arrêté,
+    d'une requête précédente et la requête WSGI échoue.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        await contextvars.Context().run(asyncio.ensure_future, self.app(scope, receive, send))
+
+
+def create_asgi_app():
+    """Crée l'application ASGI : /api/ask en asynchrone, le reste servi par Flask."""
+    flask_app = IsolatedContext(WsgiToAsgi(create_app()))
+    return Starlette(routes=[
+        Route('/api/ask', ask, methods=['POST']),
+        Mount('/', app=flask_app),
+    ])
+
+
+app = create_asgi_app()
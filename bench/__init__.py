@@ -0,0 +1 @@
+"""Benchmarks de charge du backend (voir bench/run.py)."""
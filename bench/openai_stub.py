@@ -0,0 +1,196 @@
+"""Serveur local imitant l'API OpenAI (chat et embeddings) pour les benchmarks.
+
+Les réponses sont déterministes et sans coût ; la latence est réglable :
+délai avant le premier token et débit de tokens pour le chat en streaming,
+délai fixe par appel d'embeddings. Les clients OpenAI du backend y sont
+redirigés par OPENAI_BASE_URL.
+
+    python -m bench.openai_stub --port 8100 --ttft-ms 300 --token-rate 50
+"""
+import argparse
+import base64
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+WORDS = ("Lexica répond selon ses connaissances avec un texte stylisé en markdown "
+         "pour aider l'utilisateur sur sa question").split()
+
+
+class StubConfig:
+    """Latences et tailles simulées par le serveur."""
+
+    def __init__(self, ttft_ms: float = 300, token_rate: float = 50, completion_tokens: int = 200,
+                 embedding_latency_ms: float = 50, dimensions: int = 1536):
+        """
+        Args:
+            ttft_ms: Délai avant le premier token d'une réponse de chat
+            token_rate: Tokens émis par seconde ensuite (0 : sans délai)
+            completion_tokens: Nombre de tokens d'une réponse de chat
+            embedding_latency_ms: Délai de chaque appel d'embeddings
+            dimensions: Taille des vecteurs d'embeddings
+        """
+        self.ttft_ms = ttft_ms
+        self.token_rate = token_rate
+        self.completion_tokens = completion_tokens
+        self.embedding_latency_ms = embedding_latency_ms
+        self.dimensions = dimensions
+
+
+def stub_embedding(text: str, dimensions: int) -> np.ndarray:
+    """Vecteur normalisé déterministe pour un texte."""
+    seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+    vector = np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config: StubConfig = StubConfig()
+    counters = {"chat": 0, "embeddings": 0, "embedded_texts": 0}
+    counters_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/stats'):
+            with self.counters_lock:
+                self._send_json(dict(self.counters))
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if self.path.endswith('/embeddings'):
+            self._embeddings(body)
+        elif self.path.endswith('/chat/completions'):
+            self._chat(body)
+        else:
+            self._send_json({"error": {"message": f"unknown path {self.path}"}}, status=404)
+
+    def _count(self, key, value=1):
+        with self.counters_lock:
+            self.counters[key] += value
+
+    def _embeddings(self, body):
+        texts = body.get("input")
+        texts = [texts] if isinstance(texts, str) else list(texts or [])
+        time.sleep(self.config.embedding_latency_ms / 1000)
+        self._count("embeddings")
+        self._count("embedded_texts", len(texts))
+
+        data = []
+        for index, text in enumerate(texts):
+            vector = stub_embedding(str(text), body.get("dimensions") or self.config.dimensions)
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.astype('<f4').tobytes()).decode('ascii')
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": index, "embedding": embedding})
+        tokens = sum(len(str(text).split()) for text in texts)
+        self._send_json({
+            "object": "list",
+            "data": data,
+            "model": body.get("model", ""),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+
+    def _chat(self, body):
+        self._count("chat")
+        tokens = [WORDS[i % len(WORDS)] + " " for i in range(self.config.completion_tokens)]
+        model = body.get("model", "")
+        created = int(time.time())
+        completion_id = f"chatcmpl-stub-{time.monotonic_ns()}"
+        time.sleep(self.config.ttft_ms / 1000)
+
+        if not body.get("stream"):
+            self._send_json({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)},
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def event(delta, finish_reason=None):
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            self._write_chunk(f"data: {json.dumps(payload)}\n\n".encode('utf-8'))
+
+        delay = 1 / self.config.token_rate if self.config.token_rate > 0 else 0
+        event({"role": "assistant", "content": ""})
+        for index, token in enumerate(tokens):
+            if index and delay:
+                time.sleep(delay)
+            event({"content": token})
+        event({}, "stop")
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def _send_json(self, payload, status=200):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_stub(config: StubConfig, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """Démarre le serveur dans un thread.
+
+    Returns:
+        Le serveur ; son URL de base est http://host:server.server_port/v1
+    """
+    handler = type("ConfiguredStubHandler", (StubHandler,), {
+        "config": config,
+        "counters": {"chat": 0, "embeddings": 0, "embedded_texts": 0},
+        "counters_lock": threading.Lock(),
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="openai-stub", daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serveur local imitant l'API OpenAI.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--ttft-ms', type=float, default=300)
+    parser.add_argument('--token-rate', type=float, default=50)
+    parser.add_argument('--completion-tokens', type=int, default=200)
+    parser.add_argument('--embedding-latency-ms', type=float, default=50)
+    parser.add_argument('--dimensions', type=int, default=1536)
+    args = parser.parse_args()
+
+    server = start_stub(StubConfig(args.ttft_ms, args.token_rate, args.completion_tokens,
+                                   args.embedding_latency_ms, args.dimensions), args.host, args.port)
+    print(f"Stub OpenAI sur http://{args.host}:{server.server_port}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
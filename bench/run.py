@@ -0,0 +1,270 @@
+"""Benchmark de charge et de latence du backend Lexica.
+
+Lance un stub local de l'API OpenAI (latence et débit de tokens réglables),
+un serveur Chroma local (`chroma run`) ou l'index vectoriel embarqué, puis le
+backend dans un dossier de travail temporaire. Après l'indexation d'un corpus
+synthétique, les scénarios sont joués :
+
+- ask : questions sur /api/ask en streaming (latence, premier token)
+- ingest : uploads de PDF sur /api/file jusqu'à la fin de leur indexation
+- history : liste et lecture des discussions
+
+Pour chaque scénario : débit, p50/p95/p99 de latence et du premier token, et
+mémoire résidente des workers. Les résultats sont enregistrés en JSON dans
+bench/results/, nommés d'après le commit, pour comparer deux versions :
+
+    python -m bench.run --server gunicorn --workers 2 --concurrency 16
+    python -m bench.run --compare bench/results/<avant>.json
+"""
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from bench.openai_stub import StubConfig, start_stub
+from bench.scenarios import (
+    Client, MemorySampler, ask_scenario, history_scenario, ingest_scenario, run_load, upload_pdf,
+)
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO, 'bench', 'results')
+SCENARIOS = ('ask', 'ingest', 'history')
+
+# Métriques comparées entre deux résultats : (chemin, plus petit = meilleur)
+COMPARED_METRICS = (
+    (("throughput_rps",), False),
+    (("latency_ms", "p50"), True),
+    (("latency_ms", "p95"), True),
+    (("latency_ms", "p99"), True),
+    (("ttft_ms", "p50"), True),
+    (("ttft_ms", "p95"), True),
+    (("ttft_ms", "p99"), True),
+    (("memory", "peak_rss_mb"), True),
+)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_http(url_host: str, port: int, path: str, timeout: float = 120) -> None:
+    """Attend qu'un serveur réponde 200 sur `path`.
+
+    Raises:
+        RuntimeError: Si le serveur ne répond pas à temps
+    """
+    client = Client(f"http://{url_host}:{port}", timeout=5)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if client.request("GET", path)[0] == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"http://{url_host}:{port}{path} ne répond pas après {timeout} s")
+
+
+def git_revision() -> Dict:
+    def git(*args):
+        try:
+            return subprocess.run(["git", *args], cwd=REPO, capture_output=True, text=True,
+                                  check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+    return {"commit": git("rev-parse", "--short", "HEAD"), "dirty": bool(git("status", "--porcelain", "-uno"))}
+
+
+def server_command(kind: str, port: int, workers: int, threads: int) -> List[str]:
+    """Commande de lancement du backend."""
+    if kind == 'flask':
+        return [sys.executable, os.path.join(REPO, 'app.py')]
+    if kind == 'gunicorn':
+        return [sys.executable, "-m", "gunicorn", "-w", str(workers), "--threads", str(threads),
+                "-b", f"127.0.0.1:{port}", "--timeout", "300", "app:create_app()"]
+    if kind == 'asgi':
+        return [sys.executable, "-m", "uvicorn", "asgi:app", "--host", "127.0.0.1", "--port", str(port),
+                "--workers", str(workers), "--log-level", "warning"]
+    raise ValueError(f"Serveur inconnu : {kind}")
+
+
+def start_process(command: List[str], env: Dict, cwd: str, log_path: str) -> subprocess.Popen:
+    log = open(log_path, "wb")
+    return subprocess.Popen(command, env=env, cwd=cwd, stdout=log, stderr=subprocess.STDOUT,
+                            start_new_session=True)
+
+
+def stop_process(process: Optional[subprocess.Popen]) -> None:
+    if process is None or process.poll() is not None:
+        return
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=15)
+    except (OSError, subprocess.TimeoutExpired):
+        os.killpg(process.pid, signal.SIGKILL)
+
+
+def run_benchmark(args) -> Dict:
+    """Prépare l'environnement, joue les scénarios et retourne les résultats."""
+    workdir = tempfile.mkdtemp(prefix="lexica-bench-")
+    stub = start_stub(StubConfig(args.ttft_ms, args.token_rate, args.completion_tokens,
+                                 args.embedding_latency_ms, args.dimensions))
+    chroma = backend = None
+    try:
+        env = dict(os.environ)
+        env.update({
+            "OPENAI_BASE_URL": f"http://127.0.0.1:{stub.server_port}/v1",
+            "OPENAI_API_KEY": "bench",
+            "CHROMA_OPENAI_API_KEY": "bench",
+            "VECTOR_BACKEND": args.vector_backend,
+            "PYTHONPATH": os.pathsep.join(filter(None, [REPO, env.get("PYTHONPATH")])),
+            "ANONYMIZED_TELEMETRY": "False",
+        })
+
+        if args.vector_backend == 'chroma':
+            chroma_port = free_port()
+            chroma = start_process(["chroma", "run", "--path", os.path.join(workdir, "chroma"),
+                                    "--port", str(chroma_port)], env, workdir, os.path.join(workdir, "chroma.log"))
+            wait_http("localhost", chroma_port, "/api/v2/heartbeat")
+            env.update({"CHROMA_DB_HOST": "localhost", "CHROMA_DB_PORT": str(chroma_port)})
+
+        port = free_port()
+        env["PORT"] = str(port)
+        backend = start_process(server_command(args.server, port, args.workers, args.threads),
+                                env, workdir, os.path.join(workdir, "backend.log"))
+        wait_http("127.0.0.1", port, "/api/health")
+        client = Client(f"http://127.0.0.1:{port}")
+        memory = MemorySampler(backend.pid)
+
+        print(f"Indexation du corpus : {args.corpus_files} PDF")
+        corpus = run_load(lambda index: upload_pdf(client, index, args.paragraphs), args.corpus_files,
+                          min(args.concurrency, 4))
+        if corpus["errors"]:
+            raise RuntimeError(f"échec de l'indexation du corpus : {corpus.get('error_samples')}")
+
+        results = {"corpus": corpus, "idle_memory": {"rss_mb": round((memory.current() or 0) / 2 ** 20, 1)}}
+        for name in args.scenarios:
+            if name == 'ask':
+                operation = ask_scenario(client, distinct=not args.repeat_questions, sessions=args.sessions)
+                requests = args.requests
+            elif name == 'ingest':
+                operation = ingest_scenario(client, args.paragraphs)
+                requests = args.ingest_requests
+            else:
+                operation = history_scenario(client)
+                requests = args.requests
+            print(f"Scénario {name} : {requests} requêtes, concurrence {args.concurrency}")
+            sampler = MemorySampler(backend.pid).start()
+            results[name] = run_load(operation, requests, args.concurrency)
+            results[name]["memory"] = sampler.stop()
+
+        results["openai_stub"] = dict(stub.RequestHandlerClass.counters)
+        return results
+    except Exception:
+        log_path = os.path.join(workdir, "backend.log")
+        if os.path.exists(log_path):
+            with open(log_path, "rb") as f:
+                sys.stderr.write(f.read()[-4000:].decode('utf-8', 'replace'))
+        raise
+    finally:
+        stop_process(backend)
+        stop_process(chroma)
+        stub.shutdown()
+        if not args.keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            print(f"Dossier de travail conservé : {workdir}")
+
+
+def metric(results: Dict, path) -> Optional[float]:
+    value = results
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value if isinstance(value, (int, float)) else None
+
+
+def compare(current: Dict, baseline: Dict) -> str:
+    """Tableau des écarts entre deux résultats, scénario par scénario."""
+    lines = [f"{'scénario':<10} {'métrique':<22} {'avant':>10} {'après':>10} {'écart':>9}"]
+    for scenario in SCENARIOS:
+        before, after = baseline["results"].get(scenario), current["results"].get(scenario)
+        if not before or not after:
+            continue
+        for path, lower_is_better in COMPARED_METRICS:
+            old, new = metric(before, path), metric(after, path)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old * 100 if old else 0.0
+            better = (change < 0) == lower_is_better and change != 0
+            lines.append(f"{scenario:<10} {'.'.join(path):<22} {old:>10.1f} {new:>10.1f} "
+                         f"{change:>+8.1f}%{' ✓' if better else ''}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de charge et de latence du backend Lexica.")
+    parser.add_argument('--scenarios', default=",".join(SCENARIOS),
+                        help="Scénarios à jouer, séparés par des virgules (ask, ingest, history)")
+    parser.add_argument('--server', choices=('flask', 'gunicorn', 'asgi'), default='gunicorn')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8, help="Threads par worker gunicorn")
+    parser.add_argument('--vector-backend', choices=('chroma', 'local'), default='chroma',
+                        help="chroma : serveur `chroma run` local ; local : index vectoriel embarqué")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help="Requêtes des scénarios ask et history")
+    parser.add_argument('--ingest-requests', type=int, default=10)
+    parser.add_argument('--corpus-files', type=int, default=20)
+    parser.add_argument('--paragraphs', type=int, default=40, help="Paragraphes par PDF généré")
+    parser.add_argument('--repeat-questions', action='store_true',
+                        help="Reposer les mêmes questions (mesure les caches)")
+    parser.add_argument('--sessions', type=int, default=0,
+                        help="Nombre de discussions suivies par le scénario ask (0 : questions isolées)")
+    parser.add_argument('--ttft-ms', type=float, default=300, help="Délai du premier token du stub OpenAI")
+    parser.add_argument('--token-rate', type=float, default=50, help="Tokens par seconde du stub OpenAI")
+    parser.add_argument('--completion-tokens', type=int, default=200)
+    parser.add_argument('--embedding-latency-ms', type=float, default=50)
+    parser.add_argument('--dimensions', type=int, default=1536)
+    parser.add_argument('--output', default=RESULTS_DIR, help="Dossier des résultats")
+    parser.add_argument('--compare', help="Résultat JSON de référence à comparer")
+    parser.add_argument('--keep-workdir', action='store_true')
+    args = parser.parse_args()
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"scénarios inconnus : {', '.join(sorted(unknown))}")
+
+    revision = git_revision()
+    report = {
+        **revision,
+        "timestamp": datetime.now().isoformat(timespec='seconds'),
+        "config": {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        "results": run_benchmark(args),
+    }
+
+    os.makedirs(args.output, exist_ok=True)
+    name = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{revision['commit'] or 'nogit'}"
+    path = os.path.join(args.output, f"{name}{'-dirty' if revision['dirty'] else ''}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    print(json.dumps(report["results"], indent=2, ensure_ascii=False))
+    print(f"Résultats enregistrés dans {path}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print(compare(report, json.load(f)))
+
+
+if __name__ == '__main__':
+    main()
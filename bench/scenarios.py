@@ -0,0 +1,330 @@
+"""Scénarios de charge contre un backend Lexica lancé, et mesures associées."""
+import http.client
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urlsplit
+
+TOPICS = ("contrat de travail", "congés payés", "licenciement", "période d'essai", "télétravail",
+          "rupture conventionnelle", "heures supplémentaires", "arrêt maladie", "formation", "salaire")
+
+
+class Sample:
+    """Mesure d'une requête : durée totale, délai du premier octet de réponse, succès."""
+
+    def __init__(self, latency: float, ttft: Optional[float] = None, ok: bool = True, error: str = None):
+        self.latency = latency
+        self.ttft = ttft
+        self.ok = ok
+        self.error = error
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Percentile par rang le plus proche (q entre 0 et 100)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def summarize(samples: List[Sample], wall_time: float) -> Dict:
+    """Débit, erreurs et percentiles de latence (et de premier token) en millisecondes."""
+    ok = [sample for sample in samples if sample.ok]
+    latencies = [sample.latency * 1000 for sample in ok]
+    ttfts = [sample.ttft * 1000 for sample in ok if sample.ttft is not None]
+    summary = {
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "wall_time_s": round(wall_time, 3),
+        "throughput_rps": round(len(ok) / wall_time, 2) if wall_time else None,
+    }
+    for name, values in (("latency_ms", latencies), ("ttft_ms", ttfts)):
+        if values:
+            summary[name] = {f"p{q}": round(percentile(values, q), 1) for q in (50, 95, 99)}
+            summary[name]["mean"] = round(sum(values) / len(values), 1)
+    errors = sorted({sample.error for sample in samples if sample.error})
+    if errors:
+        summary["error_samples"] = errors[:5]
+    return summary
+
+
+class Client:
+    """Client HTTP minimal, une connexion persistante par thread."""
+
+    def __init__(self, base_url: str, timeout: float = 300):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        return connection
+
+    def request(self, method: str, path: str, body: bytes = None, headers: Dict = None, stream: bool = False):
+        """Envoie une requête.
+
+        Returns:
+            tuple: (statut, corps, délai du premier octet du corps en secondes)
+        """
+        connection = self._connection()
+        start = time.perf_counter()
+        try:
+            connection.request(method, path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            first_byte = None
+            parts = []
+            while True:
+                data = response.read1(65536) if stream else response.read()
+                if not data:
+                    break
+                if first_byte is None:
+                    first_byte = time.perf_counter() - start
+                parts.append(data)
+                if not stream:
+                    break
+            if response.will_close:
+                self._reset()
+            return response.status, b"".join(parts), first_byte
+        except Exception:
+            self._reset()
+            raise
+
+    def json(self, method: str, path: str, payload=None):
+        body = json.dumps(payload).encode('utf-8') if payload is not None else None
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        status, data, _ = self.request(method, path, body, headers)
+        return status, json.loads(data) if data else None
+
+    def _reset(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+        self._local.connection = None
+
+
+def run_load(operation: Callable[[int], Sample], requests: int, concurrency: int) -> Dict:
+    """Exécute `requests` opérations avec `concurrency` threads et résume les mesures."""
+    def timed(index):
+        start = time.perf_counter()
+        try:
+            return operation(index)
+        except Exception as e:
+            return Sample(time.perf_counter() - start, ok=False, error=f"{type(e).__name__}: {e}")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        samples = list(executor.map(timed, range(requests)))
+    return summarize(samples, time.perf_counter() - start)
+
+
+def make_question(index: int, distinct: bool = True) -> str:
+    """Question de test ; distincte à chaque appel pour ne pas profiter des caches."""
+    topic = TOPICS[index % len(TOPICS)]
+    suffix = f" (cas n°{index})" if distinct else ""
+    return f"Quelles sont les règles applicables en matière de {topic} ?{suffix}"
+
+
+def make_text(index: int, paragraphs: int = 20) -> str:
+    """Texte de corpus synthétique, différent pour chaque index."""
+    lines = []
+    for paragraph in range(paragraphs):
+        topic = TOPICS[(index + paragraph) % len(TOPICS)]
+        lines.append(f"Article {index}.{paragraph} - En matière de {topic}, l'employeur et le salarié "
+                     f"respectent les dispositions prévues par la convention n°{index * 100 + paragraph}. "
+                     f"Les délais et montants applicables au {topic} sont précisés par accord collectif.")
+    return "\n".join(lines)
+
+
+def make_pdf(text: str, lines_per_page: int = 40) -> bytes:
+    """PDF minimal (Helvetica, une ligne de texte par ligne) dont le texte est extractible."""
+    def escape(line):
+        line = line.encode('latin-1', 'replace').decode('latin-1')
+        return line.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+    lines = text.splitlines() or [""]
+    pages = [lines[i:i + lines_per_page] for i in range(0, len(lines), lines_per_page)]
+    font_id = 3
+    objects = {1: b"<< /Type /Catalog /Pages 2 0 R >>",
+               font_id: b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>"}
+    kids = []
+    for number, page_lines in enumerate(pages):
+        page_id, content_id = 4 + 2 * number, 5 + 2 * number
+        kids.append(f"{page_id} 0 R")
+        stream = "BT /F1 9 Tf 11 TL 40 800 Td " + " ".join(f"({escape(line)}) '" for line in page_lines) + " ET"
+        stream_bytes = stream.encode('latin-1')
+        objects[page_id] = (f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                            f"/Resources << /Font << /F1 {font_id} 0 R >> >> /Contents {content_id} 0 R >>").encode()
+        objects[content_id] = (f"<< /Length {len(stream_bytes)} >>\nstream\n".encode() + stream_bytes
+                               + b"\nendstream")
+    objects[2] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>".encode()
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = {}
+    for object_id in sorted(objects):
+        offsets[object_id] = len(output)
+        output += f"{object_id} 0 obj\n".encode() + objects[object_id] + b"\nendobj\n"
+    xref = len(output)
+    output += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for object_id in sorted(objects):
+        output += f"{offsets[object_id]:010d} 00000 n \n".encode()
+    output += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return bytes(output)
+
+
+def multipart(field: str, filename: str, content: bytes, content_type: str):
+    """Corps multipart/form-data d'un seul fichier.
+
+    Returns:
+        tuple: (corps, en-têtes)
+    """
+    boundary = uuid.uuid4().hex
+    body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"{field}\"; filename=\"{filename}\"\r\n"
+            f"Content-Type: {content_type}\r\n\r\n").encode('utf-8') + content + f"\r\n--{boundary}--\r\n".encode()
+    return body, {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+
+
+def wait_job(client: Client, job_id: str, timeout: float = 600, interval: float = 0.05) -> Dict:
+    """Attend la fin d'une tâche d'ingestion.
+
+    Raises:
+        RuntimeError: Si la tâche échoue ou n'aboutit pas à temps
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status, job = client.json("GET", f"/api/jobs/{job_id}")
+        if status == 200 and job["status"] == "done":
+            return job
+        if status != 200 or job["status"] == "failed":
+            raise RuntimeError(f"tâche {job_id} en échec : {job and job.get('error')}")
+        time.sleep(interval)
+    raise RuntimeError(f"tâche {job_id} non terminée après {timeout} s")
+
+
+def upload_pdf(client: Client, index: int, paragraphs: int = 20) -> Sample:
+    """Envoie un PDF sur /api/file et attend la fin de son ingestion."""
+    body, headers = multipart("file", f"bench_{index}_{uuid.uuid4().hex[:8]}.pdf",
+                              make_pdf(make_text(index, paragraphs)), "application/pdf")
+    start = time.perf_counter()
+    status, data, _ = client.request("POST", "/api/file", body, headers)
+    if status != 202:
+        return Sample(time.perf_counter() - start, ok=False, error=f"HTTP {status}")
+    wait_job(client, json.loads(data)["job_id"])
+    return Sample(time.perf_counter() - start)
+
+
+def ask_scenario(client: Client, distinct: bool = True, sessions: int = 0) -> Callable[[int], Sample]:
+    """Questions sur /api/ask en streaming ; le délai du premier octet mesure le premier token.
+
+    Args:
+        distinct: Questions toutes différentes (sans profit des caches)
+        sessions: Nombre de discussions suivies à répartir entre les questions (0 : aucune)
+    """
+    def operation(index):
+        payload = {"question": make_question(index, distinct)}
+        if sessions:
+            payload["filename"] = f"discussion_bench_{index % sessions}.json"
+        start = time.perf_counter()
+        status, data, first_byte = client.request(
+            "POST", "/api/ask", json.dumps(payload).encode('utf-8'), {"Content-Type": "application/json"},
+            stream=True
+        )
+        ok = status == 200 and bool(data)
+        return Sample(time.perf_counter() - start, first_byte, ok, None if ok else f"HTTP {status}")
+    return operation
+
+
+def ingest_scenario(client: Client, paragraphs: int = 20) -> Callable[[int], Sample]:
+    """Uploads de PDF sur /api/file, mesurés jusqu'à la fin de l'indexation."""
+    return lambda index: upload_pdf(client, 100000 + index, paragraphs)
+
+
+def history_scenario(client: Client) -> Callable[[int], Sample]:
+    """Alterne la liste paginée des discussions et la lecture d'une discussion."""
+    def operation(index):
+        start = time.perf_counter()
+        status, page = client.json("GET", "/api/history/discussions?limit=20")
+        if status == 200 and page["discussions"] and index % 2:
+            discussion = page["discussions"][index % len(page["discussions"])]
+            status, _ = client.json("GET", f"/api/history/discussions/{discussion['id']}")
+        ok = status == 200
+        return Sample(time.perf_counter() - start, ok=ok, error=None if ok else f"HTTP {status}")
+    return operation
+
+
+class MemorySampler:
+    """Relève périodiquement la mémoire résidente (RSS) d'un processus et de ses enfants (Linux)."""
+
+    def __init__(self, pid: int, interval: float = 0.2):
+        self.pid = pid
+        self.interval = interval
+        self.samples: List[int] = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+
+    def start(self) -> 'MemorySampler':
+        self._thread.start()
+        return self
+
+    def stop(self) -> Optional[Dict]:
+        """Arrête les relevés.
+
+        Returns:
+            dict: RSS maximale et finale en Mo, ou None hors Linux
+        """
+        self._stop.set()
+        self._thread.join()
+        if not self.samples:
+            return None
+        return {"peak_rss_mb": round(max(self.samples) / 2 ** 20, 1),
+                "final_rss_mb": round(self.samples[-1] / 2 ** 20, 1)}
+
+    def current(self) -> Optional[int]:
+        """RSS totale en octets du processus et de ses descendants."""
+        if not os.path.isdir(f"/proc/{self.pid}"):
+            return None
+        total = 0
+        for pid in self._tree():
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            total += int(line.split()[1]) * 1024
+                            break
+            except OSError:
+                continue
+        return total
+
+    def _tree(self) -> List[int]:
+        children = {}
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    parent = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(parent, []).append(int(entry))
+        pids, pending = [], [self.pid]
+        while pending:
+            pid = pending.pop()
+            pids.append(pid)
+            pending.extend(children.get(pid, []))
+        return pids
+
+    def _run(self):
+        while not self._stop.is_set():
+            value = self.current()
+            if value:
+                self.samples.append(value)
+            self._stop.wait(self.interval)
@@ -0,0 +1,407 @@
+import fcntl
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_question(question: str) -> str:
+    """Normalise une question pour servir de clé de cache.
+
+    Args:
+        question: La question brute envoyée par l'utilisateur
+
+    Returns:
+        La question en minuscules, normalisée NFKC et aux espaces compactés
+    """
+    text = unicodedata.normalize("NFKC", question or "")
+    return " ".join(text.lower().split())
+
+
+def make_cache_key(question: str, model_name: str) -> str:
+    """Construit la clé de cache d'une question pour un modèle d'embedding donné."""
+    payload = f"{model_name}\x00{normalize_question(question)}"
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class QueryEmbeddingCache:
+    """Cache LRU/TTL des embeddings de questions, avec un niveau disque optionnel.
+
+    Le niveau mémoire est borné en nombre d'entrées ; le niveau disque (SQLite)
+    survit aux redémarrages des workers et est partagé entre les processus.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 86400, disk_path: Optional[str] = None):
+        """
+        Args:
+            max_size: Nombre maximum d'embeddings gardés en mémoire
+            ttl: Durée de vie d'une entrée en secondes (0 pour aucune expiration)
+            disk_path: Chemin du fichier SQLite du niveau disque (None pour le désactiver)
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.disk_path = disk_path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+
+        if disk_path:
+            try:
+                directory = os.path.dirname(disk_path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._get_connection()
+            except Exception as e:
+                logger.error("Cache d'embeddings disque indisponible (%s) : %s", disk_path, str(e))
+                self.disk_path = None
+
+    def _get_connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.disk_path, timeout=5)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings ("
+                "key TEXT PRIMARY KEY, embedding BLOB NOT NULL, created_at REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_query_embeddings_created_at "
+                "ON query_embeddings (created_at)"
+            )
+            connection.commit()
+            self._local.connection = connection
+        return connection
+
+    def _is_expired(self, created_at: float) -> bool:
+        return bool(self.ttl) and time.time() - created_at > self.ttl
+
+    def get(self, question: str, model_name: str) -> Optional[List[float]]:
+        """Retourne l'embedding en cache de la question, ou None."""
+        key = make_cache_key(question, model_name)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                embedding, created_at = entry
+                if not self._is_expired(created_at):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return embedding
+                del self._entries[key]
+
+        embedding = self._disk_get(key)
+        with self._lock:
+            if embedding is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self._memory_set(key, embedding[0], embedding[1])
+        return embedding[0]
+
+    def set(self, question: str, model_name: str, embedding) -> None:
+        """Enregistre l'embedding d'une question dans les deux niveaux du cache."""
+        key = make_cache_key(question, model_name)
+        embedding = [float(value) for value in embedding]
+        created_at = time.time()
+        self._memory_set(key, embedding, created_at)
+        self._disk_set(key, embedding, created_at)
+
+    def clear(self) -> None:
+        """Vide le niveau mémoire du cache."""
+        with self._lock:
+            self._entries.clear()
+
+    def _memory_set(self, key: str, embedding: List[float], created_at: float) -> None:
+        with self._lock:
+            self._entries[key] = (embedding, created_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _disk_get(self, key: str):
+        if not self.disk_path:
+            return None
+        try:
+            row = self._get_connection().execute(
+                "SELECT embedding, created_at FROM query_embeddings WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or self._is_expired(row[1]):
+                return None
+            return array("f", row[0]).tolist(), row[1]
+        except Exception as e:
+            logger.error("Erreur de lecture du cache d'embeddings : %s", str(e))
+            return None
+
+    def _disk_set(self, key: str, embedding: List[float], created_at: float) -> None:
+        if not self.disk_path:
+            return
+        try:
+            connection = self._get_connection()
+            connection.execute(
+                "INSERT OR REPLACE INTO query_embeddings (key, embedding, created_at) VALUES (?, ?, ?)",
+                (key, array("f", embedding).tobytes(), created_at),
+            )
+            if self.ttl:
+                connection.execute(
+                    "DELETE FROM query_embeddings WHERE created_at < ?", (created_at - self.ttl,)
+                )
+            connection.commit()
+        except Exception as e:
+            logger.error("Erreur d'écriture du cache d'embeddings : %s", str(e))
+
+
+# Cache partagé par le processus, configuré par variables d'environnement
+query_embedding_cache = QueryEmbeddingCache(
+    max_size=int(os.getenv('QUERY_EMBEDDING_CACHE_SIZE', 1024)),
+    ttl=float(os.getenv('QUERY_EMBEDDING_CACHE_TTL', 86400)),
+    disk_path=os.getenv('QUERY_EMBEDDING_CACHE_PATH') or None,
+)
+
+
+def _corpus_version_path() -> str:
+    return os.getenv('CORPUS_VERSION_PATH', 'save/corpus_version')
+
+
+def get_corpus_version() -> int:
+    """Retourne la version courante du corpus (0 si elle n'a jamais été incrémentée)."""
+    try:
+        with open(_corpus_version_path(), 'r', encoding='utf-8') as f:
+            return int(f.read().strip() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def bump_corpus_version() -> int:
+    """Incrémente la version du corpus après une modification de la base vectorielle.
+
+    La version est stockée dans un fichier verrouillé afin d'être partagée par
+    tous les workers : les caches qui en dépendent s'invalident d'eux-mêmes.
+
+    Returns:
+        La nouvelle version du corpus
+    """
+    path = _corpus_version_path()
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            version = get_corpus_version() + 1
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(str(version))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    logger.info("Version du corpus incrémentée : %d", version)
+    return version
+
+
+class AnswerCache:
+    """Cache sémantique des réponses, indexé par l'embedding de la question.
+
+    Une réponse est resservie quand une nouvelle question est à une distance
+    cosinus inférieure à `max_distance` d'une question en cache, que les
+    morceaux récupérés sont identiques et que le corpus n'a pas changé.
+    """
+
+    def __init__(self, max_size: int = 256, max_distance: float = 0.05, ttl: float = 3600):
+        """
+        Args:
+            max_size: Nombre maximum de réponses gardées
+            max_distance: Distance cosinus maximale pour considérer deux questions équivalentes
+            ttl: Durée de vie d'une réponse en secondes (0 pour aucune expiration)
+        """
+        self.max_size = max_size
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self._entries = []
+        self._matrix = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _sync_version(self) -> int:
+        version = get_corpus_version()
+        if version != self._version:
+            if self._entries:
+                logger.info("Corpus modifié, cache des réponses invalidé.")
+            self._entries = []
+            self._matrix = None
+            self._version = version
+        return version
+
+    def _expire(self) -> None:
+        if not self.ttl:
+            return
+        now = time.time()
+        entries = [entry for entry in self._entries if now - entry["created_at"] <= self.ttl]
+        if len(entries) != len(self._entries):
+            self._entries = entries
+            self._matrix = None
+
+    def lookup(self, embedding, source_ids: List[str]):
+        """Cherche une réponse en cache pour une question proche.
+
+        Args:
+            embedding: L'embedding de la nouvelle question
+            source_ids: Les identifiants des morceaux retenus pour le contexte
+
+        Returns:
+            Un tuple (réponse, noms de fichiers) ou None
+        """
+        sources_key = tuple(sorted(source_ids))
+        vector = self._normalize(embedding)
+
+        with self._lock:
+            self._sync_version()
+            self._expire()
+            if not self._entries:
+                return None
+            if self._matrix is None:
+                self._matrix = np.stack([entry["vector"] for entry in self._entries])
+
+            distances = 1.0 - self._matrix @ vector
+            for index in np.argsort(distances):
+                if distances[index] > self.max_distance:
+                    break
+                entry = self._entries[index]
+                if entry["sources_key"] == sources_key:
+                    logger.info("Réponse trouvée en cache (distance %.4f).", float(distances[index]))
+                    return entry["response"], entry["filenames"]
+        return None
+
+    def store(self, embedding, source_ids: List[str], response: str, filenames: List[str]) -> None:
+        """Enregistre une réponse complète pour la question et les sources données."""
+        entry = {
+            "vector": self._normalize(embedding),
+            "sources_key": tuple(sorted(source_ids)),
+            "response": response,
+            "filenames": list(filenames),
+            "created_at": time.time(),
+        }
+
+        with self._lock:
+            self._sync_version()
+            self._entries.append(entry)
+            if len(self._entries) > self.max_size:
+                self._entries = self._entries[-self.max_size:]
+            self._matrix = None
+
+    def clear(self) -> None:
+        """Vide le cache des réponses."""
+        with self._lock:
+            self._entries = []
+            self._matrix = None
+
+
+answer_cache = AnswerCache(
+    max_size=int(os.getenv('ANSWER_CACHE_SIZE', 256)),
+    max_distance=float(os.getenv('ANSWER_CACHE_MAX_DISTANCE', 0.05)),
+    ttl=float(os.getenv('ANSWER_CACHE_TTL', 3600)),
+)
+
+
+def make_retrieval_key(question: str, model_name: str, n_results: int, scope: str) -> str:
+    """Clé du cache de recherche : question normalisée, modèle d'embedding, nombre de résultats et portée.
+
+    Args:
+        scope: Ce qui change le résultat pour une même question (collection, mode de recherche...)
+    """
+    return f"{make_cache_key(question, model_name)}:{n_results}:{scope}"
+
+
+class RetrievalCache:
+    """Cache LRU des résultats de recherche dans la base vectorielle.
+
+    Une question déjà posée ne refait pas l'aller-retour vers Chroma (ni la
+    recherche BM25 en mode hybride). Les entrées appartiennent à une version
+    du corpus : dès qu'une ingestion ou une suppression l'incrémente, tout le
+    cache est vidé, et un résultat calculé avec une version dépassée n'est
+    jamais enregistré. Les résultats rendus sont partagés : ne pas les modifier.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 86400):
+        """
+        Args:
+            max_size: Nombre maximum de résultats gardés
+            ttl: Durée de vie d'une entrée en secondes (0 pour aucune expiration)
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _sync_version(self, version: int) -> None:
+        if self._version is None or version > self._version:
+            if self._entries:
+                logger.info("Corpus modifié, cache des recherches invalidé.")
+            self._entries.clear()
+            self._version = version
+
+    def get(self, key: str, version: int) -> Optional[Dict]:
+        """Retourne les résultats en cache pour une clé, ou None.
+
+        Args:
+            key: Clé construite par `make_retrieval_key`
+            version: Version courante du corpus (`get_corpus_version`)
+        """
+        with self._lock:
+            self._sync_version(version)
+            entry = self._entries.get(key) if version == self._version else None
+            if entry is not None:
+                results, created_at = entry
+                if not self.ttl or time.time() - created_at <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return results
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key: str, results: Dict, version: int) -> None:
+        """Enregistre des résultats calculés avec la version `version` du corpus."""
+        with self._lock:
+            self._sync_version(version)
+            if version != self._version:
+                return
+            self._entries[key] = (results, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Vide le cache des recherches."""
+        with self._lock:
+            self._entries.clear()
+
+
+retrieval_cache = RetrievalCache(
+    max_size=int(os.getenv('RETRIEVAL_CACHE_SIZE', 1024)),
+    ttl=float(os.getenv('RETRIEVAL_CACHE_TTL', 86400)),
+)
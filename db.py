@@ -0,0 +1,64 @@
+import base64
+import json
+import os
+import sqlite3
+import threading
+from typing import Tuple
+
+_local = threading.local()
+
+
+def get_connection(path: str) -> sqlite3.Connection:
+    """Retourne une connexion SQLite propre au thread courant pour la base donnée.
+
+    Les connexions sont ouvertes en mode WAL : les lectures ne bloquent pas les
+    écritures et un crash en cours d'écriture ne corrompt pas la base. La
+    politique de fsync est réglée par SQLITE_SYNCHRONOUS (OFF, NORMAL ou FULL).
+
+    Args:
+        path: Chemin du fichier SQLite
+
+    Returns:
+        sqlite3.Connection: La connexion, avec des lignes accessibles par nom de colonne
+    """
+    connections = getattr(_local, 'connections', None)
+    if connections is None or getattr(_local, 'pid', None) != os.getpid():
+        # Nouveau thread ou processus forké : on ne réutilise pas les connexions héritées
+        connections = _local.connections = {}
+        _local.pid = os.getpid()
+
+    connection = connections.get(path)
+    if connection is None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = sqlite3.connect(path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(f"PRAGMA synchronous={_synchronous_mode()}")
+        connections[path] = connection
+    return connection
+
+
+def encode_cursor(timestamp: str, row_id: str) -> str:
+    """Encode la position (timestamp, id) d'une ligne en curseur de pagination opaque."""
+    payload = json.dumps([timestamp, row_id], ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii')
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    """Décode un curseur produit par `encode_cursor`.
+
+    Raises:
+        ValueError: Si le curseur est invalide
+    """
+    try:
+        timestamp, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return str(timestamp), str(row_id)
+    except Exception:
+        raise ValueError("Curseur de pagination invalide")
+
+
+def _synchronous_mode() -> str:
+    mode = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL').upper()
+    return mode if mode in ('OFF', 'NORMAL', 'FULL', 'EXTRA') else 'NORMAL'
@@ -0,0 +1,696 @@
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from db import get_connection, encode_cursor, decode_cursor
+from metrics import DISCUSSION_WRITE_FAILURES, WRITE_QUEUE_DEPTH, span
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS discussions (
+    id TEXT PRIMARY KEY,
+    header TEXT NOT NULL,
+    has_messages INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS discussion_messages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    discussion_id TEXT NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_discussion_messages_discussion
+    ON discussion_messages (discussion_id, seq);
+CREATE TABLE IF NOT EXISTS discussion_rolling_summaries (
+    discussion_id TEXT PRIMARY KEY,
+    summary TEXT NOT NULL,
+    upto_seq INTEGER NOT NULL
+);
+"""
+
+# Colonnes de résumé de l'index des discussions (schéma version 1)
+SUMMARY_COLUMNS = {
+    "timestamp": "TEXT NOT NULL DEFAULT ''",
+    "title": "TEXT",
+    "message_count": "INTEGER NOT NULL DEFAULT 0",
+    "size": "INTEGER NOT NULL DEFAULT 0",
+}
+
+TITLE_LENGTH = 100
+
+
+def discussion_id_from_path(filepath: str) -> str:
+    """Extrait l'ID d'une discussion depuis le chemin envoyé par le frontend.
+
+    Args:
+        filepath: Chemin ou nom du fichier de discussion (ex. save/discussions/discussion_x.json)
+
+    Returns:
+        L'ID de la discussion (nom du fichier sans extension)
+    """
+    return os.path.splitext(os.path.basename(filepath))[0]
+
+
+def _title_from(text) -> Optional[str]:
+    if not isinstance(text, str) or not text.strip():
+        return None
+    return " ".join(text.split())[:TITLE_LENGTH]
+
+
+class DiscussionStore:
+    """Stockage des discussions dans SQLite (mode WAL).
+
+    Chaque message est une ligne ajoutée en fin de table : un ajout coûte O(1)
+    quelle que soit la longueur de la discussion, là où l'ancien stockage
+    relisait et réécrivait tout le fichier JSON. La table `discussions` sert
+    aussi d'index : titre, nombre de messages et taille y sont tenus à jour
+    pour lister l'historique sans relire les messages.
+
+    Au premier démarrage, les anciennes discussions JSON de `json_directory`
+    sont importées avant toute écriture.
+    """
+
+    def __init__(self, path: str, checkpoint_every: int = 1000, json_directory: Optional[str] = None):
+        """
+        Args:
+            path: Chemin du fichier SQLite
+            checkpoint_every: Nombre d'écritures entre deux compactages du journal WAL
+            json_directory: Dossier des anciennes discussions JSON à importer (None pour aucun)
+        """
+        self.path = path
+        self.checkpoint_every = checkpoint_every
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._migrate(json_directory)
+
+    def _connect(self):
+        return get_connection(self.path)
+
+    def _migrate(self, json_directory: Optional[str] = None) -> None:
+        connection = self._connect()
+        connection.executescript(SCHEMA)
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+
+        if version < 1:
+            columns = {row["name"] for row in connection.execute("PRAGMA table_info(discussions)")}
+            for name, definition in SUMMARY_COLUMNS.items():
+                if name not in columns:
+                    connection.execute(f"ALTER TABLE discussions ADD COLUMN {name} {definition}")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_discussions_timestamp ON discussions (timestamp DESC, id DESC)"
+            )
+            with connection:
+                self._backfill_summaries(connection)
+                connection.execute("PRAGMA user_version = 1")
+
+        if version < 2:
+            connection.execute("BEGIN IMMEDIATE")
+            with connection:
+                # Un autre processus a pu faire l'import pendant l'attente du verrou
+                if connection.execute("PRAGMA user_version").fetchone()[0] < 2:
+                    if json_directory:
+                        imported = 0
+                        for discussion_id, data in _read_json_discussions(json_directory):
+                            imported += self._import(connection, discussion_id, data)
+                        logger.info("%d discussions importées depuis %s", imported, json_directory)
+                    connection.execute("PRAGMA user_version = 2")
+
+    def _backfill_summaries(self, connection) -> None:
+        rows = connection.execute("SELECT id, header FROM discussions").fetchall()
+        for row in rows:
+            header = json.loads(row["header"])
+            messages = [
+                json.loads(message_row["message"]) for message_row in connection.execute(
+                    "SELECT message FROM discussion_messages WHERE discussion_id = ? ORDER BY seq",
+                    (row["id"],)
+                )
+            ]
+            timestamp, title, message_count, size = self._summarize(header, messages or None)
+            connection.execute(
+                "UPDATE discussions SET timestamp = ?, title = ?, message_count = ?, size = ? WHERE id = ?",
+                (timestamp, title, message_count, size, row["id"])
+            )
+
+    @staticmethod
+    def _summarize(header: Dict, messages: Optional[List[Dict]]):
+        size = len(json.dumps(header, ensure_ascii=False).encode('utf-8'))
+        if messages is not None:
+            title = next((_title_from(m.get("content")) for m in messages if m.get("type") == "user"), None)
+            message_count = len(messages)
+            size += sum(len(json.dumps(m, ensure_ascii=False).encode('utf-8')) for m in messages)
+        else:
+            title = _title_from(header.get("question"))
+            message_count = sum(1 for key in ("question", "response") if header.get(key))
+        return header.get("timestamp", ""), title, message_count, size
+
+    def _after_write(self) -> None:
+        with self._lock:
+            self._writes += 1
+            due = self.checkpoint_every and self._writes % self.checkpoint_every == 0
+        if due:
+            self.checkpoint()
+
+    def append_message(self, discussion_id: str, message: Dict) -> int:
+        """Ajoute un message à une discussion, en la créant si besoin.
+
+        Returns:
+            Le numéro de séquence du message
+        """
+        connection = self._connect()
+        with connection:
+            seq = self._append(connection, discussion_id, [message])[0]
+        self._after_write()
+        return seq
+
+    def save(self, discussion_id: str, data: Dict) -> None:
+        """Enregistre une discussion complète, en remplaçant celle de même ID."""
+        connection = self._connect()
+        with connection:
+            self._save(connection, discussion_id, data)
+        self._after_write()
+
+    def write_batch(self, operations: List[Tuple[str, str, Dict]]) -> Dict[str, List[int]]:
+        """Écrit en une seule transaction des discussions complètes et des messages.
+
+        L'ordre des écritures est respecté pour chaque discussion. Ses messages
+        sont ajoutés ensemble tant qu'aucun enregistrement complet ne
+        s'intercale : une seule mise à jour de son résumé quel que soit leur
+        nombre. Un enregistrement complet remplace les messages ajoutés avant lui.
+
+        Args:
+            operations: Écritures ("save", ID, discussion) ou ("append", ID, message), dans l'ordre
+
+        Returns:
+            dict: Numéros de séquence des messages ajoutés, par ID de discussion, dans l'ordre
+        """
+        seqs: Dict[str, List[int]] = {}
+        appends: Dict[str, List[Dict]] = {}
+        connection = self._connect()
+        with connection:
+            for kind, discussion_id, data in operations:
+                if kind == "append":
+                    appends.setdefault(discussion_id, []).append(data)
+                    continue
+                if discussion_id in appends:
+                    seqs.setdefault(discussion_id, []).extend(
+                        self._append(connection, discussion_id, appends.pop(discussion_id))
+                    )
+                self._save(connection, discussion_id, data)
+            for discussion_id, messages in appends.items():
+                seqs.setdefault(discussion_id, []).extend(self._append(connection, discussion_id, messages))
+        self._after_write()
+        return seqs
+
+    def _append(self, connection, discussion_id: str, messages: List[Dict]) -> List[int]:
+        now = datetime.now()
+        header = {
+            "timestamp": now.isoformat(),
+            "date": now.strftime("%Y-%m-%d"),
+            "time": now.strftime("%H:%M:%S"),
+        }
+        header_json = json.dumps(header, ensure_ascii=False)
+        connection.execute(
+            "INSERT OR IGNORE INTO discussions (id, header, has_messages, timestamp, size) "
+            "VALUES (?, ?, 1, ?, ?)",
+            (discussion_id, header_json, header["timestamp"], len(header_json.encode('utf-8')))
+        )
+
+        seqs = []
+        size = 0
+        title = None
+        for message in messages:
+            message_json = json.dumps(message, ensure_ascii=False)
+            seqs.append(connection.execute(
+                "INSERT INTO discussion_messages (discussion_id, message) VALUES (?, ?)",
+                (discussion_id, message_json)
+            ).lastrowid)
+            size += len(message_json.encode('utf-8'))
+            if title is None and message.get("type") == "user":
+                title = _title_from(message.get("content"))
+
+        connection.execute(
+            "UPDATE discussions SET message_count = message_count + ?, size = size + ?, "
+            "title = COALESCE(title, ?) WHERE id = ?",
+            (len(messages), size, title, discussion_id)
+        )
+        return seqs
+
+    def _save(self, connection, discussion_id: str, data: Dict) -> None:
+        header = {key: value for key, value in data.items() if key != "messages"}
+        messages = data.get("messages")
+        timestamp, title, message_count, size = self._summarize(header, messages)
+        connection.execute("DELETE FROM discussion_messages WHERE discussion_id = ?", (discussion_id,))
+        connection.execute("DELETE FROM discussion_rolling_summaries WHERE discussion_id = ?", (discussion_id,))
+        connection.execute(
+            "INSERT OR REPLACE INTO discussions "
+            "(id, header, has_messages, timestamp, title, message_count, size) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (discussion_id, json.dumps(header, ensure_ascii=False), int(messages is not None),
+             timestamp, title, message_count, size)
+        )
+        if messages:
+            connection.executemany(
+                "INSERT INTO discussion_messages (discussion_id, message) VALUES (?, ?)",
+                [(discussion_id, json.dumps(message, ensure_ascii=False)) for message in messages]
+            )
+
+    def import_discussion(self, discussion_id: str, data: Dict) -> bool:
+        """Importe une ancienne discussion JSON.
+
+        Si des messages ont déjà été ajoutés à la discussion dans le stockage,
+        ceux du JSON sont placés devant eux au lieu d'être ignorés.
+
+        Returns:
+            True si la discussion a été écrite, False si elle était déjà importée
+        """
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        with connection:
+            imported = self._import(connection, discussion_id, data)
+        self._after_write()
+        return imported
+
+    def _import(self, connection, discussion_id: str, data: Dict) -> bool:
+        row = connection.execute("SELECT has_messages FROM discussions WHERE id = ?", (discussion_id,)).fetchone()
+        if row is None:
+            self._save(connection, discussion_id, data)
+            return True
+
+        messages = data.get("messages") or []
+        stored = [
+            json.loads(message_row["message"]) for message_row in connection.execute(
+                "SELECT message FROM discussion_messages WHERE discussion_id = ? ORDER BY seq", (discussion_id,)
+            )
+        ]
+        if (messages and stored[:len(messages)] == messages) or (not messages and not row["has_messages"]):
+            return False
+        self._save(connection, discussion_id, dict(data, messages=messages + stored))
+        return True
+
+    def exists(self, discussion_id: str) -> bool:
+        """Indique si une discussion est présente dans le stockage."""
+        row = self._connect().execute(
+            "SELECT 1 FROM discussions WHERE id = ?", (discussion_id,)
+        ).fetchone()
+        return row is not None
+
+    def get(self, discussion_id: str) -> Optional[Dict]:
+        """Retourne une discussion au format JSON historique, ou None."""
+        discussions = self._load(["id = ?"], [discussion_id], limit=1)
+        return discussions[0] if discussions else None
+
+    def list(self, limit: int = 10) -> List[Dict]:
+        """Retourne les discussions les plus récentes, de la plus récente à la plus ancienne."""
+        return self._load([], [], limit=limit)
+
+    def list_summaries(self, limit: int = 20, cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        """Liste les résumés des discussions, paginés par curseur, sans lire les messages.
+
+        Args:
+            limit: Nombre maximum de résumés à retourner
+            cursor: Curseur retourné par l'appel précédent (None pour la première page)
+
+        Returns:
+            tuple: (résumés, curseur de la page suivante ou None)
+        """
+        where, params = "", []
+        if cursor:
+            where, params = "WHERE (timestamp, id) < (?, ?)", list(decode_cursor(cursor))
+
+        rows = self._connect().execute(
+            f"SELECT id, header, timestamp, title, message_count, size FROM discussions {where} "
+            f"ORDER BY timestamp DESC, id DESC LIMIT ?",
+            (*params, limit + 1)
+        ).fetchall()
+
+        summaries = []
+        for row in rows[:limit]:
+            header = json.loads(row["header"])
+            summaries.append({
+                "id": row["id"],
+                "filename": f"{row['id']}.json",
+                "timestamp": row["timestamp"],
+                "date": header.get("date"),
+                "time": header.get("time"),
+                "title": row["title"],
+                "message_count": row["message_count"],
+                "size": row["size"],
+            })
+
+        next_cursor = None
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            next_cursor = encode_cursor(last["timestamp"], last["id"])
+        return summaries, next_cursor
+
+    def _load(self, conditions: List[str], params: List, limit: int) -> List[Dict]:
+        connection = self._connect()
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = connection.execute(
+            f"SELECT id, header, has_messages FROM discussions {where} "
+            f"ORDER BY timestamp DESC, id DESC LIMIT ?",
+            (*params, limit)
+        ).fetchall()
+
+        discussions = []
+        with_messages = {}
+        for row in rows:
+            discussion = json.loads(row["header"])
+            if row["has_messages"]:
+                discussion["messages"] = []
+                with_messages[row["id"]] = discussion
+            discussion["id"] = row["id"]
+            discussions.append(discussion)
+
+        if with_messages:
+            placeholders = ",".join("?" * len(with_messages))
+            for message_row in connection.execute(
+                f"SELECT discussion_id, message FROM discussion_messages "
+                f"WHERE discussion_id IN ({placeholders}) ORDER BY seq",
+                list(with_messages)
+            ):
+                with_messages[message_row["discussion_id"]]["messages"].append(json.loads(message_row["message"]))
+
+        return discussions
+
+    def last_seq(self, discussion_id: str) -> int:
+        """Numéro de séquence du dernier message d'une discussion (0 si elle n'en a pas)."""
+        row = self._connect().execute(
+            "SELECT MAX(seq) FROM discussion_messages WHERE discussion_id = ?", (discussion_id,)
+        ).fetchone()
+        return row[0] or 0
+
+    def messages_after(self, discussion_id: str, after_seq: int = 0) -> List[Tuple[int, Dict]]:
+        """Messages d'une discussion postérieurs à un numéro de séquence.
+
+        Returns:
+            Liste de tuples (numéro de séquence, message), du plus ancien au plus récent
+        """
+        return [
+            (row["seq"], json.loads(row["message"])) for row in self._connect().execute(
+                "SELECT seq, message FROM discussion_messages WHERE discussion_id = ? AND seq > ? ORDER BY seq",
+                (discussion_id, after_seq)
+            )
+        ]
+
+    def get_rolling_summary(self, discussion_id: str) -> Tuple[Optional[str], int]:
+        """Résumé glissant d'une discussion.
+
+        Returns:
+            tuple: (résumé ou None, numéro de séquence du dernier message résumé)
+        """
+        row = self._connect().execute(
+            "SELECT summary, upto_seq FROM discussion_rolling_summaries WHERE discussion_id = ?", (discussion_id,)
+        ).fetchone()
+        return (row["summary"], row["upto_seq"]) if row else (None, 0)
+
+    def save_rolling_summary(self, discussion_id: str, summary: str, upto_seq: int) -> bool:
+        """Enregistre le résumé glissant d'une discussion, s'il couvre plus de messages que l'actuel.
+
+        Returns:
+            True si le résumé a été enregistré
+        """
+        connection = self._connect()
+        with connection:
+            saved = connection.execute(
+                "INSERT INTO discussion_rolling_summaries (discussion_id, summary, upto_seq) VALUES (?, ?, ?) "
+                "ON CONFLICT(discussion_id) DO UPDATE SET summary = excluded.summary, upto_seq = excluded.upto_seq "
+                "WHERE excluded.upto_seq > discussion_rolling_summaries.upto_seq",
+                (discussion_id, summary, upto_seq)
+            ).rowcount
+        self._after_write()
+        return saved > 0
+
+    def delete(self, discussion_id: str) -> bool:
+        """Supprime une discussion et ses messages.
+
+        Returns:
+            True si la discussion existait, False sinon
+        """
+        connection = self._connect()
+        with connection:
+            connection.execute("DELETE FROM discussion_messages WHERE discussion_id = ?", (discussion_id,))
+            connection.execute("DELETE FROM discussion_rolling_summaries WHERE discussion_id = ?", (discussion_id,))
+            deleted = connection.execute("DELETE FROM discussions WHERE id = ?", (discussion_id,)).rowcount
+        self._after_write()
+        return deleted > 0
+
+    def checkpoint(self) -> None:
+        """Reporte le journal WAL dans la base et le tronque."""
+        try:
+            self._connect().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except Exception as e:
+            logger.error("Erreur lors du checkpoint des discussions : %s", str(e))
+
+    def compact(self) -> None:
+        """Compacte la base : checkpoint du journal puis VACUUM."""
+        self.checkpoint()
+        self._connect().execute("VACUUM")
+
+
+class DiscussionWriter:
+    """File d'écriture différée (write-behind) des discussions.
+
+    Les messages et les discussions complètes sont mis en file et écrits par
+    un thread dédié : la fin d'une réponse streamée ne dépend plus du disque.
+    Chaque passage écrit tout ce qui s'est accumulé (jusqu'à `max_batch`
+    écritures) en une transaction, et les messages d'une même discussion y
+    sont regroupés. La file est vidée à l'arrêt du processus.
+
+    Un lot encore en échec après `max_retries` tentatives est mis de côté
+    dans `dead_letter_path` (une écriture JSON par ligne) et rejoué au
+    prochain démarrage.
+    """
+
+    def __init__(self, store: DiscussionStore, max_batch: int = 500, max_retries: int = 3,
+                 dead_letter_path: Optional[str] = None):
+        """
+        Args:
+            store: Stockage des discussions
+            max_batch: Nombre maximum d'écritures par transaction
+            max_retries: Nouvelles tentatives d'un lot avant de le mettre de côté
+            dead_letter_path: Fichier des écritures en échec (None pour les abandonner)
+        """
+        self.store = store
+        self.max_batch = max(1, max_batch)
+        self.max_retries = max_retries
+        self.dead_letter_path = dead_letter_path
+        self._pending = []
+        self._pending_ids: Dict[str, int] = {}
+        self._writing = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="discussion-writer", daemon=True)
+        self._thread.start()
+        self._replay_dead_letter()
+
+    def append(self, discussion_id: str, message: Dict,
+               callback: Optional[Callable[[int], None]] = None) -> None:
+        """Met en file l'ajout d'un message.
+
+        Args:
+            callback: Appelée avec le numéro de séquence du message une fois écrit
+        """
+        self._enqueue(("append", discussion_id, message, callback))
+
+    def save(self, discussion_id: str, data: Dict) -> None:
+        """Met en file l'enregistrement d'une discussion complète."""
+        self._enqueue(("save", discussion_id, data, None))
+
+    def depth(self) -> int:
+        """Nombre d'écritures en attente ou en cours."""
+        with self._condition:
+            return len(self._pending) + self._writing
+
+    def has_pending(self, discussion_id: str) -> bool:
+        """Indique si des écritures d'une discussion ne sont pas encore sur le disque."""
+        with self._condition:
+            return discussion_id in self._pending_ids
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Attend que toutes les écritures en file soient faites.
+
+        Returns:
+            True si la file est vide, False si le délai a expiré
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._pending and not self._writing, timeout)
+
+    def close(self, timeout: Optional[float] = 30) -> None:
+        """Écrit ce qui reste en file puis arrête le thread d'écriture."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+
+    def _enqueue(self, operation) -> None:
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("La file d'écriture des discussions est fermée")
+            self._pending.append(operation)
+            self._pending_ids[operation[1]] = self._pending_ids.get(operation[1], 0) + 1
+            WRITE_QUEUE_DEPTH.inc()
+            self._condition.notify_all()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending or self._closed)
+                if not self._pending:
+                    return
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+                self._writing = len(batch)
+
+            self._write(batch)
+
+            with self._condition:
+                for operation in batch:
+                    remaining = self._pending_ids[operation[1]] - 1
+                    if remaining:
+                        self._pending_ids[operation[1]] = remaining
+                    else:
+                        del self._pending_ids[operation[1]]
+                self._writing = 0
+                WRITE_QUEUE_DEPTH.dec(len(batch))
+                self._condition.notify_all()
+
+    def _write(self, batch) -> None:
+        operations = [(kind, discussion_id, data) for kind, discussion_id, data, _ in batch]
+        callbacks: Dict[str, List] = {}
+        for kind, discussion_id, _, callback in batch:
+            if kind == "append":
+                callbacks.setdefault(discussion_id, []).append(callback)
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                with span('persistence', 'write_batch'):
+                    seqs = self.store.write_batch(operations)
+                break
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error("Écriture de %d opérations sur les discussions en échec : %s", len(batch), str(e))
+                    self._spill(operations)
+                    return
+                logger.warning("Échec de l'écriture des discussions (%s), nouvelle tentative", str(e))
+                time.sleep(0.1 * 2 ** attempt)
+
+        for discussion_id, discussion_callbacks in callbacks.items():
+            for seq, callback in zip(seqs[discussion_id], discussion_callbacks):
+                if callback is None:
+                    continue
+                try:
+                    callback(seq)
+                except Exception as e:
+                    logger.error("Erreur après l'écriture de la discussion %s : %s", discussion_id, str(e))
+
+    def _spill(self, operations: List[Tuple[str, str, Dict]]) -> None:
+        """Met de côté les écritures d'un lot en échec, pour les rejouer au prochain démarrage."""
+        DISCUSSION_WRITE_FAILURES.inc(len(operations))
+        if not self.dead_letter_path:
+            logger.error("%d écritures de discussions perdues", len(operations))
+            return
+        try:
+            with open(self.dead_letter_path, 'a', encoding='utf-8') as f:
+                for kind, discussion_id, data in operations:
+                    f.write(json.dumps({"kind": kind, "id": discussion_id, "data": data}, ensure_ascii=False) + "\n")
+            logger.error("%d écritures de discussions mises de côté dans %s", len(operations), self.dead_letter_path)
+        except Exception as e:
+            logger.error("%d écritures de discussions perdues : %s", len(operations), str(e))
+
+    def _replay_dead_letter(self) -> None:
+        """Remet en file les écritures mises de côté par un lancement précédent."""
+        if not self.dead_letter_path:
+            return
+        # Renommage atomique : un seul des processus partageant le fichier le rejoue
+        replay_path = f"{self.dead_letter_path}.{os.getpid()}"
+        try:
+            os.replace(self.dead_letter_path, replay_path)
+        except FileNotFoundError:
+            return
+        with open(replay_path, 'r', encoding='utf-8') as f:
+            operations = [json.loads(line) for line in f if line.strip()]
+        os.remove(replay_path)
+        for operation in operations:
+            self._enqueue((operation["kind"], operation["id"], operation["data"], None))
+        logger.info("%d écritures de discussions mises de côté remises en file", len(operations))
+
+
+def _read_json_discussions(directory: str):
+    """Parcourt les discussions JSON d'un dossier : (ID, données), les fichiers illisibles étant ignorés."""
+    for filepath in sorted(glob.glob(os.path.join(directory, '*.json'))):
+        try:
+            with open(filepath, 'r', encoding='utf-8') as f:
+                yield discussion_id_from_path(filepath), json.load(f)
+        except Exception as e:
+            logger.error("Erreur lors de la lecture de %s : %s", filepath, str(e))
+
+
+def migrate_json_discussions(store: DiscussionStore, directory: str = 'save/discussions',
+                             remove: bool = False) -> int:
+    """Importe les anciennes discussions JSON dans le stockage SQLite.
+
+    Le stockage les importe déjà à son premier démarrage ; ce script sert à
+    importer un autre dossier ou à supprimer les fichiers une fois importés.
+
+    Args:
+        store: Le stockage cible
+        directory: Dossier contenant les fichiers discussion_*.json
+        remove: Supprimer les fichiers JSON une fois importés
+
+    Returns:
+        Le nombre de discussions importées
+    """
+    imported = 0
+    for filepath in sorted(glob.glob(os.path.join(directory, '*.json'))):
+        discussion_id = discussion_id_from_path(filepath)
+        try:
+            with open(filepath, 'r', encoding='utf-8') as f:
+                imported += store.import_discussion(discussion_id, json.load(f))
+            if remove:
+                os.remove(filepath)
+        except Exception as e:
+            logger.error("Erreur lors de la migration de %s : %s", filepath, str(e))
+
+    store.compact()
+    logger.info("%d discussions migrées depuis %s", imported, directory)
+    return imported
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_discussion_store() -> DiscussionStore:
+    """Retourne le stockage des discussions partagé par le processus."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = DiscussionStore(
+                os.getenv('DISCUSSIONS_DB_PATH', 'save/discussions.db'),
+                checkpoint_every=int(os.getenv('DISCUSSIONS_CHECKPOINT_EVERY', 1000)),
+                json_directory=os.getenv('DISCUSSIONS_JSON_DIR', 'save/discussions'),
+            )
+        return _store
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_discussion_writer() -> DiscussionWriter:
+    """Retourne la file d'écriture des discussions partagée par le processus, vidée à sa sortie."""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = DiscussionWriter(
+                get_discussion_store(),
+                max_batch=int(os.getenv('DISCUSSIONS_WRITE_BATCH', 500)),
+                dead_letter_path=os.getenv('DISCUSSIONS_DEAD_LETTER_PATH', 'save/discussions_dead_letter.jsonl'),
+            )
+            atexit.register(_writer.close)
+        return _writer
@@ -1,10 +1,17 @@
 from flask import Blueprint, jsonify, request
 import logging
 import os
-from utils import process_pdf, insert_to_chroma
-from storage import save_uploaded_file, get_sources_history, delete_source, save_uploaded_text
-import chromadb
-from chromadb.utils import embedding_functions
+from utils import ingest_pdf, insert_to_chroma, iter_files_chunks, StoredUpload
+from indexer import IndexingError, chunk_content_id
+from storage import (save_uploaded_raw_file, save_uploaded_file_metadata, get_sources_page, get_source,
+                     delete_source, save_uploaded_text, is_archive, expand_archive, upload_source_id,
+                     delete_source_chunks, discard_unlinked_chunks)
+from cache import bump_corpus_version
+from source_catalog import get_source_catalog
+from jobs import get_job_queue, job_handler
+from datetime import datetime
+from registry import get_collection, COLLECTION_NAME
+from sharding import ShardedCollection
 from langchain.schema import Document
 
 documents = Blueprint('documents', __name__)
@@ -13,22 +20,209 @@ documents = Blueprint('documents', __name__)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Configuration ChromaDB
-chroma_host = os.getenv('CHROMA_DB_HOST', 'localhost')  
-chroma_port = int(os.getenv('CHROMA_DB_PORT', 8000))
+@job_handler('pdf')
+def ingest_pdf_job(payload, job):
+    """Traite une tâche d'ingestion de PDF : extraction, indexation puis métadonnées."""
+    upload = StoredUpload(payload['file_path'], payload['filename'])
+    source = upload_source_id(payload['file_path'])
+    try:
+        job.stage("indexation")
+        documents_content = ingest_pdf(
+            upload,
+            progress=lambda done, failed: job.progress(chunks=done, chunks_failed=failed),
+            pages_progress=lambda page: job.progress(pages=page),
+            source=source
+        )
+
+        job.stage("sauvegarde")
+        metadata_path, metadata_filename = save_uploaded_file_metadata(
+            payload['file_path'], payload['filename'],
+            datetime.fromisoformat(payload['timestamp']), documents_content
+        )
+        if metadata_path is None:
+            raise Exception("Métadonnées non sauvegardées")
+    except Exception:
+        # Le fichier brut et ses morceaux ne sont conservés que si son traitement aboutit :
+        # sans métadonnées, la source ne pourrait plus être supprimée
+        if delete_source_chunks(source):
+            bump_corpus_version()
+        if os.path.exists(payload['file_path']):
+            os.remove(payload['file_path'])
+        raise
+    finally:
+        upload.close()
+
+    return {
+        "filename": payload['filename'],
+        "documents_processed": len(documents_content),
+        "chunks_created": len(documents_content),
+        "metadata_saved": metadata_path is not None,
+        "metadata_filename": metadata_filename
+    }
 
-try:
-    if chroma_host == 'localhost':
-        chroma_client = chromadb.Client()
+
+@job_handler('bulk')
+def ingest_bulk_job(payload, job):
+    """Traite une tâche d'ingestion en masse : plusieurs fichiers, archives décompressées.
+
+    Les fichiers sont découpés en parallèle et tous leurs morceaux passent par
+    une seule indexation : les lots d'embeddings sont partagés entre fichiers.
+    Les archives sont supprimées une fois décompressées : la liste des
+    fichiers extraits est enregistrée dans le payload avant l'indexation,
+    pour qu'une reprise de la tâche ne décompresse pas une seconde fois.
+    """
+    if 'expanded' in payload:
+        files = payload['expanded']['files']
+        results = payload['expanded']['results']
     else:
-        chroma_client = chromadb.HttpClient(host=chroma_host, port=chroma_port)
-except Exception as e:
-    logger.error(f"Erreur de connexion à ChromaDB : {str(e)}")
-    chroma_client = chromadb.Client()
+        job.stage("décompression")
+        files = []
+        results = []
+        for upload in payload['files']:
+            if is_archive(upload['filename']):
+                try:
+                    members = expand_archive(upload['file_path'])
+                except Exception as e:
+                    results.append({"filename": upload['filename'], "status": "failed", "error": str(e)})
+                    continue
+                for member in members:
+                    files.append(dict(member, timestamp=upload['timestamp'], archive=upload['filename']))
+            else:
+                files.append(upload)
+        job.save_payload(dict(payload, expanded={"files": files, "results": results}))
+
+    previews = [[] for _ in files]
+    chunk_ids = [[] for _ in files]
+    errors = [None] * len(files)
+    files_done = 0
+
+    def chunks():
+        nonlocal files_done
+        for index, doc, error in iter_files_chunks([(f['file_path'], f['filename']) for f in files]):
+            if doc is None:
+                errors[index] = error
+                files_done += 1
+                job.progress(files=files_done, files_total=len(files))
+                continue
+            previews[index].append({
+                'content': doc.page_content[:201],
+                'content_length': len(doc.page_content),
+                'chunk_index': doc.metadata['chunk_index'],
+                'filename': doc.metadata['filename'],
+                'metadata': doc.metadata
+            })
+            chunk_ids[index].append(chunk_content_id(doc.page_content))
+            yield doc
+
+    job.stage("indexation")
+    failed_ids = set()
+    inserted_ids = []
+    try:
+        insert_to_chroma(chunks(), progress=lambda done, failed: job.progress(chunks=done, chunks_failed=failed),
+                         inserted_ids=inserted_ids)
+    except IndexingError as e:
+        failed_ids = set(e.failed_ids)
+
+    job.stage("sauvegarde")
+    catalog = get_source_catalog()
+    # Morceaux des fichiers en échec : retirés de la base s'ils n'appartiennent à aucun autre fichier
+    discarded_ids = set()
+    for index, upload in enumerate(files):
+        result = {"filename": upload['filename'], "chunks_created": len(previews[index])}
+        if upload.get('archive'):
+            result["archive"] = upload['archive']
+
+        failed_chunks = sum(1 for chunk_id in chunk_ids[index] if chunk_id in failed_ids)
+        error = errors[index]
+        if error is None and failed_chunks:
+            error = f"{failed_chunks} morceaux non indexés"
+        elif error is None and not previews[index]:
+            error = "Aucun texte extractible trouvé"
+
+        if error is None:
+            source = upload_source_id(upload['file_path'])
+            catalog.link_chunks(source, chunk_ids[index])
+            metadata_path, metadata_filename = save_uploaded_file_metadata(
+                upload['file_path'], upload['filename'],
+                datetime.fromisoformat(upload['timestamp']), previews[index]
+            )
+            if metadata_path is None:
+                catalog.unlink_chunks(source)
+                error = "Métadonnées non sauvegardées"
+            else:
+                result.update(status="done", metadata_filename=metadata_filename)
+
+        if error is not None:
+            if os.path.exists(upload['file_path']):
+                os.remove(upload['file_path'])
+            discarded_ids.update(chunk_ids[index])
+            result.update(status="failed", error=error)
+        results.append(result)
+
+    # Seuls les morceaux insérés par cette tâche : un morceau déjà présent appartient à une autre source
+    discarded_ids.intersection_update(inserted_ids)
+    if discarded_ids and discard_unlinked_chunks(list(discarded_ids)):
+        bump_corpus_version()
+
+    return {
+        "files": results,
+        "files_processed": sum(1 for result in results if result["status"] == "done"),
+        "files_failed": sum(1 for result in results if result["status"] == "failed"),
+        "chunks_created": sum(result.get("chunks_created", 0) for result in results)
+    }
+
+
+@documents.route("files", methods=["POST"])
+def upload_files():
+    """Endpoint pour uploader plusieurs fichiers (PDF, texte) ou des archives zip/tar en une fois."""
+    try:
+        uploads = [file for file in request.files.getlist('files') if file.filename]
+        if not uploads:
+            logger.warning("Aucun fichier trouvé dans la requête.")
+            return jsonify({"error": "Aucun fichier trouvé"}), 400
+
+        accepted = []
+        rejected = []
+        for file in uploads:
+            if not (file.filename.lower().endswith(('.pdf', '.txt')) or is_archive(file.filename)):
+                rejected.append(file.filename)
+                continue
+            file_path, timestamp = save_uploaded_raw_file(file)
+            if file_path is None:
+                rejected.append(file.filename)
+                continue
+            accepted.append({
+                "file_path": file_path,
+                "filename": file.filename,
+                "timestamp": timestamp.isoformat()
+            })
+
+        if not accepted:
+            return jsonify({
+                "error": "Seuls les fichiers PDF, texte et les archives zip/tar sont acceptés",
+                "rejected": rejected
+            }), 400
+
+        job_id = get_job_queue().submit('bulk', {"files": accepted})
+
+        return jsonify({
+            "message": "Fichiers reçus, traitement en cours",
+            "files": [upload["filename"] for upload in accepted],
+            "rejected": rejected,
+            "job_id": job_id,
+            "status_url": f"/api/jobs/{job_id}"
+        }), 202
+
+    except Exception as e:
+        logger.error("Erreur lors de l'upload des fichiers : %s", str(e))
+        return jsonify({
+            "error": f"Erreur lors de l'upload des fichiers : {str(e)}"
+        }), 500
+
 
 @documents.route("file", methods=["POST"])
 def upload_file():
-    """Endpoint pour uploader et traiter un fichier PDF."""
+    """Endpoint pour uploader un fichier PDF ; le traitement se fait en tâche de fond."""
     try:
         if 'file' not in request.files:
             logger.warning("Aucun fichier trouvé dans la requête.")
@@ -46,33 +240,24 @@ def upload_file():
 
         logger.info(f"Nom du fichier : {file.filename}")
 
-        # Traitement du PDF avec LangChain (retourne des Documents LangChain)
-        langchain_documents = process_pdf(file)
-        
-        # Convertir les documents LangChain en format pour save_uploaded_file
-        documents_content = []
-        for i, doc in enumerate(langchain_documents):
-            documents_content.append({
-                'content': doc.page_content,
-                'chunk_index': i,
-                'filename': file.filename,
-                'metadata': doc.metadata
-            })
-        
-        # Sauvegarder le fichier source et ses métadonnées
-        file_path, metadata_path, metadata_filename = save_uploaded_file(file, documents_content)
-        
-        # Insertion dans ChromaDB
-        insert_to_chroma(langchain_documents, chroma_client)
+        # Sauvegarder le fichier brut, puis confier l'extraction et l'indexation à une tâche
+        file_path, timestamp = save_uploaded_raw_file(file)
+        if file_path is None:
+            return jsonify({"error": "Erreur lors de la sauvegarde du fichier"}), 500
+
+        job_id = get_job_queue().submit('pdf', {
+            "file_path": file_path,
+            "filename": file.filename,
+            "timestamp": timestamp.isoformat()
+        })
 
         return jsonify({
-            "message": "Fichier traité avec succès",
+            "message": "Fichier reçu, traitement en cours",
             "filename": file.filename,
-            "documents_processed": len(langchain_documents),
-            "chunks_created": len(langchain_documents),
-            "file_saved": file_path is not None,
-            "metadata_saved": metadata_path is not None
-        }), 200
+            "job_id": job_id,
+            "status_url": f"/api/jobs/{job_id}",
+            "file_saved": True
+        }), 202
 
     except Exception as e:
         logger.error("Erreur lors du traitement du fichier PDF : %s", str(e))
@@ -112,7 +297,7 @@ def upload_text():
         file_path, metadata_path, metadata_filename = save_uploaded_text(text)
         
         # Insertion dans ChromaDB
-        insert_to_chroma(document, chroma_client)
+        insert_to_chroma(document, source=upload_source_id(file_path) if metadata_filename else None)
 
         return jsonify({
             "message": "Fichier traité avec succès",
@@ -129,25 +314,33 @@ def upload_text():
             "error": f"Erreur lors du traitement du fichier PDF : {str(e)}"
         }), 500
     
+@documents.route("jobs/<job_id>", methods=["GET"])
+def get_job_endpoint(job_id):
+    """Récupère l'état d'une tâche d'ingestion : étape, progression, résultat ou erreur."""
+    try:
+        job = get_job_queue().get(job_id)
+        if job is None:
+            return jsonify({"error": "Tâche non trouvée"}), 404
+        return jsonify(job), 200
+    except Exception as e:
+        logger.error("Erreur lors de la récupération de la tâche : %s", str(e))
+        return jsonify({"error": "Erreur lors de la récupération de la tâche"}), 500
+    
 @documents.route("status", methods=["GET"])
 def get_status():
-    """Endpoint pour vérifier le statut des documents dans ChromaDB."""
+    """Endpoint pour vérifier le statut des documents dans ChromaDB (total et nombre par shard)."""
     try:
-        embeddings_model = embedding_functions.OpenAIEmbeddingFunction(
-            model_name="text-embedding-3-small", 
-            api_key=os.getenv('OPENAI_API_KEY')
-        )
+        collection = get_collection()
         
-        collection = chroma_client.get_or_create_collection(
-            name="Documents", 
-            embedding_function=embeddings_model
-        )
-        
-        count = collection.count()
+        if isinstance(collection, ShardedCollection):
+            counts = collection.counts()
+        else:
+            counts = {COLLECTION_NAME: collection.count()}
         
         return jsonify({
-            "documents_count": count,
-            "collection_name": "Documents"
+            "documents_count": sum(counts.values()),
+            "collection_name": COLLECTION_NAME,
+            "shards": [{"name": name, "documents_count": count} for name, count in counts.items()]
         }), 200
 
     except Exception as e:
@@ -156,17 +349,40 @@ def get_status():
 
 @documents.route("history/sources", methods=["GET"])
 def get_sources():
-    """Récupère l'historique des fichiers sources."""
+    """Récupère l'historique des fichiers sources (résumés uniquement, filtrés et paginés)."""
     try:
-        sources = get_sources_history()
+        limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+        sources, next_cursor = get_sources_page(
+            limit,
+            cursor=request.args.get('cursor'),
+            source_type=request.args.get('type'),
+            name=request.args.get('name'),
+            date_from=request.args.get('date_from'),
+            date_to=request.args.get('date_to')
+        )
         return jsonify({
             "sources": sources,
-            "count": len(sources)
+            "count": len(sources),
+            "next_cursor": next_cursor
         }), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logger.error("Erreur lors de la récupération de l'historique des sources : %s", str(e))
         return jsonify({"error": "Erreur lors de la récupération de l'historique des sources"}), 500
 
+@documents.route("history/sources/<source_id>", methods=["GET"])
+def get_source_endpoint(source_id):
+    """Récupère le détail d'un fichier source, avec l'aperçu de ses morceaux."""
+    try:
+        source = get_source(source_id)
+        if source is None:
+            return jsonify({"error": "Source non trouvée"}), 404
+        return jsonify(source), 200
+    except Exception as e:
+        logger.error("Erreur lors de la récupération de la source : %s", str(e))
+        return jsonify({"error": "Erreur lors de la récupération de la source"}), 500
+
 @documents.route("history/sources/<source_id>", methods=["DELETE"])
 def delete_source_endpoint(source_id):
     """Supprime un fichier source."""
@@ -0,0 +1,219 @@
+import logging
+import math
+import os
+import threading
+import zlib
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import numpy as np
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+from chromadb.utils.embedding_functions import register_embedding_function
+
+from lexical_index import fold_words
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_THREADS = int(os.getenv('EMBEDDING_THREADS', os.cpu_count() or 1))
+
+
+class EmbeddingProvider(EmbeddingFunction[Documents], ABC):
+    """Fournisseur d'embeddings, utilisable directement comme fonction d'embedding Chroma.
+
+    Les textes sont découpés en lots de `batch_size`, calculés en parallèle sur
+    un pool de `threads` threads. Les sous-classes n'implémentent que
+    `embed_batch` ; `model_name` identifie le modèle dans les clés de cache.
+    """
+
+    model_name = ""
+
+    def __init__(self, batch_size: int = 64, threads: int = EMBEDDING_THREADS):
+        """
+        Args:
+            batch_size: Nombre de textes par appel au modèle
+            threads: Nombre de lots calculés en parallèle
+        """
+        self.batch_size = max(1, batch_size)
+        self.threads = max(1, threads)
+        self._executor = None
+
+    @abstractmethod
+    def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """Calcule les embeddings d'un lot de textes."""
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        """Calcule les embeddings d'une liste de textes, par lots parallèles."""
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        if len(batches) <= 1 or self.threads == 1:
+            return [embedding for batch in batches for embedding in self.embed_batch(batch)]
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='embed')
+        return [embedding for result in self._executor.map(self.embed_batch, batches) for embedding in result]
+
+    def __call__(self, input: Documents) -> Embeddings:
+        return [np.asarray(embedding, dtype=np.float32) for embedding in self.embed(list(input))]
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    """Embeddings calculés par l'API OpenAI.
+
+    Enveloppe la fonction d'embedding OpenAI de Chroma : la collection existante,
+    créée avec cette fonction, garde la même configuration.
+    """
+
+    def __init__(self, function, batch_size: int = 64, threads: int = EMBEDDING_THREADS):
+        """
+        Args:
+            function: OpenAIEmbeddingFunction de Chroma, branchée sur le client partagé
+        """
+        super().__init__(batch_size, threads)
+        self.function = function
+        self.model_name = function.model_name
+
+    def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        return self.function(texts)
+
+    @staticmethod
+    def name() -> str:
+        return "openai"
+
+    def get_config(self) -> Dict[str, Any]:
+        return self.function.get_config()
+
+    @staticmethod
+    def build_from_config(config: Dict[str, Any]) -> 'OpenAIEmbeddingProvider':
+        from chromadb.utils import embedding_functions
+        return OpenAIEmbeddingProvider(embedding_functions.OpenAIEmbeddingFunction.build_from_config(config))
+
+
+@register_embedding_function
+class HashingEmbeddingProvider(EmbeddingProvider):
+    """Embeddings déterministes par hachage des mots et bigrammes, sans modèle ni réseau.
+
+    Chaque terme est projeté sur une dimension (avec un signe) par CRC32, pondéré
+    par 1 + log(tf), puis le vecteur est normalisé. La qualité est celle d'un
+    TF-IDF sans IDF : suffisant pour les tests, les benchmarks et le travail hors ligne.
+    """
+
+    def __init__(self, dimensions: int = 384, batch_size: int = 64,
+                 threads: int = EMBEDDING_THREADS):
+        """
+        Args:
+            dimensions: Taille des vecteurs produits
+        """
+        super().__init__(batch_size, threads)
+        self.dimensions = dimensions
+        self.model_name = f"hashing-{dimensions}"
+
+    def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        matrix = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            counts = {}
+            for term in self._terms(text):
+                counts[term] = counts.get(term, 0) + 1
+            for term, count in counts.items():
+                digest = zlib.crc32(term.encode('utf-8'))
+                sign = 1.0 if digest & 0x80000000 else -1.0
+                matrix[row, digest % self.dimensions] += sign * (1.0 + math.log(count))
+
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix /= np.where(norms == 0, 1, norms)
+        return matrix.tolist()
+
+    @staticmethod
+    def _terms(text: str):
+        words = fold_words(text)
+        yield from words
+        for first, second in zip(words, words[1:]):
+            yield first + " " + second
+
+    @staticmethod
+    def name() -> str:
+        return "lexica_hashing"
+
+    def get_config(self) -> Dict[str, Any]:
+        return {"dimensions": self.dimensions}
+
+    @staticmethod
+    def build_from_config(config: Dict[str, Any]) -> 'HashingEmbeddingProvider':
+        return HashingEmbeddingProvider(dimensions=config.get("dimensions", 384))
+
+
+@register_embedding_function
+class LocalEmbeddingProvider(EmbeddingProvider):
+    """Embeddings calculés sur le CPU par un modèle sentence-transformers local.
+
+    Le modèle est chargé au premier appel, depuis un dossier ou le nom d'un
+    modèle du hub (mis en cache sur le disque). Nécessite `sentence-transformers`,
+    dépendance optionnelle (voir requirements.txt).
+    """
+
+    def __init__(self, model_name: str = "all-MiniLM-L6-v2", batch_size: int = 64,
+                 threads: int = EMBEDDING_THREADS):
+        """
+        Args:
+            model_name: Chemin ou nom du modèle sentence-transformers
+        """
+        super().__init__(batch_size, threads)
+        self.model_name = model_name
+        self._model = None
+        self._model_lock = threading.Lock()
+
+    def _get_model(self):
+        with self._model_lock:
+            if self._model is None:
+                self._model = self._load_model()
+        return self._model
+
+    def _load_model(self):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise ImportError(
+                "Le fournisseur d'embeddings 'local' nécessite sentence-transformers "
+                "(pip install sentence-transformers)"
+            )
+        logger.info("Chargement du modèle d'embedding local %s", self.model_name)
+        return SentenceTransformer(self.model_name, device='cpu')
+
+    def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        return self._get_model().encode(
+            texts, batch_size=self.batch_size, normalize_embeddings=True, convert_to_numpy=True
+        ).tolist()
+
+    @staticmethod
+    def name() -> str:
+        return "lexica_local"
+
+    def get_config(self) -> Dict[str, Any]:
+        return {"model_name": self.model_name}
+
+    @staticmethod
+    def build_from_config(config: Dict[str, Any]) -> 'LocalEmbeddingProvider':
+        return LocalEmbeddingProvider(model_name=config.get("model_name", "all-MiniLM-L6-v2"))
+
+
+def create_embedding_provider(provider: str, openai_function=None) -> EmbeddingProvider:
+    """Crée le fournisseur d'embeddings choisi par configuration.
+
+    Args:
+        provider: openai, local ou hashing
+        openai_function: Fonction d'embedding OpenAI de Chroma (pour `openai`)
+
+    Returns:
+        Le fournisseur d'embeddings
+
+    Raises:
+        ValueError: Si le fournisseur est inconnu
+    """
+    # L'API OpenAI accepte 2048 textes par appel ; un modèle local travaille mieux par petits lots
+    batch_size = int(os.getenv('EMBEDDING_BATCH_SIZE', 2048 if provider == 'openai' else 64))
+    if provider == 'openai':
+        return OpenAIEmbeddingProvider(openai_function, batch_size=batch_size)
+    if provider == 'local':
+        return LocalEmbeddingProvider(os.getenv('EMBEDDING_MODEL', 'all-MiniLM-L6-v2'), batch_size=batch_size)
+    if provider == 'hashing':
+        return HashingEmbeddingProvider(int(os.getenv('EMBEDDING_DIMENSIONS', 384)), batch_size=batch_size)
+    raise ValueError(f"Fournisseur d'embeddings inconnu : {provider}")
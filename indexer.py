@@ -0,0 +1,213 @@
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from lexical_index import get_lexical_index
+from metrics import span, INGEST_CHUNKS
+from registry import get_collection, get_embedding_function
+
+logger = logging.getLogger(__name__)
+
+# Limites d'un appel d'embedding : l'API OpenAI accepte 2048 textes et 300k tokens par requête
+EMBED_MAX_BATCH_TOKENS = int(os.getenv('EMBED_MAX_BATCH_TOKENS', 100000))
+EMBED_MAX_BATCH_SIZE = int(os.getenv('EMBED_MAX_BATCH_SIZE', 256))
+EMBED_CONCURRENCY = int(os.getenv('EMBED_CONCURRENCY', 4))
+EMBED_MAX_RETRIES = int(os.getenv('EMBED_MAX_RETRIES', 5))
+EMBED_RETRY_BACKOFF = float(os.getenv('EMBED_RETRY_BACKOFF', 1.0))
+
+
+def chunk_content_id(content: str) -> str:
+    """ID d'un morceau dérivé de son contenu : deux morceaux identiques partagent le même ID."""
+    normalized = " ".join(content.split())
+    return "chunk_" + hashlib.sha256(normalized.encode('utf-8')).hexdigest()[:32]
+
+
+def delete_chunks(collection, ids: List[str], batch_size: int = 500) -> None:
+    """Supprime des morceaux de la collection et de son index lexical, par lots."""
+    lexical_index = get_lexical_index(collection.name)
+    for i in range(0, len(ids), batch_size):
+        collection.delete(ids=ids[i:i + batch_size])
+        lexical_index.remove(ids[i:i + batch_size])
+
+
+def estimate_tokens(text: str) -> int:
+    """Estime le nombre de tokens d'un texte (environ 4 caractères par token)."""
+    return len(text) // 4 + 1
+
+
+class IndexingError(Exception):
+    """Levée quand des lots n'ont pas pu être indexés après toutes les tentatives."""
+
+    def __init__(self, failed_ids: List[str], last_error: Exception):
+        super().__init__(f"{len(failed_ids)} morceaux non indexés : {last_error}")
+        self.failed_ids = failed_ids
+        self.last_error = last_error
+
+
+class BulkIndexer:
+    """Moteur d'indexation par lots : embeddings concurrents et insertion dans ChromaDB.
+
+    Les morceaux sont regroupés en lots bornés en tokens et en nombre ; au plus
+    `concurrency` lots sont calculés en parallèle. Un lot en échec est retenté
+    seul, avec un délai exponentiel, sans refaire les lots déjà insérés.
+    Avec `dedupe`, les morceaux dont l'ID est déjà présent dans la collection
+    ne sont ni recalculés ni réinsérés. L'index lexical BM25 de la collection
+    est tenu à jour lot par lot.
+    """
+
+    def __init__(self, collection=None, embedding_function=None,
+                 max_batch_tokens: int = EMBED_MAX_BATCH_TOKENS,
+                 max_batch_size: int = EMBED_MAX_BATCH_SIZE,
+                 concurrency: int = EMBED_CONCURRENCY,
+                 max_retries: int = EMBED_MAX_RETRIES,
+                 backoff: float = EMBED_RETRY_BACKOFF,
+                 progress: Optional[Callable[[int, int], None]] = None,
+                 dedupe: bool = False):
+        """
+        Args:
+            collection: Collection ChromaDB cible (celle du registre partagé par défaut)
+            embedding_function: Fonction d'embedding (celle du registre partagé par défaut)
+            max_batch_tokens: Nombre maximum de tokens estimés par lot
+            max_batch_size: Nombre maximum de morceaux par lot
+            concurrency: Nombre maximum de lots en cours en même temps
+            max_retries: Nombre de nouvelles tentatives pour un lot en échec
+            backoff: Délai initial en secondes entre deux tentatives (doublé à chaque fois)
+            progress: Appelée avec (morceaux traités, morceaux en échec) après chaque lot
+            dedupe: Ignorer les morceaux déjà présents dans la collection
+        """
+        self.collection = collection if collection is not None else get_collection()
+        self.embedding_function = embedding_function or get_embedding_function()
+        self.lexical_index = get_lexical_index(self.collection.name)
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.progress = progress
+        self.dedupe = dedupe
+        self._lock = threading.Lock()
+        self._seen_ids = set()
+        self.indexed = 0
+        self.reused = 0
+        self.inserted_ids = []
+        self.failed_ids = []
+
+    def batches(self, items: Iterable[Tuple[str, str, Dict]]):
+        """Regroupe les morceaux (id, texte, métadonnées) en lots bornés en tokens et en nombre."""
+        batch, batch_tokens = [], 0
+        for item in items:
+            # Un même ID ne peut apparaître qu'une fois dans une insertion
+            if item[0] in self._seen_ids:
+                self._report(reused=1)
+                continue
+            self._seen_ids.add(item[0])
+
+            tokens = estimate_tokens(item[1])
+            if batch and (batch_tokens + tokens > self.max_batch_tokens or len(batch) >= self.max_batch_size):
+                yield batch
+                batch, batch_tokens = [], 0
+            batch.append(item)
+            batch_tokens += tokens
+        if batch:
+            yield batch
+
+    def index(self, items: Iterable[Tuple[str, str, Dict]]) -> int:
+        """Indexe les morceaux, consommés au fil de l'eau (un générateur convient).
+
+        Args:
+            items: Morceaux sous forme de tuples (id, texte, métadonnées)
+
+        Returns:
+            Le nombre de morceaux nouvellement indexés
+
+        Raises:
+            IndexingError: Si des lots restent en échec après toutes les tentatives
+        """
+        last_error = None
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            pending = set()
+            for batch in self.batches(items):
+                # On borne le nombre de lots en attente pour garder la mémoire sous contrôle
+                while len(pending) >= 2 * self.concurrency:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    last_error = self._collect(done) or last_error
+                pending.add(executor.submit(self._index_batch, batch))
+
+            done, _ = wait(pending)
+            last_error = self._collect(done) or last_error
+
+        logger.info("Indexation terminée : %d morceaux indexés, %d déjà présents, %d en échec",
+                    self.indexed, self.reused, len(self.failed_ids))
+        if self.failed_ids:
+            raise IndexingError(self.failed_ids, last_error)
+        return self.indexed
+
+    def _collect(self, futures):
+        last_error = None
+        for future in futures:
+            error = future.result()
+            if error is not None:
+                last_error = error
+        return last_error
+
+    def _index_batch(self, batch: List[Tuple[str, str, Dict]]):
+        all_ids = ids = [item[0] for item in batch]
+        all_texts = texts = [item[1] for item in batch]
+        metadatas = [item[2] for item in batch]
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                reused = 0
+                if self.dedupe:
+                    with span('ingest', 'dedupe'):
+                        existing = set(self.collection.get(ids=ids, include=[])['ids'])
+                    if existing:
+                        kept = [i for i, doc_id in enumerate(ids) if doc_id not in existing]
+                        reused = len(ids) - len(kept)
+                        ids = [ids[i] for i in kept]
+                        texts = [texts[i] for i in kept]
+                        metadatas = [metadatas[i] for i in kept]
+
+                if ids:
+                    with span('ingest', 'embedding'):
+                        embeddings = self.embedding_function(texts)
+                    with span('ingest', 'upsert'):
+                        self.collection.upsert(ids=ids, embeddings=embeddings, documents=texts, metadatas=metadatas)
+                # Tout le lot : un morceau déjà présent côté vecteurs peut manquer côté lexical
+                with span('ingest', 'lexical_index'):
+                    self.lexical_index.add(all_ids, all_texts)
+                self._report(inserted_ids=ids, reused=reused)
+                return None
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error("Lot de %d morceaux abandonné après %d tentatives : %s",
+                                 len(batch), attempt + 1, str(e))
+                    self._report(failed_ids=ids)
+                    return e
+                delay = self.backoff * (2 ** attempt) * (1 + random.random() / 2)
+                logger.warning("Échec d'un lot de %d morceaux (%s), nouvelle tentative dans %.1fs",
+                               len(batch), str(e), delay)
+                time.sleep(delay)
+
+    def _report(self, inserted_ids: Optional[List[str]] = None, reused: int = 0,
+                failed_ids: Optional[List[str]] = None) -> None:
+        indexed = len(inserted_ids or [])
+        INGEST_CHUNKS.labels("indexed").inc(indexed)
+        INGEST_CHUNKS.labels("reused").inc(reused)
+        INGEST_CHUNKS.labels("failed").inc(len(failed_ids or []))
+        with self._lock:
+            self.indexed += indexed
+            self.inserted_ids.extend(inserted_ids or [])
+            self.reused += reused
+            if failed_ids:
+                self.failed_ids.extend(failed_ids)
+            done_total, failed_total = self.indexed + self.reused, len(self.failed_ids)
+        if indexed or failed_ids:
+            logger.info("Progression de l'indexation : %d morceaux traités", done_total)
+        if self.progress:
+            self.progress(done_total, failed_total)
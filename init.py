@@ -1,9 +1,14 @@
 import os
+import json
+import glob
+import hashlib
+import argparse
 import logging
-import chromadb
-from chromadb.config import Settings
-from chromadb.utils import embedding_functions
-from utils import load_documents_from_folder
+from utils import load_document_file
+from registry import get_chroma_client, get_collection, VECTOR_BACKEND
+from indexer import BulkIndexer, chunk_content_id, delete_chunks
+from cache import bump_corpus_version
+from source_catalog import get_source_catalog
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -11,64 +16,157 @@ load_dotenv()
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
-# Connexion au client Chroma
-client = chromadb.HttpClient(host=os.getenv("CHROMA_DB_HOST"), port=8000)
-logging.info("heartbeat %d", client.heartbeat())
-
-# Charger les documents et découper en morceaux
-folder_path = 'docs'
-documents = load_documents_from_folder(folder_path)
-
-# Création d'une fonction d'embedding
-embeddings_model = embedding_functions.OpenAIEmbeddingFunction(
-    model_name="text-embedding-3-small", 
-    api_key=os.getenv('OPENAI_API_KEY')
-)
-
-# Création ou récupération d'une collection
-collection = client.get_or_create_collection(name="Documents", embedding_function=embeddings_model)
-
-# Récupérer tous les IDs existants dans la collection et les supprimer
-try:
-    # Récupérer les IDs
-    existing_docs = collection.get()
-    existing_ids = existing_docs['ids']
-
-    # Supprimer les documents par ID si la collection n'est pas vide
-    if existing_ids:
-        collection.delete(ids=existing_ids)
-        logging.info("Tous les documents existants ont été supprimés (%d documents).", len(existing_ids))
-    else:
-        logging.info("Aucun document à supprimer, la collection est déjà vide.")
-except Exception as e:
-    logging.error("Erreur lors de la suppression des documents : %s", str(e))
-
-# Ajouter les nouveaux documents avec leurs embeddings
-try:
-    for i, doc in enumerate(documents):
-        # Génération d'un ID unique pour chaque document
-        doc_id = f"doc_{i}"
-        
-        # Ajouter le document à la collection
-        collection.add(
-            documents=[doc.page_content],
-            metadatas=[doc.metadata],
-            ids=[doc_id]
-        )
-
-    # Persister la base de données
-    logging.info("Sauvegardé %d morceaux dans la base de données", len(documents))
-
-except Exception as e:
-    logging.error("Erreur lors de l'initialisation de Chroma : %s", str(e))
-
-# Requête de test
-results = collection.query(
-    query_texts=["This is a query document about hawaii"], # Chroma will embed this for you
-    n_results=3 # Nombre de résultats à retourner
-)
-
-# Construction du contexte
-context = "\n\n----\n\n".join(doc for doc in results['documents'][0])
-print("context:", context)
-print("results:", results)
\ No newline at end of file
+DOCS_FOLDER = 'docs'
+MANIFEST_PATH = os.getenv('INDEX_MANIFEST_PATH', 'save/docs_manifest.json')
+
+
+def file_hash(file_path):
+    """Empreinte SHA-256 du contenu d'un fichier."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest():
+    """Charge le manifeste (empreintes des fichiers et IDs de leurs morceaux), ou None."""
+    try:
+        with open(MANIFEST_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_manifest(manifest):
+    """Écrit le manifeste de façon atomique."""
+    os.makedirs(os.path.dirname(MANIFEST_PATH) or '.', exist_ok=True)
+    tmp_path = MANIFEST_PATH + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, MANIFEST_PATH)
+
+
+def source_name(relative_path):
+    """Nom de source d'un fichier de docs/ dans la table des liens morceau → source."""
+    return f"{DOCS_FOLDER}/{relative_path}"
+
+
+def chunk_file(file_path):
+    """Découpe un fichier en morceaux (id, texte, métadonnées), sans doublon d'ID."""
+    chunks = {}
+    for doc in load_document_file(file_path):
+        chunks.setdefault(chunk_content_id(doc.page_content), (doc.page_content, doc.metadata))
+    return [(doc_id, content, metadata) for doc_id, (content, metadata) in chunks.items()]
+
+
+def sync(collection, full=False):
+    """Synchronise la collection avec le dossier docs/.
+
+    En mode incrémental, seuls les morceaux des fichiers nouveaux ou modifiés
+    sont calculés et insérés, et seuls les morceaux disparus sont supprimés.
+    Sans manifeste (premier lancement) ou avec `full`, la collection est vidée
+    puis reconstruite.
+
+    Les IDs étant dérivés du contenu, un morceau peut être partagé avec un
+    autre fichier ou une source uploadée : il n'est supprimé de la collection
+    que lorsqu'il n'est plus rattaché à aucune source.
+
+    Returns:
+        tuple: (morceaux ajoutés, morceaux supprimés)
+    """
+    catalog = get_source_catalog()
+    manifest = load_manifest()
+    if full or manifest is None:
+        for relative_path in (manifest or {"files": {}})["files"]:
+            catalog.unlink_chunks(source_name(relative_path))
+
+        # Récupérer tous les IDs existants dans la collection et les supprimer
+        existing_ids = collection.get(include=[])['ids']
+        if existing_ids:
+            delete_chunks(collection, existing_ids)
+            logging.info("Tous les documents existants ont été supprimés (%d documents).", len(existing_ids))
+        else:
+            logging.info("Aucun document à supprimer, la collection est déjà vide.")
+        manifest = {"files": {}}
+
+    previous_files = manifest["files"]
+    current_files = {}
+    to_add = []
+    to_unlink = {}
+
+    for file_path in sorted(glob.glob(os.path.join(DOCS_FOLDER, '*.txt'))):
+        relative_path = os.path.relpath(file_path, DOCS_FOLDER)
+        digest = file_hash(file_path)
+        previous = previous_files.get(relative_path)
+
+        if previous and previous["hash"] == digest:
+            current_files[relative_path] = previous
+            catalog.link_chunks(source_name(relative_path), previous["chunks"])
+            continue
+
+        chunks = chunk_file(file_path)
+        new_ids = [chunk[0] for chunk in chunks]
+        old_ids = set(previous["chunks"]) if previous else set()
+
+        to_add.extend(chunk for chunk in chunks if chunk[0] not in old_ids)
+        to_unlink[relative_path] = list(old_ids - set(new_ids))
+        current_files[relative_path] = {"hash": digest, "chunks": new_ids}
+        catalog.link_chunks(source_name(relative_path), new_ids)
+        logging.info("%s : %s", relative_path, "modifié" if previous else "nouveau")
+
+    # Fichiers disparus du dossier
+    for relative_path, previous in previous_files.items():
+        if relative_path not in current_files:
+            to_unlink[relative_path] = None
+            logging.info("%s : supprimé", relative_path)
+
+    # Les nouveaux liens sont posés avant : un morceau déplacé d'un fichier à l'autre est conservé
+    to_delete = []
+    for relative_path, chunk_ids in to_unlink.items():
+        to_delete.extend(catalog.unlink_chunks(source_name(relative_path), chunk_ids))
+
+    if to_delete:
+        delete_chunks(collection, to_delete)
+
+    if to_add:
+        def report_progress(indexed, failed):
+            logging.info("Indexation : %d/%d morceaux (%d en échec)", indexed, len(to_add), failed)
+
+        BulkIndexer(collection, progress=report_progress, dedupe=True).index(to_add)
+
+    save_manifest({"files": current_files})
+    if to_add or to_delete:
+        bump_corpus_version()
+    return len(to_add), len(to_delete)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Synchronise la collection ChromaDB avec le dossier docs/.")
+    parser.add_argument('--full', action='store_true', help="Vider la collection et tout réindexer")
+    args = parser.parse_args()
+
+    # Connexion au client Chroma (inutile avec l'index vectoriel embarqué)
+    if VECTOR_BACKEND == 'chroma':
+        client = get_chroma_client()
+        logging.info("heartbeat %d", client.heartbeat())
+
+    # Création ou récupération d'une collection
+    collection = get_collection()
+
+    try:
+        added, deleted = sync(collection, full=args.full)
+        logging.info("Synchronisation terminée : %d morceaux ajoutés, %d supprimés", added, deleted)
+    except Exception as e:
+        logging.error("Erreur lors de l'initialisation de Chroma : %s", str(e))
+
+    # Requête de test
+    results = collection.query(
+        query_texts=["This is a query document about hawaii"], # Chroma will embed this for you
+        n_results=3 # Nombre de résultats à retourner
+    )
+
+    # Construction du contexte
+    context = "\n\n----\n\n".join(doc for doc in results['documents'][0])
+    print("context:", context)
+    print("results:", results)
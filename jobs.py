@@ -0,0 +1,272 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, Optional
+
+from db import get_connection
+from metrics import span, JOBS
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    stage TEXT,
+    payload TEXT NOT NULL,
+    progress TEXT NOT NULL DEFAULT '{}',
+    result TEXT,
+    error TEXT,
+    worker TEXT,
+    lease_until REAL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at);
+"""
+
+# Statuts d'une tâche
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Colonnes ajoutées après la création de la table
+LEASE_COLUMNS = {"worker": "TEXT", "lease_until": "REAL"}
+
+# Identifiant de ce processus : une tâche réservée porte le jeton du processus qui la traite
+PROCESS_TOKEN = uuid.uuid4().hex
+# Durée, en secondes, du bail d'une tâche : renouvelé tant que son processus tourne
+JOB_LEASE = float(os.getenv('JOB_LEASE', 60))
+# Tâche en cours dont le bail a expiré : son processus s'est arrêté, elle peut être reprise
+EXPIRED_LEASE = "status = ? AND (worker IS NULL OR worker != ?) AND (lease_until IS NULL OR lease_until < ?)"
+
+# Fonctions de traitement, par type de tâche
+_handlers: Dict[str, Callable] = {}
+
+
+def job_handler(kind: str):
+    """Décorateur enregistrant la fonction qui traite les tâches d'un type donné.
+
+    La fonction reçoit (payload, job) et retourne un résultat sérialisable en JSON ;
+    `job` permet de publier l'étape et la progression.
+    """
+    def register(func):
+        _handlers[kind] = func
+        return func
+    return register
+
+
+def _now() -> str:
+    return datetime.now().isoformat()
+
+
+class Job:
+    """Tâche en cours d'exécution : publie son étape et sa progression."""
+
+    def __init__(self, queue: 'JobQueue', job_id: str):
+        self.queue = queue
+        self.id = job_id
+        self._progress = {}
+        self._lock = threading.Lock()
+
+    def stage(self, stage: str) -> None:
+        """Change l'étape affichée (ex. extraction, indexation, sauvegarde)."""
+        self.queue._update(self.id, stage=stage)
+
+    def progress(self, **counters) -> None:
+        """Met à jour les compteurs de progression (ex. pages=12, chunks=340)."""
+        with self._lock:
+            if all(self._progress.get(key) == value for key, value in counters.items()):
+                return
+            self._progress.update(counters)
+            progress = json.dumps(self._progress)
+        self.queue._update(self.id, progress=progress)
+
+    def save_payload(self, payload: Dict) -> None:
+        """Enregistre le payload modifié : une reprise de la tâche repartira de cet état."""
+        self.queue._update(self.id, payload=json.dumps(payload, ensure_ascii=False))
+
+
+class JobQueue:
+    """File de tâches d'ingestion persistée dans SQLite et traitée par un pool borné.
+
+    Une tâche est enregistrée avant d'être confiée au pool : si le processus
+    s'arrête, les tâches en attente ou interrompues sont reprises par `resume`.
+    Une tâche est réservée atomiquement avant son exécution, de sorte que
+    plusieurs workers partageant la base ne la traitent jamais deux fois.
+    La réservation porte le jeton du processus et un bail renouvelé
+    périodiquement : une tâche dont le bail a expiré appartient à un
+    processus arrêté, quelle que soit la machine ou le conteneur. Le thread
+    de renouvellement reprend ces tâches sans attendre un redémarrage.
+    """
+
+    def __init__(self, path: str, workers: int = 2):
+        """
+        Args:
+            path: Chemin du fichier SQLite des tâches
+            workers: Nombre maximum de tâches traitées en parallèle
+        """
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='ingest')
+        self._reclaimed = set()
+        self._reclaimed_lock = threading.Lock()
+        self._migrate()
+        threading.Thread(target=self._heartbeat, name='jobs-heartbeat', daemon=True).start()
+
+    def _connect(self):
+        return get_connection(self.path)
+
+    def _migrate(self) -> None:
+        connection = self._connect()
+        connection.executescript(SCHEMA)
+        columns = {row["name"] for row in connection.execute("PRAGMA table_info(jobs)")}
+        with connection:
+            for name, definition in LEASE_COLUMNS.items():
+                if name not in columns:
+                    connection.execute(f"ALTER TABLE jobs ADD COLUMN {name} {definition}")
+
+    def _heartbeat(self) -> None:
+        """Renouvelle le bail des tâches traitées par ce processus et reprend celles dont le bail a expiré."""
+        while True:
+            time.sleep(JOB_LEASE / 3)
+            try:
+                connection = self._connect()
+                with connection:
+                    connection.execute(
+                        "UPDATE jobs SET lease_until = ? WHERE worker = ? AND status = ?",
+                        (time.time() + JOB_LEASE, PROCESS_TOKEN, RUNNING)
+                    )
+                self._reclaim()
+            except Exception as e:
+                logger.error("Erreur lors du renouvellement des baux : %s", str(e))
+
+    def _reclaim(self) -> None:
+        job_ids = [row["id"] for row in self._connect().execute(
+            f"SELECT id FROM jobs WHERE {EXPIRED_LEASE} ORDER BY created_at",
+            (RUNNING, PROCESS_TOKEN, time.time())
+        )]
+        with self._reclaimed_lock:
+            # Une tâche déjà confiée au pool n'y est pas remise à chaque passage
+            job_ids = [job_id for job_id in job_ids if job_id not in self._reclaimed]
+            self._reclaimed.update(job_ids)
+        for job_id in job_ids:
+            logger.warning("Bail expiré, reprise de la tâche %s", job_id)
+            self._executor.submit(self._run, job_id)
+
+    def submit(self, kind: str, payload: Dict) -> str:
+        """Enregistre une tâche et la confie au pool.
+
+        Returns:
+            L'ID de la tâche
+        """
+        if kind not in _handlers:
+            raise ValueError(f"Type de tâche inconnu : {kind}")
+        job_id = uuid.uuid4().hex
+        now = _now()
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                "INSERT INTO jobs (id, kind, status, stage, payload, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, QUEUED, QUEUED, json.dumps(payload, ensure_ascii=False), now, now)
+            )
+        self._executor.submit(self._run, job_id)
+        logger.info("Tâche %s (%s) mise en file", job_id, kind)
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        """Retourne l'état d'une tâche, ou None si elle n'existe pas."""
+        row = self._connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            "id": row["id"],
+            "kind": row["kind"],
+            "status": row["status"],
+            "stage": row["stage"],
+            "progress": json.loads(row["progress"]),
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "error": row["error"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+
+    def resume(self) -> int:
+        """Reprend les tâches en attente et celles interrompues par l'arrêt de leur processus.
+
+        Une tâche en cours est interrompue lorsqu'elle appartient à un autre
+        processus et que son bail a expiré.
+
+        Returns:
+            Le nombre de tâches remises dans le pool
+        """
+        job_ids = [row["id"] for row in self._connect().execute(
+            f"SELECT id FROM jobs WHERE status = ? OR ({EXPIRED_LEASE}) ORDER BY created_at",
+            (QUEUED, RUNNING, PROCESS_TOKEN, time.time())
+        )]
+        for job_id in job_ids:
+            self._executor.submit(self._run, job_id)
+        if job_ids:
+            logger.info("%d tâches d'ingestion reprises", len(job_ids))
+        return len(job_ids)
+
+    def _claim(self, job_id: str) -> bool:
+        """Réserve une tâche en attente, ou en cours dont le bail a expiré."""
+        connection = self._connect()
+        with connection:
+            claimed = connection.execute(
+                "UPDATE jobs SET status = ?, worker = ?, lease_until = ?, updated_at = ? "
+                f"WHERE id = ? AND (status = ? OR ({EXPIRED_LEASE}))",
+                (RUNNING, PROCESS_TOKEN, time.time() + JOB_LEASE, _now(), job_id,
+                 QUEUED, RUNNING, PROCESS_TOKEN, time.time())
+            ).rowcount
+        return claimed == 1
+
+    def _update(self, job_id: str, **fields) -> None:
+        fields["updated_at"] = _now()
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        connection = self._connect()
+        with connection:
+            connection.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def _run(self, job_id: str) -> None:
+        with self._reclaimed_lock:
+            self._reclaimed.discard(job_id)
+        if not self._claim(job_id):
+            return
+        row = self._connect().execute("SELECT kind, payload FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        job = Job(self, job_id)
+        try:
+            with span('ingest', f'job_{row["kind"]}'):
+                result = _handlers[row["kind"]](json.loads(row["payload"]), job)
+            self._update(job_id, status=DONE, stage=DONE,
+                         result=json.dumps(result, ensure_ascii=False))
+            JOBS.labels(row["kind"], DONE).inc()
+            logger.info("Tâche %s terminée", job_id)
+        except Exception as e:
+            logger.error("Tâche %s en échec : %s", job_id, str(e))
+            JOBS.labels(row["kind"], FAILED).inc()
+            self._update(job_id, status=FAILED, error=str(e))
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    """Retourne la file de tâches partagée par le processus."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue(
+                os.getenv('JOBS_DB_PATH', 'save/jobs.db'),
+                workers=int(os.getenv('INGEST_WORKERS', 2))
+            )
+        return _queue
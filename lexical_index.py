@@ -0,0 +1,240 @@
+import argparse
+import logging
+import math
+import os
+import re
+import threading
+import unicodedata
+from collections import Counter
+from typing import List, Tuple
+
+from db import get_connection
+
+logger = logging.getLogger(__name__)
+
+LEXICAL_INDEX_PATH = os.getenv('LEXICAL_INDEX_PATH', 'save/lexical')
+# Part maximale des morceaux contenant un terme : au-delà, il est ignoré s'il reste des termes plus rares
+LEXICAL_MAX_DF = float(os.getenv('LEXICAL_MAX_DF', 0.5))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    chunk_id TEXT PRIMARY KEY,
+    length INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT NOT NULL,
+    chunk_id TEXT NOT NULL,
+    tf INTEGER NOT NULL,
+    PRIMARY KEY (term, chunk_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_postings_chunk ON postings (chunk_id);
+CREATE TABLE IF NOT EXISTS stats (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+# Mots trop fréquents pour départager les morceaux
+STOPWORDS = frozenset("""
+a au aux avec ce ces cet cette dans de des du elle elles en est et il ils je la le les leur leurs
+lui ma mais me mes mon ne nos notre nous on ou par pas pour qu que qui sa se ses son sont sur ta
+te tes ton tu un une vos votre vous y c d j l m n s t the of and to in is for on
+""".split())
+
+_TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def fold_words(text: str) -> List[str]:
+    """Mots d'un texte, en minuscules et sans accents."""
+    normalized = unicodedata.normalize("NFKD", text.lower())
+    return _TOKEN_PATTERN.findall("".join(c for c in normalized if not unicodedata.combining(c)))
+
+
+def tokenize(text: str) -> List[str]:
+    """Découpe un texte en termes : minuscules, sans accents, sans mots vides.
+
+    Les nombres sont gardés quelle que soit leur longueur (numéros d'articles).
+    """
+    return [
+        token for token in fold_words(text)
+        if token not in STOPWORDS and (len(token) > 1 or token.isdigit())
+    ]
+
+
+class LexicalIndex:
+    """Index inversé BM25 des morceaux, stocké dans SQLite.
+
+    Il est tenu à jour à l'indexation, à côté du stockage vectoriel, et
+    partage ses IDs de morceaux. Un morceau ne change jamais de contenu (son
+    ID en dépend) : l'ajouter une seconde fois ne fait rien.
+    """
+
+    def __init__(self, path: str, k1: float = 1.2, b: float = 0.75):
+        """
+        Args:
+            path: Chemin du fichier SQLite de l'index
+            k1: Saturation de la fréquence des termes
+            b: Poids de la normalisation par la longueur des morceaux
+        """
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        return get_connection(self.path)
+
+    def add(self, chunk_ids: List[str], texts: List[str]) -> int:
+        """Indexe des morceaux ; ceux déjà présents sont ignorés.
+
+        Returns:
+            Le nombre de morceaux ajoutés
+        """
+        connection = self._connect()
+        with connection:
+            existing = set()
+            for i in range(0, len(chunk_ids), 500):
+                part = chunk_ids[i:i + 500]
+                existing.update(row["chunk_id"] for row in connection.execute(
+                    f"SELECT chunk_id FROM chunks WHERE chunk_id IN ({','.join('?' * len(part))})", part
+                ))
+
+            added = 0
+            total_length = 0
+            for chunk_id, text in zip(chunk_ids, texts):
+                if chunk_id in existing:
+                    continue
+                existing.add(chunk_id)
+                terms = Counter(tokenize(text))
+                length = sum(terms.values())
+                connection.execute("INSERT INTO chunks (chunk_id, length) VALUES (?, ?)", (chunk_id, length))
+                connection.executemany(
+                    "INSERT INTO postings (term, chunk_id, tf) VALUES (?, ?, ?)",
+                    [(term, chunk_id, tf) for term, tf in terms.items()]
+                )
+                added += 1
+                total_length += length
+
+            if added:
+                self._update_stats(connection, added, total_length)
+        return added
+
+    def remove(self, chunk_ids: List[str]) -> None:
+        """Retire des morceaux de l'index."""
+        connection = self._connect()
+        with connection:
+            for i in range(0, len(chunk_ids), 500):
+                part = chunk_ids[i:i + 500]
+                placeholders = ','.join('?' * len(part))
+                removed, total_length = connection.execute(
+                    f"SELECT COUNT(*), COALESCE(SUM(length), 0) FROM chunks WHERE chunk_id IN ({placeholders})", part
+                ).fetchone()
+                connection.execute(f"DELETE FROM postings WHERE chunk_id IN ({placeholders})", part)
+                connection.execute(f"DELETE FROM chunks WHERE chunk_id IN ({placeholders})", part)
+                if removed:
+                    self._update_stats(connection, -removed, -total_length)
+
+    def clear(self) -> None:
+        """Vide l'index."""
+        connection = self._connect()
+        with connection:
+            connection.execute("DELETE FROM postings")
+            connection.execute("DELETE FROM chunks")
+            connection.execute("DELETE FROM stats")
+
+    def count(self) -> int:
+        """Nombre de morceaux indexés."""
+        return self._stats(self._connect())[0]
+
+    def search(self, query: str, limit: int = 20) -> List[Tuple[str, float]]:
+        """Classe les morceaux par score BM25 pour une requête.
+
+        Le score est calculé et trié par SQLite. Un terme présent dans plus de
+        `LEXICAL_MAX_DF` des morceaux départage peu et parcourt presque tout
+        l'index : il est ignoré quand la requête contient des termes plus rares.
+
+        Returns:
+            Liste de tuples (ID du morceau, score), du plus pertinent au moins pertinent
+        """
+        connection = self._connect()
+        chunk_count, total_length = self._stats(connection)
+        terms = sorted(set(tokenize(query)))
+        if not chunk_count or not terms:
+            return []
+        average_length = total_length / chunk_count
+
+        # Nombre de morceaux contenant chaque terme, lu sur l'index des postings
+        document_frequencies = dict(connection.execute(
+            f"SELECT term, COUNT(*) FROM postings WHERE term IN ({','.join('?' * len(terms))}) GROUP BY term",
+            terms
+        ).fetchall())
+        if not document_frequencies:
+            return []
+        rare = {term: df for term, df in document_frequencies.items() if df <= LEXICAL_MAX_DF * chunk_count}
+        weights = [
+            (term, math.log(1 + (chunk_count - df + 0.5) / (df + 0.5)))
+            for term, df in (rare or document_frequencies).items()
+        ]
+
+        rows = connection.execute(
+            f"WITH query (term, idf) AS (VALUES {', '.join('(?, ?)' for _ in weights)}) "
+            "SELECT p.chunk_id, SUM(q.idf * p.tf * ? / (p.tf + ? * (1 - ? + ? * c.length / ?))) AS score "
+            "FROM query q JOIN postings p ON p.term = q.term JOIN chunks c ON c.chunk_id = p.chunk_id "
+            "GROUP BY p.chunk_id ORDER BY score DESC LIMIT ?",
+            (*[value for weight in weights for value in weight],
+             self.k1 + 1, self.k1, self.b, self.b, average_length, limit)
+        ).fetchall()
+        return [(row["chunk_id"], row["score"]) for row in rows]
+
+    def _stats(self, connection) -> Tuple[int, int]:
+        stats = dict(connection.execute("SELECT key, value FROM stats").fetchall())
+        return stats.get("chunks", 0), stats.get("length", 0)
+
+    def _update_stats(self, connection, chunks: int, length: int) -> None:
+        connection.executemany(
+            "INSERT INTO stats (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+            [("chunks", chunks), ("length", length)]
+        )
+
+    def rebuild(self, collection, page_size: int = 1000) -> int:
+        """Reconstruit l'index à partir des documents de la collection.
+
+        Returns:
+            Le nombre de morceaux indexés
+        """
+        self.clear()
+        indexed = 0
+        offset = 0
+        while True:
+            page = collection.get(include=["documents"], limit=page_size, offset=offset)
+            if not page["ids"]:
+                break
+            indexed += self.add(page["ids"], [document or "" for document in page["documents"]])
+            offset += len(page["ids"])
+        logger.info("Index lexical reconstruit : %d morceaux", indexed)
+        return indexed
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_lexical_index(collection_name: str) -> LexicalIndex:
+    """Retourne l'index lexical associé à une collection, partagé par le processus."""
+    with _indexes_lock:
+        index = _indexes.get(collection_name)
+        if index is None:
+            index = LexicalIndex(os.path.join(LEXICAL_INDEX_PATH, f"{collection_name}.db"))
+            _indexes[collection_name] = index
+        return index
+
+
+if __name__ == '__main__':
+    from registry import get_collection
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Reconstruit l'index lexical BM25 à partir de la collection.")
+    parser.parse_args()
+
+    collection = get_collection()
+    get_lexical_index(collection.name).rebuild(collection)
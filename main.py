@@ -1,10 +1,15 @@
 from flask import Blueprint, jsonify, request, Response
 import logging
-from openai import OpenAI
-from chromadb.utils import embedding_functions
-import os
-import chromadb
-from storage import save_discussion, get_discussions_history, delete_discussion,append_message_to_discussion
+from storage import save_discussion, get_discussions_page, get_discussion, delete_discussion,append_message_to_discussion
+from cache import query_embedding_cache, answer_cache, make_cache_key
+from registry import get_openai_client, get_embedding_function, get_collection
+from retrieval import retrieve
+from prompt import build_prompt, count_tokens
+from metrics import (Trace, ASK_REQUESTS, COMPLETION_TOKENS, PROMPT_DROPPED, PROMPT_TOKENS,
+                     RETRIEVAL_CHUNKS, RETRIEVAL_DISTANCE, render_metrics)
+from sessions import get_session_manager
+from discussion_store import discussion_id_from_path
+from singleflight import SINGLE_FLIGHT, SINGLE_FLIGHT_WAIT, ask_flights
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -15,15 +20,247 @@ logger = logging.getLogger(__name__)
 # Création d'un blueprint Flask pour le module principal
 main = Blueprint('main', __name__)
 
-# Initialisation du client OpenAI
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
 
-# Définition du chemin pour la base de données Chroma
-# Configuration du client Chroma
-chroma_host = os.getenv('CHROMA_DB_HOST', 'localhost')  
-chroma_port = os.getenv('CHROMA_DB_PORT', 8000) 
-chroma_client = chromadb.HttpClient(host=chroma_host, port=chroma_port)
-embeddings_model = embedding_functions.OpenAIEmbeddingFunction(model_name="text-embedding-3-small", api_key=os.getenv('OPENAI_API_KEY'))
+def get_query_embedding(question):
+    """Retourne l'embedding de la question, depuis le cache si possible.
+
+    Args:
+        question: La question de l'utilisateur
+
+    Returns:
+        list: L'embedding de la question
+    """
+    provider = get_embedding_function()
+    embedding = query_embedding_cache.get(question, provider.model_name)
+    if embedding is not None:
+        logger.info("Embedding de la question trouvé en cache.")
+        return embedding
+
+    embedding = [float(value) for value in provider.embed([question])[0]]
+    query_embedding_cache.set(question, provider.model_name, embedding)
+    return embedding
+
+
+BASE_INSTRUCTIONS = """
+        Tu es Lexica, un assistant bienveillant qui vouvoie toujours et répond avec joie.
+        Ton créateur est Pharci Un ingénieur en Inteligence artificielle.
+        Tu fournis uniquement des réponses basées sur tes connaissances. 
+        Si une question dépasse tes connaissances, tu l'indiques gentiment. 
+        Tu n'as pas toujours besoin du contexte trouvé, si tu as des informations mais qu'on te parle naturellement tu parles naturellement aussi.
+        Tu réponds toujours avec du markdown tres stylisé et organisé avec toutes sortes de balises afin de rendre le texte agreables.
+        Ton but principale est d'aider les utilisateur grace à ta source de connaissance.
+        """
+
+# 💥 Seuil de similarité
+SEUIL = 1
+
+CHAT_MODEL = "gpt-4o-mini"
+ERROR_MESSAGE = "Une erreur est survenue lors du traitement."
+
+
+def validate_question(data):
+    """Vérifie le body JSON d'une requête /ask.
+
+    Args:
+        data: Le body JSON de la requête
+
+    Returns:
+        tuple: (question, message d'erreur ou None)
+    """
+    if not data or 'question' not in data:
+        return None, "Aucune question fournie."
+
+    question = data.get('question')
+    if not question.strip():
+        return None, "La question ne peut pas être vide."
+
+    return question, None
+
+
+def load_history(data):
+    """Historique de la conversation à envoyer au modèle.
+
+    Un client qui envoie encore `messages` est servi comme avant. Sinon,
+    l'historique vient de la session côté serveur de la discussion `filename` :
+    résumé glissant des anciens messages et derniers échanges.
+
+    Args:
+        data: Le body JSON de la requête
+
+    Returns:
+        tuple: (résumé ou None, messages user/assistant du plus ancien au plus récent)
+    """
+    if "messages" in data and isinstance(data["messages"], list):
+        # ⚠️ On garde uniquement les rôles user/assistant
+        return None, [msg for msg in data["messages"] if msg.get("role") in ("user", "assistant")]
+
+    discussion_path = data.get('filename')
+    if not discussion_path:
+        return None, []
+    try:
+        return get_session_manager().history(discussion_id_from_path(discussion_path))
+    except Exception as e:
+        logger.error("Erreur lors du chargement de la session %s : %s", discussion_path, str(e))
+        return None, []
+
+
+def prepare_prompt(question, data, results, history=None):
+    """Filtre les résultats de ChromaDB et prépare les messages envoyés au modèle.
+
+    Le prompt est assemblé dans le budget de tokens de `prompt.build_prompt` :
+    les morceaux et les messages d'historique qui n'y tiennent pas sont écartés.
+
+    Args:
+        question: La question de l'utilisateur
+        data: Le body JSON de la requête (pour l'historique, voir `load_history`)
+        results: Les résultats de `retrieval.retrieve` (format de `collection.query`)
+        history: Historique déjà chargé par `load_history`, sinon il est chargé ici
+
+    Returns:
+        dict: messages, context, filenames, source_ids, has_history et prompt_report
+    """
+    ids = results.get('ids', [[]])[0]
+    documents = results.get('documents', [[]])[0]
+    metadatas = results.get('metadatas', [[]])[0]
+    distances = results.get('distances', [[]])[0]
+
+    # 🔍 Filtrage des résultats pertinents
+    filtered_ids = []
+    filtered_docs = []
+    filtered_metas = []
+
+    for doc_id, doc, meta, dist in zip(ids, documents, metadatas, distances):
+        # Distance absente : morceau trouvé par la recherche lexicale seule
+        if dist is None:
+            RETRIEVAL_CHUNKS.labels("lexical").inc()
+        else:
+            RETRIEVAL_DISTANCE.observe(dist)
+        if dist is None or dist < SEUIL:
+            filtered_ids.append(doc_id)
+            filtered_docs.append(doc)
+            filtered_metas.append(meta)
+        else:
+            RETRIEVAL_CHUNKS.labels("filtered").inc()
+
+    # 🔹 Gestion de l’historique
+    summary, history = history if history is not None else load_history(data)
+
+    # 💬 Assemblage du prompt dans le budget de tokens (contexte classé, historique récent d'abord)
+    prompt = build_prompt(BASE_INSTRUCTIONS, filtered_docs, history, question, summary=summary)
+    kept_ids = [filtered_ids[i] for i in prompt["chunk_indices"]]
+    kept_metas = [filtered_metas[i] for i in prompt["chunk_indices"]]
+    record_prompt_metrics(prompt["report"], len(kept_ids))
+
+    if kept_ids:
+            filenames = list({meta.get('filename') for meta in kept_metas if meta and meta.get('filename')})
+            logger.info("Contexte trouvé: %s", prompt["context"][:200] + "...")
+    else:
+            filenames = []
+            logger.info("Aucun contexte assez pertinent trouvé, Lexica répondra sans.")
+
+    return {
+        "messages": prompt["messages"],
+        "context": prompt["context"],
+        "filenames": filenames,
+        "source_ids": kept_ids,
+        "has_history": bool(prompt["history"]) or bool(summary),
+        "prompt_report": prompt["report"],
+    }
+
+
+def record_prompt_metrics(report, kept_chunks):
+    """Exporte la taille du prompt et ce que le budget de tokens en a écarté."""
+    RETRIEVAL_CHUNKS.labels("kept").inc(kept_chunks)
+    PROMPT_TOKENS.labels("total").observe(report["tokens"])
+    PROMPT_TOKENS.labels("context").observe(report["context_tokens"])
+    PROMPT_TOKENS.labels("history").observe(report["history_tokens"])
+    PROMPT_DROPPED.labels("chunks").inc(len(report["dropped_chunks"]))
+    PROMPT_DROPPED.labels("messages").inc(report["dropped_messages"])
+
+
+def answer_outcome(cached, failed, coalesced=False):
+    """Issue d'une question pour les métriques : failed, coalesced, cached ou answered."""
+    if failed:
+        return "failed"
+    if coalesced:
+        return "coalesced"
+    return "cached" if cached else "answered"
+
+
+def finish_ask_trace(trace, full_response, cached, failed, coalesced=False):
+    """Clôt les mesures d'une question une fois la réponse sauvegardée."""
+    outcome = answer_outcome(cached, failed, coalesced)
+    ASK_REQUESTS.labels(outcome).inc()
+    if outcome == "answered":
+        COMPLETION_TOKENS.observe(count_tokens(full_response))
+    trace.finish(outcome=outcome)
+
+
+def replay_answer(text, size=64):
+    """Découpe une réponse en cache en morceaux pour la restituer en streaming."""
+    for i in range(0, len(text), size):
+        yield text[i:i + size]
+
+
+# En-têtes CORS des réponses de /ask (aussi ajoutés aux erreurs du mode ASGI, hors flask_cors)
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "https://lexica.pharci.fr",  # PAS "*"
+    "Access-Control-Allow-Headers": "X-Used-Filenames, Content-Type",
+    "Access-Control-Expose-Headers": "X-Used-Filenames",  # 💥 pour que le frontend puisse lire ce header
+    "Access-Control-Allow-Credentials": "true",
+}
+
+
+def stream_headers(filenames):
+    """En-têtes de la réponse streamée de /ask."""
+    return {
+        "Cache-Control": "no-cache, no-store, must-revalidate",
+        **CORS_HEADERS,
+        "X-Used-Filenames": "||".join(filenames)
+    }
+
+
+def save_answer(question, discussion_path, prompt, query_embedding, full_response, cached, failed):
+    """Persiste la réponse une fois le streaming terminé et alimente le cache des réponses."""
+    append_message_to_discussion(discussion_path, {"type": "assistant", "content": full_response})
+    save_discussion(question, full_response, prompt["context"])
+    if not prompt["has_history"] and not cached and not failed:
+        answer_cache.store(query_embedding, prompt["source_ids"], full_response, prompt["filenames"])
+
+
+def is_history_less(history):
+    """Vrai si la question n'a ni résumé ni messages précédents (réponse partageable)."""
+    summary, messages = history
+    return not summary and not messages
+
+
+def follow_flight(trace, question, discussion_path, flight):
+    """Répond à une question identique à une autre en cours en suivant sa réponse.
+
+    La réponse est relue depuis le début puis suivie au fil de sa génération,
+    et sauvegardée dans la discussion de cette requête.
+    """
+    with trace.span('save_question'):
+        append_message_to_discussion(discussion_path, {"type": "user", "content": question})
+
+    def stream_with_save():
+        full_response = ""
+        for chunk in flight.replay():
+            if not full_response:
+                trace.record('ttft', trace.since_start())
+            full_response += chunk
+            yield chunk
+        failed = flight.failed
+        with trace.span('save_answer'):
+            save_answer(question, discussion_path, {"context": flight.context, "has_history": False},
+                        None, full_response, True, failed)
+        finish_ask_trace(trace, full_response, True, failed, coalesced=True)
+
+    return Response(
+            stream_with_save(),
+            content_type="text/plain",
+            headers=stream_headers(flight.filenames)
+    )
 
 
 @main.route('/health')
@@ -31,6 +268,12 @@ def health_check():
     """Endpoint de vérification de la santé de l'API."""
     return jsonify({"status": "healthy", "message": "API is running"}), 200
 
+@main.route('/metrics')
+def metrics_endpoint():
+    """Métriques Prometheus : durées des étapes, tokens, distances, ingestion."""
+    content, content_type = render_metrics()
+    return Response(content, content_type=content_type)
+
 @main.route('/ask', methods=['POST'])
 def ask():
     """Traite les demandes de questions de l'utilisateur.
@@ -38,157 +281,148 @@ def ask():
     Returns:
         Response: Réponse générée par l'API OpenAI ou un message d'erreur.
     """
+    trace = Trace('ask')
+    flight, flight_key, leader = None, None, False
     try:
         # Récupérer la question depuis le body JSON
         data = request.get_json()
-        if not data or 'question' not in data:
-            return jsonify({"error": "Aucune question fournie."}), 400
-
-        question = data.get('question')
-        if not question.strip():
-            return jsonify({"error": "La question ne peut pas être vide."}), 400
+        question, error = validate_question(data)
+        if error:
+            return jsonify({"error": error}), 400
 
         discussion_path = data.get('filename')
         logger.info(f"Question reçue: {question}")
 
-        base_instructions = """
-        Tu es Lexica, un assistant bienveillant qui vouvoie toujours et répond avec joie.
-        Ton créateur est Pharci Un ingénieur en Inteligence artificielle.
-        Tu fournis uniquement des réponses basées sur tes connaissances. 
-        Si une question dépasse tes connaissances, tu l'indiques gentiment. 
-        Tu n'as pas toujours besoin du contexte trouvé, si tu as des informations mais qu'on te parle naturellement tu parles naturellement aussi.
-        Tu réponds toujours avec du markdown tres stylisé et organisé avec toutes sortes de balises afin de rendre le texte agreables.
-        Ton but principale est d'aider les utilisateur grace à ta source de connaissance.
-        """
+        # 🔹 Historique de la discussion (résumé glissant et derniers échanges)
+        history = load_history(data)
+
+        # 🔹 Une question identique sans historique est déjà en cours : on suit sa réponse
+        if SINGLE_FLIGHT and is_history_less(history):
+            flight_key = make_cache_key(question, CHAT_MODEL)
+            flight, leader = ask_flights.join(flight_key)
+            if not leader:
+                if flight.wait_start(SINGLE_FLIGHT_WAIT):
+                    return follow_flight(trace, question, discussion_path, flight)
+                flight = None
 
         # Recherche dans ChromaDB
-        collection = chroma_client.get_or_create_collection(
-            name="Documents", 
-            embedding_function=embeddings_model
-        )
+        collection = get_collection()
 
-        results = collection.query(
-            query_texts=[question],
-            n_results=5
-        )
+        with trace.span('embedding'):
+            query_embedding = get_query_embedding(question)
+        with trace.span('retrieval'):
+            results = retrieve(collection, question, query_embedding, n_results=5)
 
-        documents = results.get('documents', [[]])[0]
-        metadatas = results.get('metadatas', [[]])[0]
-        distances = results.get('distances', [[]])[0]
-
-        # 💥 Seuil de similarité
-        seuil = 1
-
-        # 🔍 Filtrage des résultats pertinents
-        filtered_docs = []
-        filtered_metas = []
-
-        for doc, meta, dist in zip(documents, metadatas, distances):
-            print(dist)
-            if dist < seuil:
-                filtered_docs.append(doc)
-                filtered_metas.append(meta)
-
-        # 💬 Préparation du contexte uniquement si au moins un document pertinent
-        # Préparer les messages
-        messages = []
-
-        # 🔹 Ajouter le contexte au prompt system
-        if filtered_docs:
-                context = "\n\n----\n\n".join(filtered_docs)
-                filenames = list({meta.get('filename') for meta in filtered_metas if meta.get('filename')})
-                logger.info("Contexte trouvé: %s", context[:200] + "...")
-                context_with_instructions = base_instructions + "\n\nConnaissances :\n" + context
-        else:
-                context = ""
-                filenames = []
-                logger.info("Aucun contexte assez pertinent trouvé, Lexica répondra sans.")
-                context_with_instructions = base_instructions
-
-        # 🔹 Ajout du message syst
-        messages.append({"role": "system", "content": context_with_instructions})
-
-        # 🔹 Gestion de l’historique
-        if "messages" in data and isinstance(data["messages"], list):
-                previous_messages = data["messages"]
-        
-            # ⚠️ On garde uniquement les rôles user/assistant
-                for msg in previous_messages:
-                    if msg["role"] in ("user", "assistant"):
-                            messages.append(msg)
-
-        # 🔹 Ajouter la nouvelle question
-        messages.append({"role": "user", "content": question})
+        with trace.span('prompt'):
+            prompt = prepare_prompt(question, data, results, history)
+        messages = prompt["messages"]
 
         # 🔹 Sauvegarder la question
-        append_message_to_discussion(discussion_path, {"type": "user", "content": question})
+        with trace.span('save_question'):
+            append_message_to_discussion(discussion_path, {"type": "user", "content": question})
+
+        # 🔹 Cache sémantique des réponses, uniquement sans historique
+        cached_answer = None
+        if not prompt["has_history"]:
+            cached_answer = answer_cache.lookup(query_embedding, prompt["source_ids"])
+            if cached_answer is not None:
+                prompt["filenames"] = cached_answer[1]
 
         # 🔹 Pour stocker la réponse de l’assistant
         full_response = ""
+        failed = False
 
         # 🔹 Streaming
         def generate():
-            nonlocal full_response
+            nonlocal full_response, failed
+            if cached_answer is not None:
+                full_response = cached_answer[0]
+                yield from replay_answer(full_response)
+                return
+
             try:
-                stream = client.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=messages,
-                    stream=True,
-                )
-
-                for chunk in stream:
-                    if chunk.choices[0].delta.content:
-                        content = chunk.choices[0].delta.content
-                        full_response += content
-                        yield content
+                with trace.span('generation'):
+                    stream = get_openai_client().chat.completions.create(
+                        model=CHAT_MODEL,
+                        messages=messages,
+                        stream=True,
+                    )
+
+                    for chunk in stream:
+                        if chunk.choices[0].delta.content:
+                            content = chunk.choices[0].delta.content
+                            if not full_response:
+                                trace.record('ttft', trace.since_start())
+                            full_response += content
+                            yield content
 
             except Exception as e:
                 logger.error("Erreur modèle : %s", str(e))
-                error_message = "Une erreur est survenue lors du traitement."
-                full_response = error_message
-                save_discussion(question, error_message, context)
-                yield error_message
-
-        filename_header = "||".join(filenames)
+                full_response = ERROR_MESSAGE
+                failed = True
+                if leader:
+                    flight.fail()
+                yield ERROR_MESSAGE
+
+        # 🔹 Meneur : la génération est partagée avec les questions identiques qui arrivent
+        chunks = generate()
+        if leader:
+            flight.start(prompt["filenames"], prompt["context"])
+            ask_flights.launch(flight_key, flight, chunks)
+            chunks = flight.replay()
 
         # 🔹 On sauvegarde la réponse une fois générée
         def stream_with_save():
-                for chunk in generate():
+                for chunk in chunks:
                     yield chunk
-                append_message_to_discussion(discussion_path, {"type": "assistant", "content": full_response})
-                save_discussion(question, full_response, context)
+                with trace.span('save_answer'):
+                    save_answer(question, discussion_path, prompt, query_embedding,
+                                full_response, cached_answer is not None, failed)
+                finish_ask_trace(trace, full_response, cached_answer is not None, failed)
 
         return Response(
                 stream_with_save(),
                 content_type="text/plain",
-                headers={
-                    "Cache-Control": "no-cache, no-store, must-revalidate",
-                    "Access-Control-Allow-Origin": "https://lexica.pharci.fr",  # PAS "*"
-                    "Access-Control-Allow-Headers": "X-Used-Filenames, Content-Type",
-                    "Access-Control-Expose-Headers": "X-Used-Filenames",  # 💥 pour que le frontend puisse lire ce header
-                    "Access-Control-Allow-Credentials": "true",
-                    "X-Used-Filenames": filename_header
-                }
+                headers=stream_headers(prompt["filenames"])
         )
  
     except Exception as e:
         logger.error("Erreur lors de la recherche de similarité : %s", str(e))
+        if leader and not flight.started:
+            ask_flights.abandon(flight_key, flight)
+        ASK_REQUESTS.labels("error").inc()
         return jsonify({"error": "Erreur lors de la recherche de similarité."}), 500
 
 @main.route('/history/discussions', methods=['GET'])
 def get_discussions():
-    """Récupère l'historique des discussions."""
+    """Récupère l'historique des discussions (résumés uniquement, paginés par curseur)."""
     try:
-        limit = request.args.get('limit', 10, type=int)
-        discussions = get_discussions_history(limit)
+        limit = min(max(request.args.get('limit', 10, type=int), 1), 100)
+        cursor = request.args.get('cursor')
+        discussions, next_cursor = get_discussions_page(limit, cursor)
         return jsonify({
             "discussions": discussions,
-            "count": len(discussions)
+            "count": len(discussions),
+            "next_cursor": next_cursor
         }), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logger.error("Erreur lors de la récupération de l'historique : %s", str(e))
         return jsonify({"error": "Erreur lors de la récupération de l'historique"}), 500
 
+@main.route('/history/discussions/<discussion_id>', methods=['GET'])
+def get_discussion_endpoint(discussion_id):
+    """Récupère une discussion et ses messages."""
+    try:
+        discussion = get_discussion(discussion_id)
+        if discussion is None:
+            return jsonify({"error": "Discussion non trouvée"}), 404
+        return jsonify(discussion), 200
+    except Exception as e:
+        logger.error("Erreur lors de la récupération de la discussion : %s", str(e))
+        return jsonify({"error": "Erreur lors de la récupération de la discussion"}), 500
+
 @main.route('/history/discussions/<discussion_id>', methods=['DELETE'])
 def delete_discussion_endpoint(discussion_id):
     """Supprime une discussion."""
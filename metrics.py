@@ -0,0 +1,120 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Tuple
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess,
+)
+
+logger = logging.getLogger(__name__)
+
+# Avec plusieurs workers (gunicorn, uvicorn --workers), PROMETHEUS_MULTIPROC_DIR pointe vers un
+# dossier vide au démarrage, partagé par les workers : /metrics agrège alors tous les processus
+MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 2000, 3000, 4000, 6000, 8000, 16000)
+DISTANCE_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 1.25, 1.5, 2.0)
+
+STAGE_DURATION = Histogram(
+    'lexica_stage_duration_seconds', "Durée de chaque étape d'une question ou d'une ingestion",
+    ['pipeline', 'stage'], buckets=LATENCY_BUCKETS
+)
+ASK_REQUESTS = Counter('lexica_ask_requests', "Questions traitées, par issue", ['outcome'])
+PROMPT_TOKENS = Histogram(
+    'lexica_prompt_tokens', "Tokens du prompt envoyé au modèle, par partie", ['part'], buckets=TOKEN_BUCKETS
+)
+COMPLETION_TOKENS = Histogram('lexica_completion_tokens', "Tokens des réponses générées", buckets=TOKEN_BUCKETS)
+PROMPT_DROPPED = Counter('lexica_prompt_dropped', "Éléments écartés du prompt faute de budget", ['kind'])
+RETRIEVAL_DISTANCE = Histogram(
+    'lexica_retrieval_distance', "Distance vectorielle des morceaux retrouvés", buckets=DISTANCE_BUCKETS
+)
+RETRIEVAL_CHUNKS = Counter(
+    'lexica_retrieval_chunks', "Morceaux retrouvés : gardés, écartés par le seuil ou trouvés par BM25 seul",
+    ['result']
+)
+RETRIEVAL_CACHE = Counter('lexica_retrieval_cache', "Recherches servies par le cache ou par la base", ['result'])
+INGEST_CHUNKS = Counter('lexica_ingest_chunks', "Morceaux traités par l'indexation", ['result'])
+WRITE_QUEUE_DEPTH = Gauge(
+    'lexica_discussion_write_queue_depth', "Écritures de discussions en attente", multiprocess_mode='livesum'
+)
+DISCUSSION_WRITE_FAILURES = Counter(
+    'lexica_discussion_write_failures', "Écritures de discussions en échec, mises de côté pour être rejouées"
+)
+JOBS = Counter('lexica_jobs', "Tâches d'ingestion terminées, par type et statut", ['kind', 'status'])
+
+
+@contextmanager
+def span(pipeline: str, stage: str) -> Iterator[None]:
+    """Mesure la durée d'un bloc dans l'histogramme des étapes.
+
+    Utilisable aussi en décorateur : `@span('ingest', 'ingest_pdf')`.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_DURATION.labels(pipeline, stage).observe(time.perf_counter() - start)
+
+
+def timed_iter(iterable: Iterable, pipeline: str, stage: str) -> Iterator:
+    """Parcourt un itérable en mesurant le temps de production de chaque élément."""
+    iterator = iter(iterable)
+    histogram = STAGE_DURATION.labels(pipeline, stage)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        histogram.observe(time.perf_counter() - start)
+        yield item
+
+
+class Trace:
+    """Durées des étapes d'une requête, exportées en histogrammes et journalisées ensemble.
+
+    Une étape mesurée plusieurs fois cumule ses durées dans le journal.
+    """
+
+    def __init__(self, pipeline: str):
+        self.pipeline = pipeline
+        self.start = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def record(self, stage: str, seconds: float) -> None:
+        self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+        STAGE_DURATION.labels(self.pipeline, stage).observe(seconds)
+
+    def since_start(self) -> float:
+        return time.perf_counter() - self.start
+
+    def finish(self, **fields) -> None:
+        """Enregistre la durée totale et journalise toutes les étapes sur une ligne."""
+        self.record("total", self.since_start())
+        details = " ".join(f"{stage}={seconds * 1000:.1f}ms" for stage, seconds in self.spans.items())
+        extra = " ".join(f"{key}={value}" for key, value in fields.items())
+        logger.info("Étapes %s : %s %s", self.pipeline, details, extra)
+
+
+def render_metrics() -> Tuple[bytes, str]:
+    """Exposition des métriques au format texte Prometheus.
+
+    Returns:
+        tuple: (contenu, type MIME)
+    """
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
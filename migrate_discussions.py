@@ -0,0 +1,15 @@
+import argparse
+import logging
+
+from discussion_store import get_discussion_store, migrate_json_discussions
+
+logging.basicConfig(level=logging.INFO)
+
+# Migration des anciennes discussions JSON vers le stockage SQLite
+parser = argparse.ArgumentParser(description="Importe save/discussions/*.json dans le stockage des discussions.")
+parser.add_argument('--directory', default='save/discussions', help="Dossier des fichiers JSON à importer")
+parser.add_argument('--remove', action='store_true', help="Supprimer les fichiers JSON une fois importés")
+args = parser.parse_args()
+
+count = migrate_json_discussions(get_discussion_store(), args.directory, remove=args.remove)
+print(f"{count} discussions importées.")
@@ -0,0 +1,96 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import PyPDF2
+
+_executor = None
+_executor_workers = 0
+_executor_lock = threading.Lock()
+
+
+def extract_page_range(path, first, last):
+    """Extrait le texte des pages [first, last) d'un PDF, dans un processus du pool.
+
+    Args:
+        path: Chemin du fichier PDF
+        first: Index (à partir de 0) de la première page
+        last: Index de fin, exclu
+
+    Returns:
+        list: Tuples (numéro de page à partir de 1, texte ou None, erreur ou None)
+    """
+    reader = PyPDF2.PdfReader(path)
+    results = []
+    for index in range(first, last):
+        try:
+            results.append((index + 1, reader.pages[index].extract_text(), None))
+        except Exception as e:
+            results.append((index + 1, None, str(e)))
+    return results
+
+
+def get_executor(workers):
+    """Retourne le pool de processus d'extraction, créé au premier appel."""
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is None or _executor_workers != workers:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            # spawn : les processus n'héritent ni des threads ni des connexions du worker web
+            _executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            _executor_workers = workers
+        return _executor
+
+
+def iter_pages_parallel(stream, page_count, workers, pages_per_task=16):
+    """Extrait les pages d'un PDF en parallèle et les restitue dans l'ordre.
+
+    Les plages de pages sont réparties sur un pool de processus ; au plus
+    `2 * workers` plages sont en cours à la fois pour borner la mémoire.
+
+    Args:
+        stream: Flux binaire du PDF
+        page_count: Nombre de pages du PDF
+        workers: Nombre de processus d'extraction
+        pages_per_task: Nombre de pages par plage
+
+    Yields:
+        tuple: (numéro de page à partir de 1, texte ou None, erreur ou None)
+    """
+    path, temporary = _as_path(stream)
+    try:
+        executor = get_executor(workers)
+        ranges = [
+            (first, min(first + pages_per_task, page_count))
+            for first in range(0, page_count, pages_per_task)
+        ]
+        pending = []
+        next_range = 0
+        while next_range < len(ranges) or pending:
+            while next_range < len(ranges) and len(pending) < 2 * workers:
+                first, last = ranges[next_range]
+                pending.append(executor.submit(extract_page_range, path, first, last))
+                next_range += 1
+            yield from pending.pop(0).result()
+    finally:
+        if temporary:
+            os.remove(temporary)
+
+
+def _as_path(stream):
+    """Retourne un chemin lisible par les processus du pool, en copiant le flux si besoin."""
+    name = getattr(stream, 'name', None)
+    if isinstance(name, str) and os.path.isfile(name):
+        return name, None
+
+    stream.seek(0)
+    with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp:
+        shutil.copyfileobj(stream, tmp)
+    return tmp.name, tmp.name
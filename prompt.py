@@ -0,0 +1,152 @@
+import logging
+import os
+import threading
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Budget total du prompt (instructions, contexte, historique et question), en tokens
+PROMPT_MAX_TOKENS = int(os.getenv('PROMPT_MAX_TOKENS', 6000))
+# Part du budget réservée au contexte quand l'historique la réclame
+PROMPT_CONTEXT_TOKENS = int(os.getenv('PROMPT_CONTEXT_TOKENS', 3000))
+# En dessous de cette place restante, un morceau de contexte est écarté plutôt que tronqué
+PROMPT_MIN_CHUNK_TOKENS = int(os.getenv('PROMPT_MIN_CHUNK_TOKENS', 100))
+
+CONTEXT_HEADER = "\n\nConnaissances :\n"
+SUMMARY_HEADER = "\n\nRésumé de la conversation jusqu'ici :\n"
+CONTEXT_SEPARATOR = "\n\n----\n\n"
+
+# Coût fixe approximatif de chaque message dans le format de chat
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    """Tokenizer local (tiktoken) s'il est disponible, sinon None.
+
+    tiktoken télécharge l'encodage au premier usage puis le garde dans
+    TIKTOKEN_CACHE_DIR (préchargé par run.sh) : hors ligne et sans cache,
+    le nombre de tokens est estimé.
+    """
+    global _encoding
+    with _encoding_lock:
+        if _encoding is None:
+            try:
+                import tiktoken
+                _encoding = tiktoken.get_encoding(os.getenv('PROMPT_ENCODING', 'o200k_base'))
+            except Exception as e:
+                logger.info("tiktoken indisponible (%s), estimation du nombre de tokens", str(e))
+                _encoding = False
+        return _encoding or None
+
+
+def count_tokens(text: str) -> int:
+    """Nombre de tokens d'un texte (environ 4 caractères par token sans tiktoken)."""
+    encoding = _get_encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """Tronque un texte à `max_tokens` tokens."""
+    encoding = _get_encoding()
+    if encoding is None:
+        return text[:max_tokens * 4]
+    return encoding.decode(encoding.encode(text)[:max_tokens])
+
+
+def build_prompt(instructions: str, chunks: List[str], history: List[Dict], question: str,
+                 max_tokens: Optional[int] = None, context_tokens: Optional[int] = None,
+                 summary: Optional[str] = None) -> Dict:
+    """Assemble les messages envoyés au modèle dans un budget de tokens.
+
+    Les instructions, le résumé de la conversation et la question sont
+    toujours gardés. Le reste du budget
+    est partagé : le contexte reçoit au moins `context_tokens` (plus si
+    l'historique n'utilise pas sa part), dans l'ordre de pertinence des
+    morceaux, le dernier pouvant être tronqué. L'historique reçoit le reste,
+    en partant des messages les plus récents.
+
+    Args:
+        instructions: Instructions système
+        chunks: Morceaux de contexte, du plus pertinent au moins pertinent
+        history: Messages précédents (user/assistant), du plus ancien au plus récent
+        question: La question de l'utilisateur
+        max_tokens: Budget total (PROMPT_MAX_TOKENS par défaut)
+        context_tokens: Part réservée au contexte (PROMPT_CONTEXT_TOKENS par défaut)
+        summary: Résumé des messages plus anciens que `history`, ou None
+
+    Returns:
+        dict: messages, chunks gardés (indices), messages d'historique gardés
+        et rapport (tokens utilisés, éléments écartés ou tronqués)
+    """
+    max_tokens = PROMPT_MAX_TOKENS if max_tokens is None else max_tokens
+    context_tokens = PROMPT_CONTEXT_TOKENS if context_tokens is None else context_tokens
+
+    if summary:
+        instructions = instructions + SUMMARY_HEADER + summary
+    fixed = (count_tokens(instructions) + count_tokens(question) + 2 * MESSAGE_OVERHEAD_TOKENS
+             + (count_tokens(CONTEXT_HEADER) if chunks else 0))
+    remaining = max(max_tokens - fixed, 0)
+
+    history_costs = [count_tokens(message.get("content") or "") + MESSAGE_OVERHEAD_TOKENS for message in history]
+    chunk_costs = [count_tokens(chunk) + count_tokens(CONTEXT_SEPARATOR) for chunk in chunks]
+
+    # Le contexte garde sa part ; il prend aussi ce que l'historique n'utilise pas
+    context_budget = min(sum(chunk_costs), max(context_tokens, remaining - sum(history_costs)), remaining)
+
+    kept_chunks, kept_indices, trimmed_chunks = [], [], []
+    used = 0
+    for index, (chunk, cost) in enumerate(zip(chunks, chunk_costs)):
+        if used + cost <= context_budget:
+            kept_chunks.append(chunk)
+            kept_indices.append(index)
+            used += cost
+            continue
+        room = context_budget - used - count_tokens(CONTEXT_SEPARATOR)
+        if room >= PROMPT_MIN_CHUNK_TOKENS:
+            kept_chunks.append(truncate_tokens(chunk, room))
+            kept_indices.append(index)
+            trimmed_chunks.append(index)
+            used = context_budget
+        break
+    context_used = used
+
+    # Historique : les messages les plus récents d'abord, sans trou dans la conversation
+    history_budget = remaining - context_used
+    kept_history_start = len(history)
+    used = 0
+    for index in range(len(history) - 1, -1, -1):
+        if used + history_costs[index] > history_budget:
+            break
+        used += history_costs[index]
+        kept_history_start = index
+    kept_history = history[kept_history_start:]
+
+    context = CONTEXT_SEPARATOR.join(kept_chunks)
+    system = instructions + CONTEXT_HEADER + context if kept_chunks else instructions
+    messages = [{"role": "system", "content": system}, *kept_history, {"role": "user", "content": question}]
+
+    report = {
+        "budget": max_tokens,
+        "tokens": fixed + context_used + used,
+        "context_tokens": context_used,
+        "history_tokens": used,
+        "dropped_chunks": [index for index in range(len(chunks)) if index not in kept_indices],
+        "trimmed_chunks": trimmed_chunks,
+        "dropped_messages": kept_history_start,
+    }
+    if report["dropped_chunks"] or report["trimmed_chunks"] or report["dropped_messages"]:
+        logger.info("Prompt limité à %d tokens : %d morceaux écartés, %d tronqués, %d messages d'historique écartés",
+                    max_tokens, len(report["dropped_chunks"]), len(trimmed_chunks), kept_history_start)
+
+    return {
+        "messages": messages,
+        "context": context,
+        "chunk_indices": kept_indices,
+        "history": kept_history,
+        "report": report,
+    }
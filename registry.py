@@ -0,0 +1,258 @@
+import logging
+import os
+import threading
+import time
+
+import chromadb
+import httpx
+from chromadb.utils import embedding_functions
+from dotenv import load_dotenv
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+
+from embeddings import EmbeddingProvider, create_embedding_provider
+from sharding import SHARD_COUNT, ShardedCollection, shard_names
+from vector_index import VectorIndex
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL_NAME = "text-embedding-3-small"
+
+# Fournisseur d'embeddings : openai, local (sentence-transformers) ou hashing (tests, hors ligne)
+EMBEDDING_PROVIDER = os.getenv('EMBEDDING_PROVIDER', 'openai')
+
+# Stockage des vecteurs : serveur Chroma, ou index embarqué persistant (un seul nœud)
+VECTOR_BACKEND = os.getenv('VECTOR_BACKEND', 'chroma')
+VECTOR_INDEX_PATH = os.getenv('VECTOR_INDEX_PATH', 'save/vector_index')
+
+# Les vecteurs de fournisseurs différents ne sont pas comparables : une collection par fournisseur
+COLLECTION_NAME = os.getenv(
+    'CHROMA_COLLECTION',
+    "Documents" if EMBEDDING_PROVIDER == 'openai' else f"Documents-{EMBEDDING_PROVIDER}"
+)
+
+
+class ClientRegistry:
+    """Registre des clients Chroma/OpenAI et des collections, partagé par le processus.
+
+    Les clients sont créés une seule fois et gardent leurs connexions HTTP
+    ouvertes ; les collections sont mises en cache. La connexion à Chroma est
+    vérifiée périodiquement et recréée si le serveur ne répond plus.
+    """
+
+    def __init__(self, health_check_interval: float = 30):
+        """
+        Args:
+            health_check_interval: Délai minimum en secondes entre deux vérifications de Chroma
+        """
+        self.health_check_interval = health_check_interval
+        self.chroma_host = os.getenv('CHROMA_DB_HOST', 'localhost')
+        self.chroma_port = int(os.getenv('CHROMA_DB_PORT', 8000))
+        self._lock = threading.RLock()
+        # Connexion et vérification de Chroma (appels réseau), hors du verrou principal
+        self._chroma_lock = threading.Lock()
+        self._openai_client = None
+        self._async_openai_client = None
+        self._embedding_function = None
+        self._chroma_client = None
+        self._collections = {}
+        self._last_health_check = 0.0
+
+    def get_openai_client(self) -> OpenAI:
+        """Retourne le client OpenAI partagé et son pool de connexions."""
+        with self._lock:
+            if self._openai_client is None:
+                max_connections = int(os.getenv('OPENAI_MAX_CONNECTIONS', 100))
+                self._openai_client = OpenAI(
+                    api_key=os.getenv('OPENAI_API_KEY'),
+                    http_client=DefaultHttpxClient(
+                        limits=httpx.Limits(
+                            max_connections=max_connections,
+                            max_keepalive_connections=max_connections,
+                        )
+                    ),
+                )
+            return self._openai_client
+
+    def get_async_openai_client(self) -> AsyncOpenAI:
+        """Retourne le client OpenAI asynchrone partagé, utilisé par le mode ASGI.
+
+        Une boucle asyncio garde des centaines de flux ouverts à la fois : son
+        pool a sa propre limite, OPENAI_ASYNC_MAX_CONNECTIONS (0 : sans limite).
+        """
+        with self._lock:
+            if self._async_openai_client is None:
+                max_connections = int(os.getenv('OPENAI_ASYNC_MAX_CONNECTIONS', 1000)) or None
+                max_keepalive = int(os.getenv('OPENAI_MAX_CONNECTIONS', 100))
+                self._async_openai_client = AsyncOpenAI(
+                    api_key=os.getenv('OPENAI_API_KEY'),
+                    http_client=DefaultAsyncHttpxClient(
+                        limits=httpx.Limits(
+                            max_connections=max_connections,
+                            max_keepalive_connections=max_keepalive,
+                        )
+                    ),
+                )
+            return self._async_openai_client
+
+    def get_embedding_function(self) -> EmbeddingProvider:
+        """Retourne le fournisseur d'embeddings partagé, choisi par EMBEDDING_PROVIDER."""
+        with self._lock:
+            if self._embedding_function is None:
+                openai_function = None
+                if EMBEDDING_PROVIDER == 'openai':
+                    # Branchée sur le client OpenAI partagé et son pool de connexions
+                    openai_function = embedding_functions.OpenAIEmbeddingFunction(
+                        model_name=EMBEDDING_MODEL_NAME,
+                        api_key=os.getenv('OPENAI_API_KEY')
+                    )
+                    openai_function.client = self.get_openai_client()
+                self._embedding_function = create_embedding_provider(EMBEDDING_PROVIDER, openai_function)
+                logger.info("Fournisseur d'embeddings : %s (%s)", EMBEDDING_PROVIDER,
+                            self._embedding_function.model_name)
+            return self._embedding_function
+
+    def get_chroma_client(self):
+        """Retourne le client Chroma partagé, en le recréant s'il ne répond plus.
+
+        La vérification périodique (heartbeat) se fait hors du verrou du
+        registre, par un seul thread à la fois : un Chroma lent ne bloque ni
+        les clients OpenAI ni les requêtes qui utilisent le client courant.
+        """
+        with self._lock:
+            client = self._chroma_client
+            due = time.monotonic() - self._last_health_check > self.health_check_interval
+
+        if client is None:
+            with self._chroma_lock:
+                with self._lock:
+                    client = self._chroma_client
+                if client is None:
+                    client = self._connect_chroma()
+                    with self._lock:
+                        self._chroma_client = client
+                        self._last_health_check = time.monotonic()
+            return client
+
+        if due and self._chroma_lock.acquire(blocking=False):
+            try:
+                client.heartbeat()
+            except Exception as e:
+                logger.warning("ChromaDB ne répond plus, reconnexion : %s", str(e))
+                replacement = self._connect_chroma()
+                with self._lock:
+                    if self._chroma_client is client:
+                        self.reset()
+                        self._chroma_client = replacement
+                    client = self._chroma_client
+            finally:
+                with self._lock:
+                    self._last_health_check = time.monotonic()
+                self._chroma_lock.release()
+        return client
+
+    def get_collection(self, name: str = COLLECTION_NAME):
+        """Retourne la collection demandée, répartie en shards pour le corpus si SHARD_COUNT > 1.
+
+        Les collections des shards viennent du cache ; l'enveloppe qui les
+        réunit est recréée à chaque appel, après une éventuelle reconnexion.
+
+        Args:
+            name: Nom de la collection Chroma
+
+        Returns:
+            La collection, ou une `ShardedCollection` de même interface
+        """
+        if SHARD_COUNT > 1 and name == COLLECTION_NAME:
+            return ShardedCollection(
+                name, [self.get_single_collection(shard) for shard in shard_names(name)],
+                embedding_function=self.get_embedding_function()
+            )
+        return self.get_single_collection(name)
+
+    def get_single_collection(self, name: str):
+        """Retourne une collection non répartie, depuis le cache si possible.
+
+        Avec VECTOR_BACKEND=local, la collection est un index vectoriel embarqué
+        (même interface) stocké dans VECTOR_INDEX_PATH/<nom>, sans serveur Chroma.
+
+        Args:
+            name: Nom de la collection Chroma
+
+        Returns:
+            La collection, configurée avec la fonction d'embedding partagée
+        """
+        chroma_client = self.get_chroma_client() if VECTOR_BACKEND != 'local' else None
+        with self._lock:
+            if VECTOR_BACKEND == 'local':
+                collection = self._collections.get(name)
+                if collection is None:
+                    collection = VectorIndex(
+                        os.path.join(VECTOR_INDEX_PATH, name), name, self.get_embedding_function()
+                    )
+                    self._collections[name] = collection
+                return collection
+
+            collection = self._collections.get(name)
+            if collection is None:
+                collection = chroma_client.get_or_create_collection(
+                    name=name,
+                    embedding_function=self.get_embedding_function()
+                )
+                self._collections[name] = collection
+            return collection
+
+    def reset(self) -> None:
+        """Oublie le client Chroma et les collections ; ils seront recréés au prochain appel."""
+        with self._lock:
+            self._chroma_client = None
+            if VECTOR_BACKEND != 'local':
+                self._collections = {}
+
+    def _connect_chroma(self):
+        try:
+            chroma_client = chromadb.HttpClient(host=self.chroma_host, port=self.chroma_port)
+            logger.info("Connecté à ChromaDB sur %s:%d", self.chroma_host, self.chroma_port)
+            return chroma_client
+        except Exception as e:
+            if self.chroma_host != 'localhost':
+                raise
+            # En local sans serveur Chroma, on retombe sur une base en mémoire
+            logger.error(f"Erreur de connexion à ChromaDB : {str(e)}")
+            return chromadb.Client()
+
+
+registry = ClientRegistry(
+    health_check_interval=float(os.getenv('CHROMA_HEALTH_CHECK_INTERVAL', 30))
+)
+
+
+def get_openai_client() -> OpenAI:
+    """Retourne le client OpenAI partagé."""
+    return registry.get_openai_client()
+
+
+def get_async_openai_client() -> AsyncOpenAI:
+    """Retourne le client OpenAI asynchrone partagé."""
+    return registry.get_async_openai_client()
+
+
+def get_embedding_function() -> EmbeddingProvider:
+    """Retourne le fournisseur d'embeddings partagé."""
+    return registry.get_embedding_function()
+
+
+def get_chroma_client():
+    """Retourne le client Chroma partagé."""
+    return registry.get_chroma_client()
+
+
+def get_collection(name: str = COLLECTION_NAME):
+    """Retourne une collection Chroma depuis le registre partagé."""
+    return registry.get_collection(name)
+
+
+def get_single_collection(name: str):
+    """Retourne une collection Chroma non répartie (un shard) depuis le registre partagé."""
+    return registry.get_single_collection(name)
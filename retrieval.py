@@ -0,0 +1,105 @@
+import logging
+import os
+from typing import Dict, List
+
+from cache import get_corpus_version, make_retrieval_key, retrieval_cache
+from lexical_index import get_lexical_index
+from metrics import RETRIEVAL_CACHE
+from registry import get_embedding_function
+
+logger = logging.getLogger(__name__)
+
+# vector : distance vectorielle seule ; hybrid : fusion des classements BM25 et vectoriel
+RETRIEVAL_MODE = os.getenv('RETRIEVAL_MODE', 'vector')
+# Nombre de candidats de chaque classement avant fusion
+HYBRID_CANDIDATES = int(os.getenv('HYBRID_CANDIDATES', 20))
+# Constante de la fusion RRF : plus elle est grande, plus les rangs éloignés comptent
+RRF_K = int(os.getenv('RRF_K', 60))
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = RRF_K) -> List[str]:
+    """Fusionne plusieurs classements d'IDs par Reciprocal Rank Fusion.
+
+    Chaque ID reçoit la somme de 1 / (k + rang) sur les classements où il apparaît.
+
+    Returns:
+        Les IDs, du meilleur score fusionné au moins bon
+    """
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda doc_id: scores[doc_id], reverse=True)
+
+
+def retrieve(collection, question: str, query_embedding, n_results: int = 5) -> Dict:
+    """Cherche les morceaux pertinents pour une question, selon RETRIEVAL_MODE.
+
+    Les résultats sont mis en cache par question (normalisée), modèle
+    d'embedding, nombre de résultats, collection et mode, pour la version
+    courante du corpus : une question déjà posée ne refait pas la recherche
+    tant qu'aucune ingestion ni suppression n'a eu lieu.
+
+    Returns:
+        dict: Résultats au format de `collection.query` (une seule requête)
+    """
+    if not retrieval_cache.max_size:
+        return search(collection, question, query_embedding, n_results)
+
+    version = get_corpus_version()
+    key = make_retrieval_key(question, get_embedding_function().model_name, n_results,
+                             f"{collection.name}:{RETRIEVAL_MODE}")
+    results = retrieval_cache.get(key, version)
+    if results is not None:
+        RETRIEVAL_CACHE.labels("hit").inc()
+        return results
+
+    RETRIEVAL_CACHE.labels("miss").inc()
+    results = search(collection, question, query_embedding, n_results)
+    retrieval_cache.set(key, results, version)
+    return results
+
+
+def search(collection, question: str, query_embedding, n_results: int = 5) -> Dict:
+    """Recherche dans la base vectorielle (et l'index BM25 en mode hybride), sans cache.
+
+    En mode hybride, les `HYBRID_CANDIDATES` meilleurs morceaux du classement
+    vectoriel et du classement BM25 sont fusionnés par RRF, puis les
+    `n_results` premiers sont retenus. Un morceau trouvé seulement par BM25
+    n'a pas de distance vectorielle (None) : il contient les termes exacts de
+    la question et n'est pas soumis au seuil de distance.
+
+    Returns:
+        dict: Résultats au format de `collection.query` (une seule requête)
+    """
+    if RETRIEVAL_MODE != 'hybrid':
+        return collection.query(query_embeddings=[query_embedding], n_results=n_results)
+
+    vector = collection.query(query_embeddings=[query_embedding], n_results=HYBRID_CANDIDATES)
+    vector_ids = vector['ids'][0]
+    lexical_ids = [chunk_id for chunk_id, _ in get_lexical_index(collection.name).search(question, HYBRID_CANDIDATES)]
+
+    fused = reciprocal_rank_fusion([vector_ids, lexical_ids])[:n_results]
+
+    found = {
+        doc_id: (document, metadata, distance)
+        for doc_id, document, metadata, distance in zip(
+            vector_ids, vector['documents'][0], vector['metadatas'][0], vector['distances'][0]
+        )
+    }
+    missing = [doc_id for doc_id in fused if doc_id not in found]
+    if missing:
+        lexical = collection.get(ids=missing, include=["documents", "metadatas"])
+        for doc_id, document, metadata in zip(lexical['ids'], lexical['documents'], lexical['metadatas']):
+            found[doc_id] = (document, metadata, None)
+
+    # Un ID de l'index lexical absent de la collection (supprimé entre-temps) est ignoré
+    fused = [doc_id for doc_id in fused if doc_id in found]
+    logger.info("Recherche hybride : %d vectoriels, %d lexicaux, %d retenus",
+                len(vector_ids), len(lexical_ids), len(fused))
+    return {
+        "ids": [fused],
+        "documents": [[found[doc_id][0] for doc_id in fused]],
+        "metadatas": [[found[doc_id][1] for doc_id in fused]],
+        "distances": [[found[doc_id][2] for doc_id in fused]],
+    }
@@ -18,6 +18,13 @@ source venv/bin/activate
 echo "📚 Installation des dépendances..."
 pip install -r requirements.txt
 
+# Télécharger une fois l'encodage de tiktoken (o200k_base) : sans réseau au
+# premier appel, le nombre de tokens des prompts n'est qu'estimé
+export TIKTOKEN_CACHE_DIR="${TIKTOKEN_CACHE_DIR:-save/tiktoken}"
+echo "🔤 Préchargement de l'encodage des tokens..."
+python -c "import tiktoken; tiktoken.get_encoding('${PROMPT_ENCODING:-o200k_base}')" \
+    || echo "⚠️  Encodage indisponible hors ligne, estimation du nombre de tokens"
+
 # Vérifier le fichier .env
 if [ ! -f ".env" ]; then
     echo "⚠️  Fichier .env manquant, copie de .env.example..."
@@ -28,5 +35,11 @@ fi
 # Lancer l'application
 
 # Lancer l'application
-echo "🎯 Lancement du serveur Flask..."
-python app.py
+if [ "$LEXICA_ASYNC" = "1" ]; then
+    # Mode asynchrone : /api/ask servi par asyncio, le reste par Flask
+    echo "🎯 Lancement du serveur ASGI..."
+    uvicorn asgi:app --host 0.0.0.0 --port "${PORT:-5000}"
+else
+    echo "🎯 Lancement du serveur Flask..."
+    python app.py
+fi
@@ -0,0 +1,222 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from discussion_store import DiscussionStore, DiscussionWriter, get_discussion_store, get_discussion_writer
+from prompt import truncate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Nombre de discussions gardées en mémoire (les moins récemment utilisées sont oubliées)
+SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', 1000))
+# Messages les plus récents envoyés tels quels au modèle
+SESSION_RECENT_MESSAGES = int(os.getenv('SESSION_RECENT_MESSAGES', 6))
+# Nombre de messages plus anciens accumulés avant de les replier dans le résumé
+SESSION_SUMMARY_BATCH = int(os.getenv('SESSION_SUMMARY_BATCH', 6))
+SESSION_SUMMARY_MODEL = os.getenv('SESSION_SUMMARY_MODEL', 'gpt-4o-mini')
+SESSION_SUMMARY_MAX_TOKENS = int(os.getenv('SESSION_SUMMARY_MAX_TOKENS', 400))
+# Longueur maximale d'un message dans le texte envoyé au résumé
+SESSION_SUMMARY_MESSAGE_TOKENS = 500
+
+SUMMARY_INSTRUCTIONS = """
+        Tu résumes une conversation entre un utilisateur et Lexica, un assistant.
+        Tu reçois le résumé précédent (éventuellement vide) et les nouveaux messages.
+        Produis un résumé unique, concis et factuel, en français : sujets abordés,
+        questions posées, réponses et informations importantes à retenir pour la suite.
+        Ne dépasse pas quelques paragraphes.
+        """
+
+ROLE_LABELS = {"user": "Utilisateur", "assistant": "Lexica"}
+
+
+def summarize_messages(previous_summary: Optional[str], messages: List[Dict]) -> str:
+    """Replie des messages dans le résumé glissant d'une discussion, via le modèle de chat.
+
+    Args:
+        previous_summary: Résumé des messages plus anciens, ou None
+        messages: Messages à ajouter au résumé (format du stockage : type/content)
+
+    Returns:
+        Le nouveau résumé
+    """
+    from registry import get_openai_client
+
+    transcript = "\n\n".join(
+        f"{ROLE_LABELS[message['type']]} : "
+        f"{truncate_tokens(message.get('content') or '', SESSION_SUMMARY_MESSAGE_TOKENS)}"
+        for message in messages if message.get("type") in ROLE_LABELS
+    )
+    response = get_openai_client().chat.completions.create(
+        model=SESSION_SUMMARY_MODEL,
+        messages=[
+            {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+            {"role": "user", "content": f"Résumé précédent :\n{previous_summary or ''}\n\n"
+                                        f"Nouveaux messages :\n{transcript}"},
+        ],
+        max_tokens=SESSION_SUMMARY_MAX_TOKENS,
+    )
+    return response.choices[0].message.content.strip()
+
+
+class Session:
+    """État d'une discussion : résumé glissant et messages non encore résumés."""
+
+    def __init__(self, summary: Optional[str], summary_upto: int, messages: List[Tuple[int, Dict]]):
+        """
+        Args:
+            summary: Résumé des messages jusqu'à `summary_upto`, ou None
+            summary_upto: Numéro de séquence du dernier message résumé
+            messages: Messages postérieurs au résumé, (numéro de séquence, message)
+        """
+        self.summary = summary
+        self.summary_upto = summary_upto
+        self.messages = messages
+
+    @property
+    def last_seq(self) -> int:
+        return self.messages[-1][0] if self.messages else self.summary_upto
+
+
+class SessionManager:
+    """Sessions de conversation côté serveur.
+
+    Le client n'envoie plus que l'ID de la discussion et la question : les
+    derniers messages sont gardés en mémoire (LRU de `capacity` discussions)
+    et rechargés depuis le stockage des discussions au besoin. Au-delà des
+    `recent_messages` derniers messages, les plus anciens sont repliés, par
+    lots de `summary_batch`, dans un résumé glissant calculé une seule fois en
+    tâche de fond et enregistré avec la discussion. Le prompt ne contient donc
+    que le résumé et les derniers échanges, quelle que soit la longueur de la
+    conversation.
+
+    Les messages sont écrits par la file d'écriture différée et ajoutés à la
+    session une fois sur le disque. Le stockage reste la référence : une
+    session en mémoire dont le dernier message n'est plus celui du stockage
+    (écrit par un autre worker) est rechargée.
+    """
+
+    def __init__(self, store: DiscussionStore, writer: DiscussionWriter, capacity: int = SESSION_CACHE_SIZE,
+                 recent_messages: int = SESSION_RECENT_MESSAGES, summary_batch: int = SESSION_SUMMARY_BATCH,
+                 summarize: Callable[[Optional[str], List[Dict]], str] = summarize_messages):
+        """
+        Args:
+            store: Stockage des discussions
+            writer: File d'écriture différée des discussions
+            capacity: Nombre de discussions gardées en mémoire
+            recent_messages: Messages récents gardés tels quels dans le prompt
+            summary_batch: Messages plus anciens accumulés avant un nouveau résumé
+            summarize: Fonction (résumé précédent, messages) -> nouveau résumé
+        """
+        self.store = store
+        self.writer = writer
+        self.capacity = capacity
+        self.recent_messages = recent_messages
+        self.summary_batch = max(1, summary_batch)
+        self.summarize = summarize
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._summarizing = set()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='summary')
+
+    def get(self, discussion_id: str) -> Session:
+        """Retourne la session d'une discussion, depuis la mémoire si elle est à jour."""
+        if self.writer.has_pending(discussion_id):
+            # Relire ses propres écritures : les messages en file doivent être sur le disque
+            self.writer.flush()
+        last_seq = self.store.last_seq(discussion_id)
+        with self._lock:
+            session = self._sessions.get(discussion_id)
+            if session is not None and session.last_seq == last_seq:
+                self._sessions.move_to_end(discussion_id)
+                return session
+
+        summary, summary_upto = self.store.get_rolling_summary(discussion_id)
+        session = Session(summary, summary_upto, self.store.messages_after(discussion_id, summary_upto))
+        with self._lock:
+            self._sessions[discussion_id] = session
+            self._sessions.move_to_end(discussion_id)
+            while len(self._sessions) > self.capacity:
+                self._sessions.popitem(last=False)
+        return session
+
+    def history(self, discussion_id: str) -> Tuple[Optional[str], List[Dict]]:
+        """Historique à envoyer au modèle pour une discussion.
+
+        Returns:
+            tuple: (résumé glissant ou None, messages user/assistant non résumés)
+        """
+        session = self.get(discussion_id)
+        messages = [
+            {"role": message["type"], "content": message.get("content") or ""}
+            for _, message in session.messages if message.get("type") in ("user", "assistant")
+        ]
+        return session.summary, messages
+
+    def append(self, discussion_id: str, message: Dict) -> None:
+        """Met en file l'écriture d'un message ; il rejoint la session en mémoire une fois écrit.
+
+        Après une réponse de l'assistant, les messages anciens sont repliés
+        dans le résumé si un lot complet s'est accumulé.
+        """
+        self.writer.append(discussion_id, message, lambda seq: self._appended(discussion_id, message, seq))
+
+    def _appended(self, discussion_id: str, message: Dict, seq: int) -> None:
+        with self._lock:
+            session = self._sessions.get(discussion_id)
+            # Un message intermédiaire manquant (autre worker) : la session sera rechargée
+            if session is not None and session.last_seq < seq:
+                session.messages = session.messages + [(seq, message)]
+        if message.get("type") == "assistant":
+            self._schedule_summary(discussion_id)
+
+    def forget(self, discussion_id: str) -> None:
+        """Retire une discussion de la mémoire (après sa suppression)."""
+        with self._lock:
+            self._sessions.pop(discussion_id, None)
+
+    def _schedule_summary(self, discussion_id: str) -> None:
+        with self._lock:
+            session = self._sessions.get(discussion_id)
+            due = session is not None and len(session.messages) - self.recent_messages >= self.summary_batch
+            if not due or discussion_id in self._summarizing:
+                return
+            self._summarizing.add(discussion_id)
+        self._executor.submit(self._update_summary, discussion_id)
+
+    def _update_summary(self, discussion_id: str) -> None:
+        try:
+            session = self.get(discussion_id)
+            folded = session.messages[:len(session.messages) - self.recent_messages]
+            if not folded:
+                return
+            summary = self.summarize(session.summary, [message for _, message in folded])
+            upto = folded[-1][0]
+            self.store.save_rolling_summary(discussion_id, summary, upto)
+            with self._lock:
+                current = self._sessions.get(discussion_id)
+                if current is not None and current.summary_upto < upto:
+                    current.summary = summary
+                    current.summary_upto = upto
+                    current.messages = [item for item in current.messages if item[0] > upto]
+            logger.info("Résumé de la discussion %s mis à jour (%d messages repliés)", discussion_id, len(folded))
+        except Exception as e:
+            logger.error("Erreur lors du résumé de la discussion %s : %s", discussion_id, str(e))
+        finally:
+            with self._lock:
+                self._summarizing.discard(discussion_id)
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_session_manager() -> SessionManager:
+    """Retourne le gestionnaire de sessions partagé par le processus."""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = SessionManager(get_discussion_store(), get_discussion_writer())
+        return _manager
@@ -0,0 +1,295 @@
+import argparse
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Nombre de collections (shards) entre lesquelles les morceaux sont répartis (1 : une seule collection)
+SHARD_COUNT = max(1, int(os.getenv('SHARD_COUNT', 1)))
+# Répartition des morceaux : hash (ID du morceau), source (fichier d'origine) ou tenant (métadonnée)
+SHARD_ROUTING = os.getenv('SHARD_ROUTING', 'hash')
+# Métadonnée portant le locataire d'un morceau, avec SHARD_ROUTING=tenant
+SHARD_TENANT_KEY = os.getenv('SHARD_TENANT_KEY', 'tenant')
+# Appels simultanés vers les shards, toutes requêtes confondues
+SHARD_CONCURRENCY = int(os.getenv('SHARD_CONCURRENCY', 16))
+
+ROUTINGS = ('hash', 'source', 'tenant')
+DEFAULT_QUERY_INCLUDE = ["documents", "metadatas", "distances"]
+RESULT_KEYS = ("ids", "documents", "metadatas", "distances", "embeddings")
+
+_executor = ThreadPoolExecutor(max_workers=SHARD_CONCURRENCY, thread_name_prefix='shard')
+
+
+def shard_names(name: str, count: int = SHARD_COUNT) -> List[str]:
+    """Noms des collections d'un corpus réparti en `count` shards (le nom seul s'il n'y en a qu'un)."""
+    if count <= 1:
+        return [name]
+    return [f"{name}-shard{i}" for i in range(count)]
+
+
+def shard_index(key: str, count: int) -> int:
+    """Shard d'une clé de répartition, stable d'un processus et d'un redémarrage à l'autre."""
+    return int.from_bytes(hashlib.sha256(key.encode('utf-8')).digest()[:8], 'big') % count
+
+
+class ShardedCollection:
+    """Collection répartie sur plusieurs collections, avec l'interface d'une collection Chroma.
+
+    Chaque morceau est rangé dans un seul shard, choisi selon SHARD_ROUTING :
+    - hash : d'après l'ID du morceau ; un ID désigne directement son shard,
+      les lectures et suppressions par ID ne touchent que lui ;
+    - source : d'après le fichier d'origine (métadonnée `filename`) ;
+    - tenant : d'après la métadonnée `tenant_key` (à défaut, le fichier d'origine).
+
+    Une recherche interroge les shards en parallèle puis fusionne leurs
+    meilleurs résultats par distance ; un filtre `where` sur la clé de
+    répartition limite la recherche au shard concerné. Avec une répartition
+    par source ou par locataire, un morceau commun à deux sources reste dans
+    le shard où il a été indexé en premier (les IDs sont dérivés du contenu),
+    et les lectures par ID interrogent tous les shards.
+    """
+
+    def __init__(self, name: str, shards: List, routing: str = SHARD_ROUTING,
+                 tenant_key: str = SHARD_TENANT_KEY, embedding_function: Optional[Callable] = None):
+        """
+        Args:
+            name: Nom du corpus (celui de la collection unique, sans shards)
+            shards: Collections des shards, dans l'ordre de `shard_names`
+            routing: Répartition des morceaux : hash, source ou tenant
+            tenant_key: Métadonnée portant le locataire, avec la répartition tenant
+            embedding_function: Fonction d'embedding, pour les requêtes par texte
+        """
+        if routing not in ROUTINGS:
+            raise ValueError(f"Répartition inconnue : {routing} (attendu : {', '.join(ROUTINGS)})")
+        self.name = name
+        self.shards = shards
+        self.routing = routing
+        self.tenant_key = tenant_key
+        self._embedding_function = embedding_function
+
+    # Répartition
+
+    def shard_for(self, chunk_id: str, metadata: Optional[Dict]) -> int:
+        """Shard dans lequel ranger un morceau."""
+        metadata = metadata or {}
+        if self.routing == 'hash':
+            key = chunk_id
+        elif self.routing == 'tenant' and metadata.get(self.tenant_key) is not None:
+            key = f"tenant:{metadata[self.tenant_key]}"
+        else:
+            key = f"source:{metadata.get('filename') or chunk_id}"
+        return shard_index(key, len(self.shards))
+
+    def _shards_for_ids(self, ids: List[str]) -> Dict[int, List[str]]:
+        if self.routing == 'hash':
+            grouped: Dict[int, List[str]] = {}
+            for doc_id in ids:
+                grouped.setdefault(self.shard_for(doc_id, None), []).append(doc_id)
+            return grouped
+        return {index: list(ids) for index in range(len(self.shards))}
+
+    def _shards_for_where(self, where: Optional[Dict]) -> List[int]:
+        """Shards pouvant contenir des morceaux correspondant au filtre."""
+        if where and self.routing != 'hash':
+            key = self.tenant_key if self.routing == 'tenant' else 'filename'
+            value = where.get(key)
+            if isinstance(value, (str, int, float)) and not isinstance(value, bool):
+                return [self.shard_for("", {key: value})]
+        return list(range(len(self.shards)))
+
+    def _map(self, calls: Dict[int, Callable]) -> Dict[int, object]:
+        """Exécute un appel par shard, en parallèle s'il y en a plusieurs."""
+        if len(calls) <= 1:
+            return {index: call() for index, call in calls.items()}
+        futures = {index: _executor.submit(call) for index, call in calls.items()}
+        return {index: future.result() for index, future in futures.items()}
+
+    # Interface d'une collection Chroma
+
+    def count(self) -> int:
+        return sum(self.counts().values())
+
+    def counts(self) -> Dict[str, int]:
+        """Nombre de morceaux de chaque shard, par nom de collection."""
+        results = self._map({index: shard.count for index, shard in enumerate(self.shards)})
+        return {self.shards[index].name: results[index] for index in range(len(self.shards))}
+
+    def upsert(self, ids, embeddings=None, documents=None, metadatas=None) -> None:
+        """Insère ou remplace des morceaux, chacun dans son shard."""
+        positions: Dict[int, List[int]] = {}
+        for position, doc_id in enumerate(ids):
+            metadata = metadatas[position] if metadatas is not None else None
+            positions.setdefault(self.shard_for(doc_id, metadata), []).append(position)
+
+        def pick(values, selected):
+            return [values[position] for position in selected] if values is not None else None
+
+        self._map({
+            index: (lambda shard=self.shards[index], selected=selected: shard.upsert(
+                ids=pick(ids, selected), embeddings=pick(embeddings, selected),
+                documents=pick(documents, selected), metadatas=pick(metadatas, selected),
+            ))
+            for index, selected in positions.items()
+        })
+
+    def delete(self, ids=None, where=None) -> None:
+        """Supprime des morceaux par ID ou par filtre, dans les shards concernés."""
+        if ids is not None:
+            calls = {index: (lambda shard=self.shards[index], part=part: shard.delete(ids=part))
+                     for index, part in self._shards_for_ids(ids).items() if part}
+        else:
+            calls = {index: (lambda shard=self.shards[index]: shard.delete(where=where))
+                     for index in self._shards_for_where(where)}
+        self._map(calls)
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include=("documents", "metadatas")) -> Dict:
+        """Récupère des morceaux au format de `Collection.get`, les shards étant lus à la suite."""
+        include = list(include)
+        if ids is not None:
+            targets = self._shards_for_ids(ids)
+            results = self._map({
+                index: (lambda shard=self.shards[index], part=part: shard.get(ids=part, where=where, include=include))
+                for index, part in targets.items() if part
+            })
+            merged = self._concat([results[index] for index in sorted(results)], include)
+            return self._slice(merged, offset or 0, limit)
+
+        if where is not None:
+            # Le nombre de morceaux d'un shard qui passent le filtre n'est pas connu d'avance
+            results = self._map({
+                index: (lambda shard=self.shards[index]: shard.get(where=where, include=include))
+                for index in self._shards_for_where(where)
+            })
+            merged = self._concat([results[index] for index in sorted(results)], include)
+            return self._slice(merged, offset or 0, limit)
+
+        # Pagination sur l'ensemble des shards : on saute les shards entiers déjà parcourus
+        skip, remaining = offset or 0, limit
+        pages = []
+        for shard in self.shards:
+            size = shard.count()
+            if skip >= size:
+                skip -= size
+                continue
+            page = shard.get(limit=remaining, offset=skip or None, include=include)
+            skip = 0
+            pages.append(page)
+            if remaining is not None:
+                remaining -= len(page['ids'])
+                if remaining <= 0:
+                    break
+        return self._concat(pages, include)
+
+    def query(self, query_embeddings=None, query_texts=None, n_results=10, where=None,
+              include=None) -> Dict:
+        """Cherche les plus proches voisins dans les shards en parallèle et fusionne par distance."""
+        include = list(include or DEFAULT_QUERY_INCLUDE)
+        if query_embeddings is None:
+            query_embeddings = self._embedding_function(query_texts)
+        # Les distances servent à la fusion, même si l'appelant ne les demande pas
+        shard_include = include if "distances" in include else include + ["distances"]
+        kwargs = {"query_embeddings": query_embeddings, "n_results": n_results, "include": shard_include}
+        if where:
+            kwargs["where"] = where
+
+        results = self._map({
+            index: (lambda shard=self.shards[index]: shard.query(**kwargs))
+            for index in self._shards_for_where(where)
+        })
+        merged = self._merge([results[index] for index in sorted(results)], len(query_embeddings), n_results)
+        if "distances" not in include:
+            merged["distances"] = None
+        return merged
+
+    # Fusion des résultats
+
+    @staticmethod
+    def _merge(results: List[Dict], query_count: int, n_results: int) -> Dict:
+        """Garde, pour chaque requête, les `n_results` meilleurs morceaux de tous les shards."""
+        keys = [key for key in RESULT_KEYS if all(result.get(key) is not None for result in results)]
+        merged = {key: [] for key in keys}
+        for query in range(query_count):
+            candidates = sorted(
+                (result["distances"][query][position], shard, position)
+                for shard, result in enumerate(results)
+                for position in range(len(result["ids"][query]))
+            )
+            kept, seen = [], set()
+            for _, shard, position in candidates:
+                doc_id = results[shard]["ids"][query][position]
+                if doc_id in seen:
+                    continue
+                seen.add(doc_id)
+                kept.append((shard, position))
+                if len(kept) == n_results:
+                    break
+            for key in keys:
+                merged[key].append([results[shard][key][query][position] for shard, position in kept])
+        return {key: merged.get(key) for key in RESULT_KEYS}
+
+    @staticmethod
+    def _concat(results: List[Dict], include: List[str]) -> Dict:
+        merged = {"ids": []}
+        for key in include:
+            merged[key] = []
+        for result in results:
+            merged["ids"].extend(result["ids"])
+            for key in include:
+                values = result.get(key)
+                merged[key].extend(values if values is not None else [None] * len(result["ids"]))
+        return merged
+
+    @staticmethod
+    def _slice(result: Dict, offset: int, limit: Optional[int]) -> Dict:
+        end = offset + limit if limit is not None else None
+        return {key: values[offset:end] for key, values in result.items()}
+
+
+def rebalance(collection: ShardedCollection, sources: List, batch_size: int = 500) -> int:
+    """Range dans leur shard les morceaux qui n'y sont pas.
+
+    À lancer après un changement de SHARD_COUNT ou de SHARD_ROUTING, ou pour
+    répartir une collection unique existante : `sources` liste les collections
+    à parcourir (anciens shards ou collection d'origine).
+
+    Returns:
+        Le nombre de morceaux déplacés
+    """
+    moved = 0
+    for source in sources:
+        listing = source.get(include=["metadatas"])
+        misplaced = [
+            doc_id for doc_id, metadata in zip(listing["ids"], listing["metadatas"])
+            if collection.shards[collection.shard_for(doc_id, metadata)].name != source.name
+        ]
+        for i in range(0, len(misplaced), batch_size):
+            batch = source.get(ids=misplaced[i:i + batch_size], include=["embeddings", "documents", "metadatas"])
+            collection.upsert(ids=batch["ids"], embeddings=batch["embeddings"],
+                              documents=batch["documents"], metadatas=batch["metadatas"])
+            source.delete(ids=batch["ids"])
+            moved += len(batch["ids"])
+        logger.info("%s : %d morceaux déplacés sur %d", source.name, len(misplaced), len(listing["ids"]))
+    return moved
+
+
+if __name__ == '__main__':
+    from cache import bump_corpus_version
+    from registry import COLLECTION_NAME, get_collection, get_single_collection
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Répartit les morceaux entre les shards de la collection.")
+    parser.add_argument('--previous-count', type=int, default=1,
+                        help="Nombre de shards avant le changement (1 : collection unique)")
+    args = parser.parse_args()
+
+    if SHARD_COUNT <= 1:
+        parser.error("SHARD_COUNT doit être supérieur à 1")
+    target = get_collection()
+    names = list(dict.fromkeys(shard_names(COLLECTION_NAME, args.previous_count) + shard_names(COLLECTION_NAME)))
+    count = rebalance(target, [get_single_collection(name) for name in names])
+    if count:
+        bump_corpus_version()
+    logger.info("Répartition terminée : %d morceaux déplacés", count)
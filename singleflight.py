@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import os
+import threading
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Regroupement des questions identiques posées en même temps (0 pour le désactiver)
+SINGLE_FLIGHT = os.getenv('SINGLE_FLIGHT', '1') == '1'
+# Attente maximale, en secondes, du début de la réponse partagée avant de traiter la question seul
+SINGLE_FLIGHT_WAIT = float(os.getenv('SINGLE_FLIGHT_WAIT', 30))
+
+
+class Flight:
+    """Une réponse en cours de génération, partagée par des requêtes identiques.
+
+    Le meneur publie les morceaux de la réponse au fil du streaming ; chaque
+    abonné la relit depuis le début, puis reçoit les morceaux suivants dès
+    leur publication. L'attente se fait par thread (Flask) ou par boucle
+    asyncio (ASGI).
+    """
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.filenames: List[str] = []
+        self.context = ""
+        self.started = False
+        self.done = False
+        self.aborted = False
+        self.failed = False
+        self.subscribers = 0
+        self._condition = threading.Condition()
+        self._async_waiters = []
+
+    def start(self, filenames: List[str], context: str) -> None:
+        """Signale que la réponse commence : les sources sont connues."""
+        with self._condition:
+            self.filenames = filenames
+            self.context = context
+            self.started = True
+            self._notify()
+
+    def publish(self, chunk: str) -> None:
+        with self._condition:
+            self.chunks.append(chunk)
+            self._notify()
+
+    def finish(self) -> None:
+        with self._condition:
+            self.done = True
+            self._notify()
+
+    def fail(self) -> None:
+        """Signale que la génération a échoué : la réponse partagée n'est qu'un message d'erreur."""
+        with self._condition:
+            self.failed = True
+
+    def abort(self) -> None:
+        """Le meneur a échoué avant de répondre : les abonnés traitent la question eux-mêmes."""
+        with self._condition:
+            self.aborted = True
+            self.done = True
+            self._notify()
+
+    def _notify(self) -> None:
+        self._condition.notify_all()
+        for loop, event in self._async_waiters:
+            loop.call_soon_threadsafe(event.set)
+        self._async_waiters = []
+
+    def wait_start(self, timeout: Optional[float] = None) -> bool:
+        """Attend le début de la réponse.
+
+        Returns:
+            True si la réponse a commencé, False si le meneur a échoué ou tarde trop
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self.started or self.aborted, timeout)
+            return self.started and not self.aborted
+
+    async def wait_start_async(self, timeout: Optional[float] = None) -> bool:
+        """Version asynchrone de `wait_start`."""
+        try:
+            await asyncio.wait_for(self._wait_async(lambda: self.started or self.aborted), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return self.started and not self.aborted
+
+    def replay(self) -> Iterator[str]:
+        """Morceaux de la réponse depuis le début, jusqu'à sa fin."""
+        index = 0
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: len(self.chunks) > index or self.done)
+                chunks, done = self.chunks[index:], self.done
+            index += len(chunks)
+            yield from chunks
+            if done and index == len(self.chunks):
+                return
+
+    async def replay_async(self) -> AsyncIterator[str]:
+        """Version asynchrone de `replay`."""
+        index = 0
+        while True:
+            await self._wait_async(lambda: len(self.chunks) > index or self.done)
+            with self._condition:
+                chunks, done = self.chunks[index:], self.done
+            index += len(chunks)
+            for chunk in chunks:
+                yield chunk
+            if done and index == len(self.chunks):
+                return
+
+    async def _wait_async(self, predicate: Callable[[], bool]) -> None:
+        while True:
+            with self._condition:
+                if predicate():
+                    return
+                event = asyncio.Event()
+                self._async_waiters.append((asyncio.get_running_loop(), event))
+            await event.wait()
+
+
+class SingleFlight:
+    """Registre des réponses en cours, par clé de question.
+
+    La première requête pour une clé en devient le meneur : elle fait la
+    recherche et lance la génération. Les requêtes identiques arrivées avant
+    la fin s'abonnent à la même réponse au lieu de relancer recherche et
+    modèle. La clé est libérée dès la réponse terminée : les questions
+    suivantes passent par le cache des réponses.
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, Flight] = {}
+        self._lock = threading.Lock()
+        self._tasks = set()
+
+    def join(self, key: str) -> Tuple[Flight, bool]:
+        """Rejoint la réponse en cours pour une clé, ou en devient le meneur.
+
+        Returns:
+            tuple: (réponse partagée, True si l'appelant en est le meneur)
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.subscribers += 1
+                return flight, False
+            flight = self._flights[key] = Flight()
+            return flight, True
+
+    def release(self, key: str, flight: Flight) -> None:
+        """Retire une réponse terminée : les questions suivantes repartent de zéro (ou du cache)."""
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        if flight.subscribers:
+            logger.info("Réponse partagée avec %d requêtes identiques", flight.subscribers)
+
+    def abandon(self, key: str, flight: Flight) -> None:
+        """Le meneur échoue avant de répondre : libère la clé et renvoie les abonnés à leur propre traitement."""
+        flight.abort()
+        self.release(key, flight)
+
+    def launch(self, key: str, flight: Flight, chunks: Iterator[str]) -> None:
+        """Génère la réponse partagée dans un thread, jusqu'au bout même si le client du meneur se déconnecte."""
+        def drive():
+            try:
+                for chunk in chunks:
+                    flight.publish(chunk)
+            except Exception as e:
+                logger.error("Erreur lors de la génération partagée : %s", str(e))
+                flight.fail()
+            finally:
+                flight.finish()
+                self.release(key, flight)
+
+        threading.Thread(target=drive, name='single-flight', daemon=True).start()
+
+    def launch_async(self, key: str, flight: Flight, chunks: AsyncIterator[str]) -> None:
+        """Version asynchrone de `launch`, dans une tâche de la boucle d'événements courante."""
+        async def drive():
+            try:
+                async for chunk in chunks:
+                    flight.publish(chunk)
+            except Exception as e:
+                logger.error("Erreur lors de la génération partagée : %s", str(e))
+                flight.fail()
+            finally:
+                flight.finish()
+                self.release(key, flight)
+
+        task = asyncio.get_running_loop().create_task(drive())
+        # La boucle ne garde qu'une référence faible vers ses tâches
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._flights)
+
+
+ask_flights = SingleFlight()
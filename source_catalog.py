@@ -0,0 +1,258 @@
+import json
+import logging
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from db import get_connection, encode_cursor, decode_cursor
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    id TEXT PRIMARY KEY,
+    metadata_filename TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    type TEXT NOT NULL,
+    name TEXT NOT NULL,
+    saved_filename TEXT,
+    file_path TEXT,
+    chunks_processed INTEGER,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_sources_timestamp ON sources (timestamp DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_sources_type ON sources (type, timestamp DESC, id DESC);
+CREATE TABLE IF NOT EXISTS chunk_links (
+    chunk_id TEXT NOT NULL,
+    source TEXT NOT NULL,
+    PRIMARY KEY (chunk_id, source)
+);
+CREATE INDEX IF NOT EXISTS idx_chunk_links_source ON chunk_links (source);
+"""
+
+
+def summarize_source(metadata_filename: str, metadata: Dict) -> Dict:
+    """Construit le résumé catalogué d'une source à partir de son fichier de métadonnées.
+
+    Args:
+        metadata_filename: Nom du fichier metadata_*.json
+        metadata: Contenu du fichier de métadonnées
+
+    Returns:
+        dict: Les champs de résumé de la source
+    """
+    original_filename = metadata.get('original_filename')
+    if original_filename:
+        source_type = os.path.splitext(original_filename)[1].lstrip('.').lower() or 'file'
+        name = original_filename
+        file_path = metadata.get('file_path')
+        size = os.path.getsize(file_path) if file_path and os.path.exists(file_path) else None
+    else:
+        source_type = 'text'
+        name = metadata.get('preview') or metadata.get('saved_filename', '')
+        size = metadata.get('text_length')
+
+    return {
+        "id": metadata_filename.replace('.json', ''),
+        "metadata_filename": metadata_filename,
+        "timestamp": metadata.get('timestamp', ''),
+        "type": source_type,
+        "name": name,
+        "saved_filename": metadata.get('saved_filename'),
+        "file_path": metadata.get('file_path'),
+        "chunks_processed": metadata.get('chunks_processed', 1 if source_type == 'text' else None),
+        "size": size,
+    }
+
+
+class SourceCatalog:
+    """Index SQLite des fichiers sources, tenu à jour à chaque upload et suppression.
+
+    Le listing ne lit que cet index (champs de résumé) ; le détail d'une source,
+    avec l'aperçu de ses morceaux, reste dans son fichier de métadonnées.
+    """
+
+    def __init__(self, path: str, sources_dir: str = 'save/sources'):
+        """
+        Args:
+            path: Chemin du fichier SQLite du catalogue
+            sources_dir: Dossier contenant les fichiers metadata_*.json
+        """
+        self.path = path
+        self.sources_dir = sources_dir
+        connection = self._connect()
+        connection.executescript(SCHEMA)
+        if connection.execute("PRAGMA user_version").fetchone()[0] < 1:
+            # Premier démarrage : on indexe les sources déjà présentes
+            self.rebuild()
+            connection.execute("PRAGMA user_version = 1")
+
+    def _connect(self):
+        return get_connection(self.path)
+
+    def add(self, metadata_filename: str, metadata: Dict) -> None:
+        """Ajoute ou remplace une source dans le catalogue."""
+        connection = self._connect()
+        with connection:
+            self._insert(connection, summarize_source(metadata_filename, metadata))
+
+    @staticmethod
+    def _insert(connection, summary: Dict) -> None:
+        columns = list(summary)
+        connection.execute(
+            f"INSERT OR REPLACE INTO sources ({', '.join(columns)}) "
+            f"VALUES ({', '.join('?' * len(columns))})",
+            [summary[column] for column in columns]
+        )
+
+    def remove(self, source_id: str) -> None:
+        """Retire une source du catalogue."""
+        connection = self._connect()
+        with connection:
+            connection.execute("DELETE FROM sources WHERE id = ?", (source_id,))
+
+    def get(self, source_id: str) -> Optional[Dict]:
+        """Retourne le résumé catalogué d'une source, ou None."""
+        row = self._connect().execute("SELECT * FROM sources WHERE id = ?", (source_id,)).fetchone()
+        return dict(row) if row else None
+
+    def list(self, limit: int = 20, cursor: Optional[str] = None, source_type: Optional[str] = None,
+             name: Optional[str] = None, date_from: Optional[str] = None,
+             date_to: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        """Liste les résumés des sources, filtrés et paginés par curseur.
+
+        Args:
+            limit: Nombre maximum de sources à retourner
+            cursor: Curseur retourné par l'appel précédent (None pour la première page)
+            source_type: Type de source (pdf, text, ...)
+            name: Fragment du nom de la source, sans tenir compte de la casse
+            date_from: Date minimale incluse (AAAA-MM-JJ)
+            date_to: Date maximale incluse (AAAA-MM-JJ)
+
+        Returns:
+            tuple: (résumés des sources, curseur de la page suivante ou None)
+
+        Raises:
+            ValueError: Si le curseur est invalide
+        """
+        conditions, params = [], []
+        if cursor:
+            conditions.append("(timestamp, id) < (?, ?)")
+            params.extend(decode_cursor(cursor))
+        if source_type:
+            conditions.append("type = ?")
+            params.append(source_type.lower())
+        if name:
+            conditions.append("name LIKE ? ESCAPE '\\'")
+            escaped = name.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            params.append(f"%{escaped}%")
+        if date_from:
+            conditions.append("timestamp >= ?")
+            params.append(date_from)
+        if date_to:
+            # Les timestamps ISO du jour `date_to` sont tous inférieurs à "date_to~"
+            conditions.append("timestamp < ?")
+            params.append(date_to + "~")
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self._connect().execute(
+            f"SELECT * FROM sources {where} ORDER BY timestamp DESC, id DESC LIMIT ?",
+            (*params, limit + 1)
+        ).fetchall()
+
+        sources = [dict(row) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            next_cursor = encode_cursor(last["timestamp"], last["id"])
+        return sources, next_cursor
+
+    def link_chunks(self, source: str, chunk_ids: List[str]) -> None:
+        """Rattache des morceaux (nouveaux ou déjà indexés) à une source."""
+        connection = self._connect()
+        with connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO chunk_links (chunk_id, source) VALUES (?, ?)",
+                [(chunk_id, source) for chunk_id in chunk_ids]
+            )
+
+    def unlink_chunks(self, source: str, chunk_ids: Optional[List[str]] = None) -> List[str]:
+        """Détache des morceaux d'une source (tous si `chunk_ids` est None).
+
+        Returns:
+            Les IDs des morceaux qui ne sont plus rattachés à aucune source
+        """
+        connection = self._connect()
+        with connection:
+            if chunk_ids is None:
+                chunk_ids = [row["chunk_id"] for row in connection.execute(
+                    "SELECT chunk_id FROM chunk_links WHERE source = ?", (source,)
+                )]
+            connection.executemany(
+                "DELETE FROM chunk_links WHERE chunk_id = ? AND source = ?",
+                [(chunk_id, source) for chunk_id in chunk_ids]
+            )
+            still_linked = self._linked(connection, chunk_ids)
+        return [chunk_id for chunk_id in chunk_ids if chunk_id not in still_linked]
+
+    def sources_for_chunks(self, chunk_ids: List[str]) -> Dict[str, List[str]]:
+        """Retourne, pour chaque morceau, les sources auxquelles il est rattaché."""
+        sources = {}
+        for row in self._select_links(self._connect(), chunk_ids):
+            sources.setdefault(row["chunk_id"], []).append(row["source"])
+        return sources
+
+    def _linked(self, connection, chunk_ids: List[str]) -> set:
+        return {row["chunk_id"] for row in self._select_links(connection, chunk_ids)}
+
+    @staticmethod
+    def _select_links(connection, chunk_ids: List[str]):
+        rows = []
+        # SQLite limite le nombre de paramètres par requête
+        for i in range(0, len(chunk_ids), 500):
+            part = chunk_ids[i:i + 500]
+            rows.extend(connection.execute(
+                f"SELECT chunk_id, source FROM chunk_links WHERE chunk_id IN ({','.join('?' * len(part))})",
+                part
+            ).fetchall())
+        return rows
+
+    def rebuild(self) -> int:
+        """Reconstruit le catalogue à partir des fichiers de métadonnées du dossier des sources.
+
+        Returns:
+            Le nombre de sources indexées
+        """
+        if not os.path.exists(self.sources_dir):
+            return 0
+
+        summaries = []
+        for filename in os.listdir(self.sources_dir):
+            if not (filename.startswith('metadata_') and filename.endswith('.json')):
+                continue
+            try:
+                with open(os.path.join(self.sources_dir, filename), 'r', encoding='utf-8') as f:
+                    summaries.append(summarize_source(filename, json.load(f)))
+            except Exception as e:
+                logger.error("Erreur lors de la lecture de %s : %s", filename, str(e))
+
+        connection = self._connect()
+        with connection:
+            connection.execute("DELETE FROM sources")
+            for summary in summaries:
+                self._insert(connection, summary)
+        logger.info("Catalogue des sources reconstruit : %d sources", len(summaries))
+        return len(summaries)
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_source_catalog() -> SourceCatalog:
+    """Retourne le catalogue des sources partagé par le processus."""
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = SourceCatalog(os.getenv('SOURCES_DB_PATH', 'save/sources.db'))
+        return _catalog
@@ -2,7 +2,22 @@ import json
 import os
 from datetime import datetime
 import shutil
+import tarfile
+import uuid
+import zipfile
 from typing import Dict, Any, List
+from cache import bump_corpus_version
+from indexer import delete_chunks
+from discussion_store import get_discussion_store, get_discussion_writer, discussion_id_from_path
+from metrics import span
+from registry import get_collection
+from sessions import get_session_manager
+from source_catalog import get_source_catalog
+
+# Archives uploadées : extensions reconnues et limites de décompression
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz')
+ARCHIVE_MAX_MEMBERS = int(os.getenv('ARCHIVE_MAX_MEMBERS', 1000))
+ARCHIVE_MAX_MEMBER_SIZE = int(os.getenv('ARCHIVE_MAX_MEMBER_SIZE', 200 * 1024 * 1024))
 
 def ensure_directories_exist():
     """Crée les dossiers nécessaires pour le stockage."""
@@ -12,7 +27,8 @@ def ensure_directories_exist():
 
 def save_discussion(question: str,response:str, context_used: List[str] = None):
     """
-    Sauvegarde une discussion dans un fichier JSON.
+    Sauvegarde une discussion dans le stockage des discussions.
+    L'écriture est différée : elle est faite par la file d'écriture des discussions.
     
     Args:
         question: La question posée par l'utilisateur
@@ -31,34 +47,28 @@ def save_discussion(question: str,response:str, context_used: List[str] = None):
         "time": timestamp.strftime("%H:%M:%S")
     }
     
-    # Nom du fichier basé sur la date et l'heure
-    filename = f"discussion_{timestamp.strftime('%Y%m%d_%H%M%S')}.json"
-    filepath = os.path.join('save/discussions', filename)
+    # Nom du fichier basé sur la date et l'heure, suffixé pour que deux réponses de la même seconde ne s'écrasent pas
+    filename = f"discussion_{timestamp.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.json"
     
     try:
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(discussion_data, f, ensure_ascii=False, indent=2)
-        print(f"Discussion sauvegardée : {filepath}")
+        get_discussion_writer().save(discussion_id_from_path(filename), discussion_data)
+        print(f"Discussion mise en file de sauvegarde : {filename}")
         return filename
     except Exception as e:
         print(f"Erreur lors de la sauvegarde de la discussion : {str(e)}")
         return None
 
 def append_message_to_discussion(filepath: str, message: dict):
+    """
+    Ajoute un message à une discussion, sans réécrire les messages précédents.
+    La session côté serveur de la discussion est tenue à jour.
+    
+    Args:
+        filepath: Chemin du fichier de discussion envoyé par le frontend
+        message: Le message à ajouter
+    """
     try:
-        if os.path.exists(filepath):
-            with open(filepath, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            data["messages"].append(message)
-        else:
-            data = {
-                "timestamp": datetime.now().isoformat(),
-                "messages": [message],
-                "date": datetime.now().strftime("%Y-%m-%d"),
-                "time": datetime.now().strftime("%H:%M:%S"),
-            }
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        get_session_manager().append(discussion_id_from_path(filepath), message)
         print(f"Message ajouté à la discussion: {filepath}")
     except Exception as e:
         print(f"Erreur append message: {e}")
@@ -74,10 +84,12 @@ def save_uploaded_text(text):
     timestamp = datetime.now()
     
     preview = text[:10].replace('\n', ' ').replace('\r', ' ')
-    filename = f"{timestamp.strftime('%Y%m%d_%H%M%S')}_{preview}...txt"
-    file_path = os.path.join("save/sources", filename)
 
     try:
+        # Chemin unique : deux textes envoyés dans la même seconde ne partagent ni fichier ni source
+        file_path = unique_source_path(f"{timestamp.strftime('%Y%m%d_%H%M%S')}_{preview}...txt")
+        filename = os.path.basename(file_path)
+
         # Sauvegarde du texte brut
         with open(file_path, 'w', encoding='utf-8') as f:
             f.write(text)
@@ -91,11 +103,12 @@ def save_uploaded_text(text):
             "preview": preview + "..." if len(text) > 10 else preview,
         }
 
-        metadata_filename = f"metadata_{timestamp.strftime('%Y%m%d_%H%M%S')}.json"
+        metadata_filename = f"{upload_source_id(file_path)}.json"
         metadata_path = os.path.join("save/sources", metadata_filename)
 
         with open(metadata_path, 'w', encoding='utf-8') as f:
             json.dump(metadata, f, ensure_ascii=False, indent=2)
+        get_source_catalog().add(metadata_filename, metadata)
 
         print(f"Fichier sauvegardé : {file_path}")
         print(f"Métadonnées : {metadata_path}")
@@ -115,24 +128,73 @@ def save_uploaded_file(file, processed_documents: List[Dict]):
         file: Le fichier uploadé
         processed_documents: Les documents traités extraits du fichier (avec chunks LangChain)
     """
+    file_path, timestamp = save_uploaded_raw_file(file)
+    if file_path is None:
+        return None, None, None
+    metadata_path, metadata_filename = save_uploaded_file_metadata(
+        file_path, file.filename, timestamp, processed_documents
+    )
+    return file_path, metadata_path, metadata_filename
+
+@span('ingest', 'save_upload')
+def save_uploaded_raw_file(file):
+    """
+    Sauvegarde le fichier uploadé tel quel, avant tout traitement.
+    
+    Le fichier n'apparaît dans l'historique des sources qu'une fois ses
+    métadonnées écrites par save_uploaded_file_metadata.
+    
+    Args:
+        file: Le fichier uploadé
+        
+    Returns:
+        tuple: (chemin du fichier sauvegardé, horodatage de l'upload), ou (None, None)
+    """
     ensure_directories_exist()
     
     timestamp = datetime.now()
     
-    # Sauvegarde du fichier original
-    filename = f"{timestamp.strftime('%Y%m%d_%H%M%S')}_{file.filename}"
-    file_path = os.path.join('save/sources', filename)
-    
     try:
+        # Sauvegarde du fichier original
+        file_path = unique_source_path(f"{timestamp.strftime('%Y%m%d_%H%M%S')}_{os.path.basename(file.filename)}")
+        
         # Réinitialiser le pointeur du fichier au début
         file.seek(0)
         with open(file_path, 'wb') as f:
             shutil.copyfileobj(file, f)
+        print(f"Fichier source sauvegardé : {file_path}")
+        return file_path, timestamp
+    
+    except Exception as e:
+        print(f"Erreur lors de la sauvegarde du fichier source : {str(e)}")
+        return None, None
+
+def upload_source_id(file_path: str) -> str:
+    """ID de la source (catalogue) d'un fichier uploadé, connu dès que le fichier est sauvegardé."""
+    return f"metadata_{os.path.basename(file_path)}"
+
+@span('ingest', 'save_metadata')
+def save_uploaded_file_metadata(file_path: str, original_filename: str, timestamp: datetime,
+                                processed_documents: List[Dict]):
+    """
+    Écrit les métadonnées d'un fichier uploadé une fois son traitement terminé.
+    
+    Args:
+        file_path: Chemin du fichier sauvegardé par save_uploaded_raw_file
+        original_filename: Nom du fichier envoyé par l'utilisateur
+        timestamp: Horodatage de l'upload
+        processed_documents: Les documents traités extraits du fichier (avec chunks LangChain)
         
+    Returns:
+        tuple: (chemin des métadonnées, nom du fichier de métadonnées), ou (None, None)
+    """
+    filename = os.path.basename(file_path)
+    
+    try:
         # Sauvegarde des métadonnées avec informations sur les chunks
         metadata = {
             "timestamp": timestamp.isoformat(),
-            "original_filename": file.filename,
+            "original_filename": original_filename,
             "saved_filename": filename,
             "file_path": file_path,
             "chunks_processed": len(processed_documents),
@@ -144,7 +206,7 @@ def save_uploaded_file(file, processed_documents: List[Dict]):
             "documents_content": [
                 {
                     "chunk_index": doc.get('chunk_index', i),
-                    "content_length": len(doc['content']),
+                    "content_length": doc.get('content_length', len(doc['content'])),
                     "content_preview": doc['content'][:200] + "..." if len(doc['content']) > 200 else doc['content'],
                     "metadata": doc.get('metadata', {})
                 }
@@ -152,78 +214,175 @@ def save_uploaded_file(file, processed_documents: List[Dict]):
             ]
         }
         
-        metadata_filename = f"metadata_{timestamp.strftime('%Y%m%d_%H%M%S')}_{file.filename}.json"
+        metadata_filename = f"{upload_source_id(file_path)}.json"
         metadata_path = os.path.join('save/sources', metadata_filename)
         
         with open(metadata_path, 'w', encoding='utf-8') as f:
             json.dump(metadata, f, ensure_ascii=False, indent=2)
+        get_source_catalog().add(metadata_filename, metadata)
         
-        print(f"Fichier source sauvegardé : {file_path}")
         print(f"Métadonnées sauvegardées : {metadata_path}")
         
-        return file_path, metadata_path, metadata_filename
+        return metadata_path, metadata_filename
         
     except Exception as e:
-        print(f"Erreur lors de la sauvegarde du fichier source : {str(e)}")
-        return None, None, None
+        print(f"Erreur lors de la sauvegarde des métadonnées : {str(e)}")
+        return None, None
 
-def get_discussions_history(limit: int = 10) -> List[Dict]:
+def unique_source_path(filename: str) -> str:
+    """
+    Chemin libre dans save/sources : un suffixe est ajouté si le nom est déjà pris
+    (plusieurs fichiers du même nom uploadés dans la même seconde). Le fichier
+    est créé vide pour réserver le chemin face aux uploads simultanés.
     """
-    Récupère l'historique des discussions.
+    stem, extension = os.path.splitext(filename)
+    file_path = os.path.join('save/sources', filename)
+    counter = 1
+    while True:
+        try:
+            with open(file_path, 'x'):
+                return file_path
+        except FileExistsError:
+            file_path = os.path.join('save/sources', f"{stem}_{counter}{extension}")
+            counter += 1
+
+def is_archive(filename: str) -> bool:
+    """Indique si le fichier est une archive zip ou tar acceptée en upload."""
+    return filename.lower().endswith(ARCHIVE_EXTENSIONS)
+
+def expand_archive(archive_path: str, extensions=('.pdf', '.txt')) -> List[Dict]:
+    """
+    Décompresse dans save/sources les fichiers d'une archive zip ou tar, puis supprime l'archive.
+    
+    Seuls les fichiers aux extensions acceptées sont extraits ; les chemins
+    internes sont ignorés (seul le nom du fichier est gardé) pour qu'aucun
+    membre ne puisse être écrit hors du dossier des sources.
     
     Args:
-        limit: Nombre maximum de discussions à retourner
+        archive_path: Chemin de l'archive sauvegardée
+        extensions: Extensions des fichiers à extraire
         
     Returns:
-        Liste des discussions récentes avec leurs IDs
+        Liste de dictionnaires {file_path, filename} des fichiers extraits
     """
-    discussions_dir = 'save/discussions'
-    if not os.path.exists(discussions_dir):
-        return []
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    extracted = []
+    
+    def extract(name, size, open_member):
+        filename = os.path.basename(name)
+        if not filename.lower().endswith(extensions) or filename.startswith('.'):
+            return
+        if size > ARCHIVE_MAX_MEMBER_SIZE:
+            print(f"Fichier ignoré (trop volumineux) : {name}")
+            return
+        if len(extracted) >= ARCHIVE_MAX_MEMBERS:
+            raise ValueError(f"L'archive contient plus de {ARCHIVE_MAX_MEMBERS} fichiers")
+        file_path = unique_source_path(f"{timestamp}_{filename}")
+        with open_member() as source, open(file_path, 'wb') as f:
+            shutil.copyfileobj(source, f)
+        extracted.append({"file_path": file_path, "filename": filename})
     
-    discussions = []
-    files = sorted(os.listdir(discussions_dir), reverse=True)
+    try:
+        if archive_path.lower().endswith('.zip'):
+            with zipfile.ZipFile(archive_path) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir():
+                        extract(info.filename, info.file_size, lambda: archive.open(info))
+        else:
+            # Lecture en flux : les membres sont extraits au fil de l'archive
+            with tarfile.open(archive_path, 'r|*') as archive:
+                for info in archive:
+                    if info.isfile():
+                        extract(info.name, info.size, lambda: archive.extractfile(info))
+    except Exception:
+        for member in extracted:
+            os.remove(member["file_path"])
+        raise
+    finally:
+        os.remove(archive_path)
     
-    for filename in files[:limit]:
-        if filename.endswith('.json'):
-            filepath = os.path.join(discussions_dir, filename)
-            try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    discussion = json.load(f)
-                    discussion['id'] = filename.replace('.json', '')
-                    discussion['filename'] = filename
-                    discussions.append(discussion)
-            except Exception as e:
-                print(f"Erreur lors de la lecture de {filename} : {str(e)}")
+    print(f"Archive décompressée : {len(extracted)} fichiers extraits de {archive_path}")
+    return extracted
+
+def get_discussions_page(limit: int = 20, cursor: str = None):
+    """
+    Liste les résumés des discussions (titre, date, nombre de messages, taille), page par page.
     
-    return discussions
+    Args:
+        limit: Nombre maximum de discussions à retourner
+        cursor: Curseur de la page précédente, None pour la première page
+        
+    Returns:
+        tuple: (résumés des discussions, curseur de la page suivante ou None)
+        
+    Raises:
+        ValueError: Si le curseur est invalide
+    """
+    return get_discussion_store().list_summaries(limit, cursor)
 
-def get_sources_history() -> List[Dict]:
+def get_discussion(discussion_id: str):
     """
-    Récupère l'historique des fichiers sources.
+    Récupère une discussion complète avec ses messages.
     
+    Args:
+        discussion_id: L'ID de la discussion
+        
     Returns:
-        Liste des fichiers sources avec leurs métadonnées
+        La discussion, ou None si elle n'existe pas
     """
-    sources_dir = 'save/sources'
-    if not os.path.exists(sources_dir):
-        return []
+    writer = get_discussion_writer()
+    if writer.has_pending(discussion_id):
+        writer.flush()
+    discussion = get_discussion_store().get(discussion_id)
+    if discussion is not None:
+        discussion['filename'] = f"{discussion_id}.json"
+    return discussion
+
+def get_sources_page(limit: int = 20, cursor: str = None, source_type: str = None,
+                     name: str = None, date_from: str = None, date_to: str = None):
+    """
+    Liste les résumés des fichiers sources depuis le catalogue, filtrés et paginés.
     
-    sources = []
-    files = [f for f in os.listdir(sources_dir) if f.startswith('metadata_') and f.endswith('.json')]
+    Args:
+        limit: Nombre maximum de sources à retourner
+        cursor: Curseur de la page précédente, None pour la première page
+        source_type: Filtre sur le type de source (pdf, text, ...)
+        name: Filtre sur un fragment du nom
+        date_from: Date minimale incluse (AAAA-MM-JJ)
+        date_to: Date maximale incluse (AAAA-MM-JJ)
+        
+    Returns:
+        tuple: (résumés des sources, curseur de la page suivante ou None)
+        
+    Raises:
+        ValueError: Si le curseur est invalide
+    """
+    return get_source_catalog().list(limit, cursor, source_type, name, date_from, date_to)
+
+def get_source(source_id: str):
+    """
+    Récupère les métadonnées complètes d'une source, avec l'aperçu de ses morceaux.
     
-    for filename in sorted(files, reverse=True):
-        filepath = os.path.join(sources_dir, filename)
-        try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                metadata = json.load(f)
-                metadata['id'] = filename.replace('.json', '')
-                metadata['metadata_filename'] = filename
-                sources.append(metadata)
-        except Exception as e:
-            print(f"Erreur lors de la lecture de {filename} : {str(e)}")
+    Args:
+        source_id: L'ID du fichier source
+        
+    Returns:
+        Les métadonnées de la source, ou None si elle n'existe pas
+    """
+    summary = get_source_catalog().get(source_id)
+    if summary is None:
+        return None
+    
+    metadata_filepath = os.path.join('save/sources', summary['metadata_filename'])
+    try:
+        with open(metadata_filepath, 'r', encoding='utf-8') as f:
+            metadata = json.load(f)
+    except FileNotFoundError:
+        return None
     
-    return sources
+    metadata['id'] = source_id
+    metadata['metadata_filename'] = summary['metadata_filename']
+    return metadata
 
 def delete_discussion(discussion_id: str) -> bool:
     """
@@ -235,25 +394,59 @@ def delete_discussion(discussion_id: str) -> bool:
     Returns:
         True si la suppression a réussi, False sinon
     """
-    discussions_dir = 'save/discussions'
-    filename = f"{discussion_id}.json"
-    filepath = os.path.join(discussions_dir, filename)
-    
     try:
-        if os.path.exists(filepath):
-            os.remove(filepath)
-            print(f"Discussion supprimée : {filepath}")
+        # Les écritures en file ne doivent pas recréer la discussion après sa suppression
+        get_discussion_writer().flush()
+        get_session_manager().forget(discussion_id)
+        if get_discussion_store().delete(discussion_id):
+            print(f"Discussion supprimée : {discussion_id}")
             return True
         else:
-            print(f"Fichier de discussion non trouvé : {filepath}")
+            print(f"Discussion non trouvée : {discussion_id}")
             return False
     except Exception as e:
         print(f"Erreur lors de la suppression de la discussion : {str(e)}")
         return False
 
+def delete_source_chunks(source_id: str) -> int:
+    """
+    Détache les morceaux d'une source et supprime de la base vectorielle (et de
+    l'index lexical) ceux qui ne sont plus rattachés à aucune autre source.
+    
+    Args:
+        source_id: L'ID de la source dans le catalogue
+        
+    Returns:
+        Le nombre de morceaux supprimés
+    """
+    orphans = get_source_catalog().unlink_chunks(source_id)
+    if orphans:
+        delete_chunks(get_collection(), orphans)
+    return len(orphans)
+
+def discard_unlinked_chunks(chunk_ids: List[str], collection=None) -> int:
+    """
+    Supprime de la base vectorielle (et de l'index lexical) ceux des morceaux
+    donnés qui ne sont rattachés à aucune source : ceux d'une ingestion en échec.
+    
+    Args:
+        chunk_ids: IDs des morceaux à examiner
+        collection: Collection ChromaDB (celle du registre partagé par défaut)
+        
+    Returns:
+        Le nombre de morceaux supprimés
+    """
+    chunk_ids = list(dict.fromkeys(chunk_ids))
+    linked = get_source_catalog().sources_for_chunks(chunk_ids)
+    orphans = [chunk_id for chunk_id in chunk_ids if chunk_id not in linked]
+    if orphans:
+        delete_chunks(collection if collection is not None else get_collection(), orphans)
+    return len(orphans)
+
 def delete_source(source_id: str) -> bool:
     """
-    Supprime un fichier source et ses métadonnées.
+    Supprime un fichier source, ses métadonnées et ses morceaux qui ne sont
+    partagés avec aucune autre source.
     
     Args:
         source_id: L'ID du fichier source à supprimer
@@ -279,7 +472,11 @@ def delete_source(source_id: str) -> bool:
             
             # Supprimer les métadonnées
             os.remove(metadata_filepath)
+            get_source_catalog().remove(source_id)
             print(f"Métadonnées supprimées : {metadata_filepath}")
+            removed = delete_source_chunks(source_id)
+            print(f"Morceaux supprimés de la base : {removed}")
+            bump_corpus_version()
             
             return True
         else:
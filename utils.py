@@ -1,14 +1,31 @@
 import PyPDF2
 import logging
-from chromadb.utils import embedding_functions
 import os
-from io import BytesIO
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.document_loaders import DirectoryLoader
-from langchain.schema import Document
+from langchain.document_loaders import DirectoryLoader, TextLoader
+from cache import bump_corpus_version
+from indexer import BulkIndexer, chunk_content_id
+from metrics import span, timed_iter
+from pdf_extract import iter_pages_parallel
+from source_catalog import get_source_catalog
+from storage import discard_unlinked_chunks
 
 logger = logging.getLogger(__name__)
 
+# Ingestion des PDF : nombre de pages découpées à la fois
+PDF_WINDOW_PAGES = int(os.getenv('PDF_WINDOW_PAGES', 8))
+
+# Extraction multi-processus : nombre de processus, taille minimale du PDF et pages par tâche
+PDF_EXTRACT_WORKERS = int(os.getenv('PDF_EXTRACT_WORKERS', os.cpu_count() or 1))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv('PDF_PARALLEL_MIN_PAGES', 50))
+PDF_PAGES_PER_TASK = int(os.getenv('PDF_PAGES_PER_TASK', 16))
+
+# Ingestion en masse : nombre de fichiers découpés en parallèle
+BULK_EXTRACT_WORKERS = int(os.getenv('BULK_EXTRACT_WORKERS', 4))
+
 def chunk_text(documents, chunk_size, chunk_overlap):
     """Découpe les documents en morceaux de texte selon les paramètres spécifiés.
 
@@ -58,106 +75,346 @@ def load_documents_from_folder(folder_path, chunk_size=512):
         logging.error("Erreur lors du chargement des documents: %s", str(e))
         return []
 
-def process_pdf(file):
+def load_document_file(file_path, chunk_size=1024, chunk_overlap=100):
+    """Charge un fichier texte et le découpe en morceaux.
+
+    Args:
+        file_path (str): Chemin du fichier texte.
+        chunk_size (int): Taille maximale de chaque morceau.
+        chunk_overlap (int): Nombre de caractères à chevaucher entre les morceaux.
+
+    Returns:
+        list: Liste des morceaux de texte découpés.
+    """
+    documents = TextLoader(file_path, encoding='utf-8').load()
+    return chunk_text(documents, chunk_size, chunk_overlap)
+
+class StoredUpload:
+    """Fichier uploadé relu depuis le disque, avec l'interface attendue par iter_pdf_pages."""
+
+    def __init__(self, file_path, filename):
+        self.filename = filename
+        self.stream = open(file_path, 'rb')
+
+    def close(self):
+        self.stream.close()
+
+def iter_pdf_pages(file):
     """
-    Traite un fichier PDF, extrait le texte et le découpe en morceaux avec LangChain.
+    Extrait le texte d'un PDF page par page, sans charger le fichier en mémoire.
+    
+    Args:
+        file: Fichier PDF uploadé ou flux binaire positionnable
+        
+    Yields:
+        tuple: (numéro de page à partir de 1, texte de la page)
+    """
+    stream = getattr(file, 'stream', file)
+    stream.seek(0)
+    pdf_reader = PyPDF2.PdfReader(stream)
+    page_count = len(pdf_reader.pages)
+    
+    logger.info(f"Nombre de pages dans le PDF : {page_count}")
+    
+    if PDF_EXTRACT_WORKERS > 1 and page_count >= PDF_PARALLEL_MIN_PAGES:
+        logger.info(f"Extraction parallèle sur {PDF_EXTRACT_WORKERS} processus")
+        pages = iter_pages_parallel(stream, page_count, PDF_EXTRACT_WORKERS, PDF_PAGES_PER_TASK)
+    else:
+        pages = _iter_pages_sequential(pdf_reader)
+    
+    for page_number, page_text, error in timed_iter(pages, 'ingest', 'extract_page'):
+        if error is not None:
+            logger.error(f"Erreur lors de l'extraction de la page {page_number} : {error}")
+            continue
+        
+        if page_text.strip():
+            logger.info(f"Page {page_number} traitée : {len(page_text)} caractères")
+            yield page_number, page_text
+        else:
+            logger.warning(f"Page {page_number} est vide ou ne contient pas de texte extractible")
+
+def _iter_pages_sequential(pdf_reader):
+    for page_num, page in enumerate(pdf_reader.pages):
+        try:
+            yield page_num + 1, page.extract_text(), None
+        except Exception as e:
+            yield page_num + 1, None, str(e)
+
+def iter_pdf_chunks(file, chunk_size=1024, chunk_overlap=100, window_pages=PDF_WINDOW_PAGES):
+    """
+    Découpe un PDF en morceaux au fil de l'extraction des pages.
+    
+    Le texte n'est jamais assemblé en entier : on découpe une fenêtre de
+    `window_pages` pages, on émet tous les morceaux sauf le dernier, qui est
+    reporté au début de la fenêtre suivante pour ne pas couper une phrase.
     
     Args:
         file: Fichier PDF uploadé
+        chunk_size (int): Taille maximale de chaque morceau.
+        chunk_overlap (int): Nombre de caractères à chevaucher entre les morceaux.
+        window_pages (int): Nombre de pages découpées à la fois.
         
-    Returns:
-        List[Document]: Liste des documents LangChain découpés
+    Yields:
+        Document: Morceaux LangChain, avec les pages de début et de fin dans les métadonnées
     """
-    try:
-        # Lire le fichier PDF depuis la mémoire
-        pdf_content = file.read()
-        pdf_file = BytesIO(pdf_content)
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=len,
+        add_start_index=True,
+    )
+    
+    # Fenêtre courante : morceaux de texte et page de chacun
+    parts = []
+    pages_in_window = 0
+    window_offset = 0
+    
+    def split_window(final):
+        nonlocal parts, window_offset
+        text = ''.join(part for _, part in parts)
+        
+        # Positions de début de chaque page dans la fenêtre
+        page_starts = []
+        position = 0
+        for page_number, part in parts:
+            page_starts.append((position, page_number))
+            position += len(part)
+        
+        def page_at(offset):
+            page = page_starts[0][1]
+            for start, page_number in page_starts:
+                if start > offset:
+                    break
+                page = page_number
+            return page
+        
+        with span('ingest', 'chunk'):
+            chunks = text_splitter.create_documents([text])
+        if not final and len(chunks) > 1:
+            carry_start = chunks[-1].metadata['start_index']
+            chunks = chunks[:-1]
+        else:
+            carry_start = len(text)
+        
+        for chunk in chunks:
+            start = chunk.metadata['start_index']
+            end = start + max(len(chunk.page_content) - 1, 0)
+            chunk.metadata = {
+                'filename': file.filename,
+                'start_index': window_offset + start,
+                'page': page_at(start),
+                'page_end': page_at(end),
+            }
+            yield chunk
         
-        pdf_reader = PyPDF2.PdfReader(pdf_file)
+        # Le dernier morceau (incomplet) est reporté dans la fenêtre suivante
+        carried = []
+        for (start, page_number), (_, part) in zip(page_starts, parts):
+            end = start + len(part)
+            if end > carry_start:
+                carried.append((page_number, part[max(carry_start - start, 0):]))
+        parts = carried
+        window_offset += carry_start
+    
+    for page_number, page_text in iter_pdf_pages(file):
+        parts.append((page_number, page_text + '\n'))
+        pages_in_window += 1
+        if pages_in_window >= window_pages:
+            yield from split_window(final=False)
+            pages_in_window = len(parts)
+    
+    if parts:
+        yield from split_window(final=True)
+
+def iter_file_chunks(file_path, filename, chunk_size=1024, chunk_overlap=100):
+    """
+    Découpe un fichier sauvegardé (PDF ou texte) en morceaux.
+    
+    Args:
+        file_path (str): Chemin du fichier sur le disque.
+        filename (str): Nom d'origine du fichier, repris dans les métadonnées.
         
-        logger.info(f"Nombre de pages dans le PDF : {len(pdf_reader.pages)}")
+    Yields:
+        Document: Morceaux LangChain, numérotés dans le fichier
+    """
+    if filename.lower().endswith('.pdf'):
+        upload = StoredUpload(file_path, filename)
+        try:
+            chunks = iter_pdf_chunks(upload, chunk_size, chunk_overlap)
+            for chunk_index, chunk in enumerate(chunks):
+                chunk.metadata['chunk_index'] = chunk_index
+                yield chunk
+        finally:
+            upload.close()
+    else:
+        with span('ingest', 'chunk'):
+            chunks = load_document_file(file_path, chunk_size, chunk_overlap)
+        for chunk_index, chunk in enumerate(chunks):
+            chunk.metadata = {
+                'filename': filename,
+                'start_index': chunk.metadata.get('start_index', 0),
+                'chunk_index': chunk_index,
+            }
+            yield chunk
+
+def iter_files_chunks(files, workers=BULK_EXTRACT_WORKERS):
+    """
+    Découpe plusieurs fichiers en parallèle et fusionne leurs morceaux en un seul flux.
+    
+    Chaque fichier est découpé dans un thread du pool (les gros PDF passent en
+    plus par le pool de processus d'extraction). Les morceaux sont transmis par
+    une file bornée, au fil de l'eau, ce qui permet au moteur d'indexation de
+    remplir ses lots avec des morceaux de fichiers différents.
+    
+    Args:
+        files (list): Tuples (chemin du fichier, nom d'origine)
+        workers (int): Nombre de fichiers découpés en même temps
         
-        # Extraire tout le texte du PDF
-        text = ''
-        for page_num, page in enumerate(pdf_reader.pages):
+    Yields:
+        tuple: (index du fichier, Document, None) pour chaque morceau, puis
+        (index du fichier, None, message d'erreur ou None) quand le fichier est terminé
+    """
+    results = queue.Queue(maxsize=256)
+    stop = threading.Event()
+    
+    def put(item):
+        # Le consommateur peut abandonner le flux : on ne bloque pas indéfiniment
+        while not stop.is_set():
             try:
-                page_text = page.extract_text()
-                if page_text.strip():
-                    text += page_text + '\n'
-                    logger.info(f"Page {page_num + 1} traitée : {len(page_text)} caractères")
-                else:
-                    logger.warning(f"Page {page_num + 1} est vide ou ne contient pas de texte extractible")
-                    
-            except Exception as e:
-                logger.error(f"Erreur lors de l'extraction de la page {page_num + 1} : {str(e)}")
+                results.put(item, timeout=0.5)
+                return
+            except queue.Full:
                 continue
+    
+    def produce(index, file_path, filename):
+        try:
+            for chunk in iter_file_chunks(file_path, filename):
+                if stop.is_set():
+                    return
+                put((index, chunk, None))
+            put((index, None, None))
+        except Exception as e:
+            logger.error(f"Erreur lors du découpage de {filename} : {str(e)}")
+            put((index, None, str(e) or type(e).__name__))
+    
+    executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='bulk-extract')
+    try:
+        for index, (file_path, filename) in enumerate(files):
+            executor.submit(produce, index, file_path, filename)
         
-        if not text.strip():
-            raise Exception("Aucun texte extractible trouvé dans le PDF")
+        remaining = len(files)
+        while remaining:
+            item = results.get()
+            if item[1] is None:
+                remaining -= 1
+            yield item
+    finally:
+        stop.set()
+        executor.shutdown(wait=False)
+
+@span('ingest', 'ingest_pdf')
+def ingest_pdf(file, progress=None, pages_progress=None, source=None):
+    """
+    Extrait, découpe et insère un PDF dans ChromaDB au fil de l'extraction.
+    
+    Les morceaux sont transmis au moteur d'indexation dès qu'ils sont produits :
+    la mémoire utilisée est bornée par une fenêtre de pages et quelques lots,
+    quelle que soit la taille du document.
+    
+    Args:
+        file: Fichier PDF uploadé
+        progress: Appelée avec (morceaux indexés, morceaux en échec) après chaque lot
+        pages_progress: Appelée avec le numéro de la dernière page découpée
+        source: ID de la source (catalogue) à laquelle rattacher les morceaux
         
-        logger.info("Texte extrait du PDF.")
+    Returns:
+        list: Aperçus des morceaux insérés, au format attendu par save_uploaded_file
+    """
+    try:
+        documents_content = []
         
-        # Créer une liste de documents à partir du texte extrait
-        documents = [Document(page_content=text, metadata={'filename': file.filename})]
+        def chunks():
+            for doc in iter_pdf_chunks(file, chunk_size=1024, chunk_overlap=100):
+                documents_content.append({
+                    'content': doc.page_content[:201],
+                    'content_length': len(doc.page_content),
+                    'chunk_index': len(documents_content),
+                    'filename': file.filename,
+                    'metadata': doc.metadata
+                })
+                if pages_progress:
+                    pages_progress(doc.metadata['page_end'])
+                yield doc
         
-        # Découper les documents en morceaux avec LangChain
-        documents = chunk_text(documents, chunk_size=1024, chunk_overlap=100)
+        inserted = insert_to_chroma(chunks(), progress=progress, source=source)
         
-        logger.info(f"Extraction et découpage terminés : {len(documents)} morceaux créés")
-        return documents
+        if not documents_content:
+            raise Exception("Aucun texte extractible trouvé dans le PDF")
+        
+        logger.info(f"Extraction, découpage et insertion terminés : {inserted} morceaux créés")
+        return documents_content
         
     except Exception as e:
         logger.error(f"Erreur lors du traitement du PDF : {str(e)}")
         raise
 
-def insert_to_chroma(documents, chroma_client):
+@span('ingest', 'insert_to_chroma')
+def insert_to_chroma(documents, collection=None, progress=None, source=None, inserted_ids=None):
     """
-    Insère les documents LangChain traités dans ChromaDB.
+    Insère les documents LangChain traités dans ChromaDB, par lots concurrents.
+    
+    Les IDs sont dérivés du contenu des morceaux : un morceau déjà présent dans
+    la collection (ré-upload, passage commun à deux documents) n'est ni
+    recalculé ni réinséré, il est seulement rattaché à la nouvelle source.
     
     Args:
-        documents: Liste des documents LangChain à insérer
-        chroma_client: Client ChromaDB
-    """
-    try:
-        # Configuration de l'embedding
-        embeddings_model = embedding_functions.OpenAIEmbeddingFunction(
-            model_name="text-embedding-3-small", 
-            api_key=os.getenv('OPENAI_API_KEY')
-        )
-        
-        # Récupérer ou créer la collection
-        collection = chroma_client.get_or_create_collection(
-            name="Documents", 
-            embedding_function=embeddings_model
-        )
-        
-        # Préparer les données pour l'insertion
-        texts = []
-        metadatas = []
-        ids = []
+        documents: Documents LangChain à insérer (liste ou générateur)
+        collection: Collection ChromaDB cible (celle du registre partagé par défaut)
+        progress: Appelée avec (morceaux indexés, morceaux en échec) après chaque lot
+        source: ID de la source (catalogue) à laquelle rattacher les morceaux une fois
+            tous indexés ; sans source, l'appelant pose lui-même les liens. En cas
+            d'échec, les morceaux insérés et rattachés à aucune source sont retirés
+        inserted_ids: Liste complétée, même en cas d'échec, par les IDs des morceaux
+            nouvellement insérés (pas ceux déjà présents)
         
+    Returns:
+        int: Le nombre de morceaux traités (insérés ou déjà présents)
+    """
+    indexer = BulkIndexer(collection, progress=progress, dedupe=True)
+    chunk_ids = []
+    
+    def items():
         for i, doc in enumerate(documents):
-            texts.append(doc.page_content)
-            
             # Préparer les métadonnées
             metadata = doc.metadata.copy()
-            metadata['chunk_index'] = i
-            metadatas.append(metadata)
+            metadata.setdefault('chunk_index', i)
             
-            # Générer un ID unique
-            filename = doc.metadata.get('filename', 'unknown')
-            doc_id = f"{filename}_{i}"
-            ids.append(doc_id)
-        
-        # Insertion dans ChromaDB
-        collection.add(
-            documents=texts,
-            metadatas=metadatas,
-            ids=ids
-        )
-        
-        logger.info(f"Insertion réussie : {len(texts)} morceaux ajoutés à ChromaDB")
+            # ID dérivé du contenu : deux morceaux identiques partagent le même ID
+            chunk_id = chunk_content_id(doc.page_content)
+            chunk_ids.append(chunk_id)
+            yield chunk_id, doc.page_content, metadata
+    
+    try:
+        indexer.index(items())
+        if source:
+            get_source_catalog().link_chunks(source, chunk_ids)
+        logger.info(f"Insertion réussie : {indexer.indexed} morceaux ajoutés à ChromaDB, "
+                    f"{indexer.reused} déjà présents")
+        return indexer.indexed + indexer.reused
         
     except Exception as e:
         logger.error(f"Erreur lors de l'insertion dans ChromaDB : {str(e)}")
+        # Sans lien vers la source, ces morceaux ne pourraient plus jamais être supprimés
+        if source and indexer.inserted_ids:
+            try:
+                discarded = discard_unlinked_chunks(indexer.inserted_ids, indexer.collection)
+                logger.info(f"{discarded} morceaux insérés avant l'échec retirés de ChromaDB")
+            except Exception as cleanup_error:
+                logger.error(f"Erreur lors du retrait des morceaux insérés : {str(cleanup_error)}")
         raise
+    
+    finally:
+        if inserted_ids is not None:
+            inserted_ids.extend(indexer.inserted_ids)
+        if indexer.indexed or indexer.reused:
+            bump_corpus_version()
@@ -0,0 +1,477 @@
+import json
+import logging
+import os
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from db import get_connection
+
+logger = logging.getLogger(__name__)
+
+# Au-delà de ce nombre de vecteurs, la recherche passe par l'index IVF (approché)
+VECTOR_IVF_MIN_SIZE = int(os.getenv('VECTOR_IVF_MIN_SIZE', 50000))
+# Nombre de listes IVF sondées par requête (0 : automatique)
+VECTOR_IVF_NPROBE = int(os.getenv('VECTOR_IVF_NPROBE', 0))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    row INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    document TEXT,
+    metadata TEXT,
+    seq INTEGER NOT NULL,
+    deleted INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_items_seq ON items (seq);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+_GROWTH_ROWS = 1024
+_SEARCH_BLOCK = 65536
+
+
+class VectorIndex:
+    """Index vectoriel embarqué et persistant, avec l'interface d'une collection Chroma.
+
+    Les vecteurs float32 et leurs normes sont dans des fichiers mappés en
+    mémoire ; les IDs, documents et métadonnées dans une base SQLite à côté.
+    Une ligne supprimée devient une ligne libre, réutilisée par la prochaine
+    insertion. Les distances sont des L2 au carré, comme l'espace `l2` de Chroma.
+
+    La recherche est exacte (produit matriciel NumPy) jusqu'à VECTOR_IVF_MIN_SIZE
+    vecteurs ; au-delà, un index IVF (k-means) limite la recherche aux listes
+    les plus proches de la requête. Chaque écriture prend le verrou d'écriture
+    SQLite : plusieurs processus peuvent partager l'index, chacun rechargeant
+    les lignes modifiées (repérées par leur numéro de séquence) avant de lire.
+    """
+
+    def __init__(self, path: str, name: str, embedding_function=None):
+        """
+        Args:
+            path: Dossier de l'index (créé s'il n'existe pas)
+            name: Nom de la collection
+            embedding_function: Fonction d'embedding, pour les requêtes par texte
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.name = name
+        self._embedding_function = embedding_function
+        self._lock = threading.RLock()
+        self._dimension = None
+        self._capacity = 0
+        self._vectors = None
+        self._norms = None
+        self._assignments = None
+        self._centroids = None
+        self._ivf_lists = None
+        self._ivf_built_size = 0
+        self._ivf_version = None
+        self._ids: Dict[str, int] = {}
+        self._row_ids: List[Optional[str]] = []
+        self._active = np.zeros(0, dtype=bool)
+        self._free_rows: List[int] = []
+        self._seq = 0
+        self._connect().executescript(SCHEMA)
+        with self._lock:
+            self._refresh()
+
+    def _connect(self):
+        return get_connection(os.path.join(self.path, 'meta.db'))
+
+    # Stockage des vecteurs
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _map(self, capacity: int) -> None:
+        """(Re)mappe les fichiers de vecteurs, de normes et d'affectations IVF à la capacité donnée."""
+        files = (
+            ('vectors.f32', np.float32, (capacity, self._dimension)),
+            ('norms.f32', np.float32, (capacity,)),
+            ('assign.i32', np.int32, (capacity,)),
+        )
+        mapped = []
+        for filename, dtype, shape in files:
+            path = self._file(filename)
+            size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            with open(path, 'ab') as f:
+                if f.tell() < size:
+                    f.truncate(size)
+            mapped.append(np.memmap(path, dtype=dtype, mode='r+', shape=shape))
+        self._vectors, self._norms, self._assignments = mapped
+        self._capacity = capacity
+        if len(self._active) < capacity:
+            self._active = np.concatenate([self._active, np.zeros(capacity - len(self._active), dtype=bool)])
+            self._row_ids.extend([None] * (capacity - len(self._row_ids)))
+
+    def _settings(self, connection) -> Dict[str, str]:
+        return {row["key"]: row["value"] for row in connection.execute("SELECT key, value FROM settings")}
+
+    def _refresh(self) -> None:
+        """Applique les lignes écrites depuis le dernier rechargement (par ce processus ou un autre)."""
+        connection = self._connect()
+        last_seq, ivf_version = connection.execute(
+            "SELECT (SELECT COALESCE(MAX(seq), 0) FROM items), "
+            "(SELECT value FROM settings WHERE key = 'ivf_version')"
+        ).fetchone()
+        if last_seq == self._seq and ivf_version == self._ivf_version and self._vectors is not None:
+            return
+
+        settings = self._settings(connection)
+        if 'dimension' not in settings:
+            return
+        self._dimension = int(settings['dimension'])
+        capacity = int(settings['capacity'])
+        if capacity != self._capacity or self._vectors is None:
+            self._map(capacity)
+
+        changed = []
+        for row in connection.execute(
+            "SELECT row, id, deleted, seq FROM items WHERE seq > ? ORDER BY seq", (self._seq,)
+        ):
+            row_index = row["row"]
+            changed.append(row_index)
+            previous_id = self._row_ids[row_index]
+            if previous_id is not None and self._ids.get(previous_id) == row_index:
+                del self._ids[previous_id]
+            if row["deleted"]:
+                self._row_ids[row_index] = None
+                self._active[row_index] = False
+            else:
+                self._row_ids[row_index] = row["id"]
+                self._ids[row["id"]] = row_index
+                self._active[row_index] = True
+        self._seq = last_seq
+        self._free_rows = np.flatnonzero(~self._active[:self._used_rows(connection)]).tolist()
+
+        if ivf_version != self._ivf_version:
+            # Index IVF (re)construit, éventuellement par un autre processus
+            self._ivf_version = ivf_version
+            self._load_ivf()
+        elif self._ivf_lists is not None and changed:
+            self._extend_lists(np.asarray(changed))
+
+    def _used_rows(self, connection) -> int:
+        return connection.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM items").fetchone()[0]
+
+    # Interface de collection
+
+    def count(self) -> int:
+        """Nombre de vecteurs dans l'index."""
+        with self._lock:
+            self._refresh()
+            return len(self._ids)
+
+    def add(self, ids, embeddings=None, documents=None, metadatas=None) -> None:
+        """Ajoute des vecteurs (identique à `upsert`)."""
+        self.upsert(ids, embeddings, documents, metadatas)
+
+    def upsert(self, ids, embeddings=None, documents=None, metadatas=None) -> None:
+        """Insère ou remplace des vecteurs, avec leurs documents et métadonnées.
+
+        Args:
+            ids: IDs des vecteurs
+            embeddings: Vecteurs (calculés par la fonction d'embedding si absents)
+            documents: Textes associés
+            metadatas: Métadonnées associées
+        """
+        if not ids:
+            return
+        if embeddings is None:
+            embeddings = self._embedding_function(documents)
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        if len(set(ids)) != len(ids):
+            raise ValueError("Les IDs d'une insertion doivent être uniques")
+        documents = documents or [None] * len(ids)
+        metadatas = metadatas or [None] * len(ids)
+
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._refresh()
+                self._ensure_dimension(connection, matrix.shape[1])
+
+                rows = []
+                used_rows = self._used_rows(connection)
+                reused = connection.execute(
+                    f"SELECT id, row FROM items WHERE id IN ({','.join('?' * len(ids))})", list(ids)
+                ).fetchall()
+                existing = {row["id"]: row["row"] for row in reused}
+                free_rows = [row for row in self._free_rows if self._row_ids[row] is None]
+                for doc_id in ids:
+                    if doc_id in existing:
+                        rows.append(existing[doc_id])
+                    elif free_rows:
+                        rows.append(int(free_rows.pop()))
+                    else:
+                        rows.append(used_rows)
+                        used_rows += 1
+
+                if used_rows > self._capacity:
+                    # Le fichier est agrandi par doublement pour amortir les remappages
+                    capacity = max(used_rows, self._capacity * 2, _GROWTH_ROWS)
+                    connection.execute(
+                        "INSERT OR REPLACE INTO settings (key, value) VALUES ('capacity', ?)", (str(capacity),)
+                    )
+                    self._map(capacity)
+
+                rows_array = np.asarray(rows)
+                self._vectors[rows_array] = matrix
+                self._norms[rows_array] = np.einsum('ij,ij->i', matrix, matrix)
+                self._assignments[rows_array] = self._assign(matrix)
+                self._vectors.flush()
+                self._norms.flush()
+                self._assignments.flush()
+
+                seq = self._seq + 1
+                connection.execute("DELETE FROM items WHERE id IN ({}) OR row IN ({})".format(
+                    ','.join('?' * len(ids)), ','.join('?' * len(rows))), [*ids, *rows])
+                connection.executemany(
+                    "INSERT INTO items (row, id, document, metadata, seq) VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (row, doc_id, document, json.dumps(metadata, ensure_ascii=False) if metadata else None, seq)
+                        for row, doc_id, document, metadata in zip(rows, ids, documents, metadatas)
+                    ]
+                )
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+            self._refresh()
+
+    def delete(self, ids=None, where=None) -> None:
+        """Supprime des vecteurs par ID ou par filtre sur les métadonnées."""
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._refresh()
+                rows = self._filter_rows(connection, ids, where)
+                if rows:
+                    placeholders = ','.join('?' * len(rows))
+                    connection.execute(
+                        f"UPDATE items SET deleted = 1, document = NULL, metadata = NULL, "
+                        f"id = '#deleted#' || row, seq = ? WHERE row IN ({placeholders})",
+                        [self._seq + 1, *rows]
+                    )
+                    self._assignments[np.asarray(rows)] = -1
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+            self._refresh()
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include=("documents", "metadatas")) -> Dict:
+        """Récupère des entrées par ID ou par filtre, au format de `Collection.get` de Chroma."""
+        with self._lock:
+            self._refresh()
+            connection = self._connect()
+            rows = self._filter_rows(connection, ids, where)
+            rows = rows[offset or 0:(offset or 0) + limit if limit else None]
+            return self._records(connection, rows, include)
+
+    def query(self, query_embeddings=None, query_texts=None, n_results=10, where=None,
+              include=("documents", "metadatas", "distances")) -> Dict:
+        """Cherche les plus proches voisins, au format de `Collection.query` de Chroma."""
+        if query_embeddings is None:
+            query_embeddings = self._embedding_function(query_texts)
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+
+        with self._lock:
+            self._refresh()
+            connection = self._connect()
+            allowed = None
+            if where:
+                allowed = np.zeros(self._capacity, dtype=bool)
+                allowed[self._filter_rows(connection, None, where)] = True
+
+            results = {key: [] for key in ("ids", "documents", "metadatas", "distances")}
+            for query in queries:
+                rows, distances = self._search(query, n_results, allowed)
+                records = self._records(connection, rows.tolist(), include)
+                for key in ("ids", "documents", "metadatas"):
+                    results[key].append(records.get(key))
+                results["distances"].append(distances.tolist() if "distances" in include else None)
+
+        return {
+            "ids": results["ids"],
+            "documents": results["documents"] if "documents" in include else None,
+            "metadatas": results["metadatas"] if "metadatas" in include else None,
+            "distances": results["distances"] if "distances" in include else None,
+            "embeddings": None,
+        }
+
+    # Recherche
+
+    def _search(self, query: np.ndarray, k: int, allowed: Optional[np.ndarray]):
+        if self._vectors is None or not self._ids:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        mask = self._active[:self._capacity] if allowed is None else self._active[:self._capacity] & allowed
+        if len(self._ids) >= VECTOR_IVF_MIN_SIZE:
+            self._ensure_ivf()
+            rows = self._ivf_candidates(query)
+            rows = rows[mask[rows]]
+            if len(rows) >= k:
+                return self._top_k(query, rows, k)
+
+        return self._top_k(query, np.flatnonzero(mask), k)
+
+    def _top_k(self, query: np.ndarray, rows: np.ndarray, k: int):
+        """Distances L2 au carré exactes sur les lignes candidates, par blocs, et sélection des k plus proches."""
+        best_rows = np.zeros(0, dtype=np.int64)
+        best_distances = np.zeros(0, dtype=np.float32)
+        query_norm = float(query @ query)
+        for start in range(0, len(rows), _SEARCH_BLOCK):
+            block = rows[start:start + _SEARCH_BLOCK]
+            distances = self._norms[block] - 2.0 * (self._vectors[block] @ query) + query_norm
+            best_rows = np.concatenate([best_rows, block])
+            best_distances = np.concatenate([best_distances, distances])
+            if len(best_rows) > k:
+                keep = np.argpartition(best_distances, k - 1)[:k]
+                best_rows, best_distances = best_rows[keep], best_distances[keep]
+        order = np.argsort(best_distances, kind='stable')
+        return best_rows[order], np.maximum(best_distances[order], 0.0)
+
+    # Index IVF
+
+    def _assign(self, matrix: np.ndarray) -> np.ndarray:
+        if self._centroids is None:
+            return np.full(len(matrix), -1, dtype=np.int32)
+        return _nearest_centroids(matrix, self._centroids)
+
+    def _load_ivf(self) -> None:
+        path = self._file('centroids.npy')
+        if os.path.exists(path):
+            self._centroids = np.load(path)
+            self._build_lists()
+
+    def _build_lists(self) -> None:
+        assignments = np.asarray(self._assignments[:self._capacity])
+        valid = np.flatnonzero((assignments >= 0) & self._active[:self._capacity])
+        order = valid[np.argsort(assignments[valid], kind='stable')]
+        bounds = np.searchsorted(assignments[order], np.arange(len(self._centroids) + 1))
+        self._ivf_lists = [order[bounds[i]:bounds[i + 1]] for i in range(len(self._centroids))]
+        self._ivf_built_size = len(valid)
+
+    def _extend_lists(self, rows: np.ndarray) -> None:
+        """Ajoute les lignes écrites depuis la construction aux listes IVF de leurs centroïdes."""
+        rows = rows[self._active[rows]]
+        assignments = np.asarray(self._assignments[rows])
+        for list_id in np.unique(assignments[assignments >= 0]):
+            self._ivf_lists[list_id] = np.concatenate([self._ivf_lists[list_id], rows[assignments == list_id]])
+
+    def _ensure_ivf(self) -> None:
+        """Construit l'index IVF s'il n'existe pas, ou le reconstruit quand l'index a doublé."""
+        unassigned = self._active[:self._capacity] & (np.asarray(self._assignments[:self._capacity]) < 0)
+        if self._centroids is not None and len(self._ids) < 2 * max(self._ivf_built_size, 1) \
+                and not unassigned.any():
+            return
+
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            self._refresh()
+            rows = np.flatnonzero(self._active[:self._capacity])
+            list_count = int(min(max(np.sqrt(len(rows)), 16), 4096))
+            logger.info("Construction de l'index IVF : %d vecteurs, %d listes", len(rows), list_count)
+            rng = np.random.default_rng(0)
+            sample = np.sort(rng.choice(rows, size=min(len(rows), list_count * 64), replace=False))
+            self._centroids = _kmeans(np.asarray(self._vectors[sample]), list_count, rng)
+            for start in range(0, len(rows), _SEARCH_BLOCK):
+                block = rows[start:start + _SEARCH_BLOCK]
+                self._assignments[block] = _nearest_centroids(np.asarray(self._vectors[block]), self._centroids)
+            self._assignments.flush()
+            tmp_path = self._file('centroids.tmp.npy')
+            np.save(tmp_path, self._centroids)
+            os.replace(tmp_path, self._file('centroids.npy'))
+
+            self._ivf_version = str(int(self._ivf_version or 0) + 1)
+            connection.execute(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES ('ivf_version', ?)", (self._ivf_version,)
+            )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        self._build_lists()
+
+    def _ivf_candidates(self, query: np.ndarray) -> np.ndarray:
+        nprobe = VECTOR_IVF_NPROBE or max(8, len(self._centroids) // 16)
+        distances = np.einsum('ij,ij->i', self._centroids, self._centroids) - 2.0 * (self._centroids @ query)
+        probes = np.argpartition(distances, min(nprobe, len(distances)) - 1)[:nprobe]
+        return np.unique(np.concatenate([self._ivf_lists[i] for i in probes]))
+
+    # Métadonnées
+
+    def _ensure_dimension(self, connection, dimension: int) -> None:
+        if self._dimension is None:
+            self._dimension = dimension
+            connection.executemany(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                [('dimension', str(dimension)), ('capacity', str(_GROWTH_ROWS))]
+            )
+            self._map(_GROWTH_ROWS)
+        elif dimension != self._dimension:
+            raise ValueError(f"Dimension {dimension} incompatible avec l'index (dimension {self._dimension})")
+
+    def _filter_rows(self, connection, ids, where) -> List[int]:
+        if ids is not None:
+            rows = [self._ids[doc_id] for doc_id in ids if doc_id in self._ids]
+        else:
+            rows = np.flatnonzero(self._active[:self._capacity]).tolist()
+        if where:
+            clauses = " AND ".join("json_extract(metadata, ?) = ?" for _ in where)
+            params = [value for key, expected in where.items() for value in (f"$.{key}", expected)]
+            matching = {row["row"] for row in connection.execute(
+                f"SELECT row FROM items WHERE deleted = 0 AND {clauses}", params
+            )}
+            rows = [row for row in rows if row in matching]
+        return rows
+
+    def _records(self, connection, rows: List[int], include) -> Dict:
+        records = {"ids": [self._row_ids[row] for row in rows]}
+        if "documents" in include or "metadatas" in include:
+            found = {}
+            for i in range(0, len(rows), 500):
+                part = rows[i:i + 500]
+                for row in connection.execute(
+                    f"SELECT row, document, metadata FROM items WHERE row IN ({','.join('?' * len(part))})", part
+                ):
+                    found[row["row"]] = row
+            if "documents" in include:
+                records["documents"] = [found[row]["document"] for row in rows]
+            if "metadatas" in include:
+                records["metadatas"] = [
+                    json.loads(found[row]["metadata"]) if found[row]["metadata"] else None for row in rows
+                ]
+        if "embeddings" in include:
+            records["embeddings"] = [np.array(self._vectors[row]) for row in rows]
+        return records
+
+
+def _nearest_centroids(matrix: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    return np.argmin(centroid_norms[None, :] - 2.0 * (matrix @ centroids.T), axis=1).astype(np.int32)
+
+
+def _kmeans(data: np.ndarray, k: int, rng, iterations: int = 10) -> np.ndarray:
+    """K-means simple (Lloyd) pour les centroïdes de l'index IVF."""
+    centroids = data[rng.choice(len(data), size=k, replace=False)].copy()
+    for _ in range(iterations):
+        labels = _nearest_centroids(data, centroids)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, data)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # Une liste vide est réamorcée sur un point au hasard
+        if empty.any():
+            centroids[empty] = data[rng.choice(len(data), size=int(empty.sum()), replace=False)]
+    return centroids